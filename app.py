@@ -1,99 +1,1766 @@
-from flask import Flask, request, jsonify, send_from_directory
-import openai
+from flask import Flask, Response, g, request, jsonify, send_from_directory
+from werkzeug.exceptions import RequestEntityTooLarge
 import os
+import sys
+import importlib
 import io
 import base64
 import uuid
+import json
+import math
+import time
+import hashlib
+import hmac
+import itertools
+import bisect
+import contextvars
+import sqlite3
+import fcntl
+import socket
+import ipaddress
+import threading
+import asyncio
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, wait
 from datetime import datetime
-from PIL import Image
 from urllib.parse import urlparse
 import requests
-import google.generativeai as genai
-from google.genai.types import GenerateImagesConfig
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+class _LazyModule:
+    """Module chỉ được import ở lần đầu truy cập thuộc tính: SDK provider và PIL không làm chậm lúc khởi động"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+
+openai = _LazyModule("openai")
+genai = _LazyModule("google.genai")
+genai_types = _LazyModule("google.genai.types")
+storage = _LazyModule("google.cloud.storage")
+google_auth_credentials = _LazyModule("google.auth.credentials")
+google_api_exceptions = _LazyModule("google.api_core.exceptions")
+Image = _LazyModule("PIL.Image")
+LAZY_MODULES = (openai, genai, genai_types, storage, google_auth_credentials, google_api_exceptions, Image)
 
 app = Flask(__name__)
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GEMINI_IMAGE_MODEL = "imagen-3.0-generate-001"
+GEMINI_EDIT_MODEL = "imagen-3.0-capability-001"  # model Imagen nhận ảnh tham chiếu (style reference)
+# edit_image (ảnh tham chiếu) chỉ chạy trên Vertex AI, không có ở Gemini Developer API (api_key).
+# Có GOOGLE_CLOUD_PROJECT thì tạo thêm client Vertex cho edit_image; không có thì gửi ảnh tham chiếu
+# dạng inline image part tới model ảnh Gemini (generate_content, chạy được với api_key).
+GEMINI_VERTEX_LOCATION = os.getenv("GOOGLE_CLOUD_LOCATION", "us-central1")
+GEMINI_REFERENCE_IMAGE_MODEL = os.getenv("GEMINI_REFERENCE_IMAGE_MODEL", "gemini-2.5-flash-image")
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 IDEOGRAM_API_KEY = os.getenv("IDEOGRAM_API_KEY")
-IDEOGRAM_API_URL = "https://api.ideogram.ai/v1/ideogram-v3/generate"
+IDEOGRAM_API_URL = os.getenv("IDEOGRAM_API_URL", "https://api.ideogram.ai/v1/ideogram-v3/generate")
+
+# Endpoint thay thế cho provider (vd fake server trong bench/), để trống = endpoint thật
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL") or None
+GCS_API_ENDPOINT = os.getenv("GCS_API_ENDPOINT") or None
 UPLOAD_FOLDER = 'generated_images'
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
-from google.cloud import storage
 
-# Cấu hình GCS
-GCS_BUCKET_NAME = os.getenv("GCS_BUCKET_NAME")
-GCS_CREDENTIALS_JSON = "./sun-production.json" 
+# Cấu hình GCS
+GCS_BUCKET_NAME = os.getenv("GCS_BUCKET_NAME")
+GCS_CREDENTIALS_JSON = "./sun-production.json" 
+
+# Cấu hình HTTP connection pool dùng chung cho mọi request ra ngoài
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "20"))  # số host được giữ pool
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "10"))          # số connection keep-alive / host
+# Kích thước pool riêng cho từng host, dạng "host=size,host=size"
+HTTP_POOL_HOST_MAXSIZE = os.getenv("HTTP_POOL_HOST_MAXSIZE", "api.ideogram.ai=20")
+# Ladder tải ảnh (_fetch_image_bytes) gọi lại khi gặp các status này / lỗi mạng, đợi HTTP_RETRY_BACKOFF * 2^lần
+HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", "1"))
+HTTP_RETRY_STATUSES = [int(s) for s in os.getenv("HTTP_RETRY_STATUSES", "429,500,502,503,504").split(",") if s.strip()]
+
+# Retry policy của urllib3 theo từng loại request:
+# - api: POST lên provider (không idempotent) nên không retry, giống requests mặc định
+HTTP_RETRY_PROFILES = {
+    "api": {
+        "total": 0,
+        "read": False,
+    },
+    # image: ladder trong _fetch_image_bytes tự retry trong phạm vi deadline, urllib3 không retry
+    "image": {
+        "total": 0,
+        "read": False,
+    },
+}
+
+
+def _parse_host_sizes(value):
+    """Parse "host=size,host=size" thành dict"""
+    sizes = {}
+    for item in (value or "").split(","):
+        if "=" not in item:
+            continue
+        host, size = item.split("=", 1)
+        try:
+            sizes[host.strip()] = int(size)
+        except ValueError:
+            print(f"Invalid pool size for host {host}: {size}")
+    return sizes
+
+
+class HttpPoolStats:
+    """Đếm số lần lấy connection từ pool: hit = dùng lại connection keep-alive, miss = mở connection mới"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def record(self, host, reused):
+        with self._lock:
+            counters = self._hosts.setdefault(host, {"hits": 0, "misses": 0})
+            counters["hits" if reused else "misses"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            hosts = {host: dict(c) for host, c in self._hosts.items()}
+        hits = sum(c["hits"] for c in hosts.values())
+        misses = sum(c["misses"] for c in hosts.values())
+        return {"hits": hits, "misses": misses, "hosts": hosts}
+
+    def reset(self):
+        with self._lock:
+            self._hosts = {}
+
+
+HTTP_POOL_STATS = HttpPoolStats()
+
+
+class _CountingPoolMixin:
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout=timeout)
+        # Connection mới tạo (hoặc bị drop) chưa có socket -> sẽ phải handshake lại
+        HTTP_POOL_STATS.record(self.host, reused=getattr(conn, "sock", None) is not None)
+        return conn
+
+
+class _CountingHTTPConnectionPool(_CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class _CountingHTTPSConnectionPool(_CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class _PooledAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+
+class HttpPool:
+    """Giữ các requests.Session dùng chung (keep-alive) theo retry profile, an toàn khi fork worker"""
+
+    def __init__(self, profiles, pool_connections, pool_maxsize, host_maxsize=None):
+        self._profiles = profiles
+        self._pool_connections = pool_connections
+        self._pool_maxsize = pool_maxsize
+        self._host_maxsize = host_maxsize or {}
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._pid = os.getpid()
+
+    def _build_session(self, profile):
+        retry = Retry(**self._profiles[profile])
+        session = requests.Session()
+        adapter = _PooledAdapter(
+            pool_connections=self._pool_connections,
+            pool_maxsize=self._pool_maxsize,
+            max_retries=retry,
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+        # Host có lưu lượng cao được mount adapter riêng với pool lớn hơn
+        for host, size in self._host_maxsize.items():
+            host_adapter = _PooledAdapter(pool_connections=1, pool_maxsize=size, max_retries=retry)
+            session.mount(f"http://{host}/", host_adapter)
+            session.mount(f"https://{host}/", host_adapter)
+        return session
+
+    def session(self, profile):
+        if profile not in self._profiles:
+            raise ValueError(f"Unknown HTTP retry profile: {profile}")
+        with self._lock:
+            if self._pid != os.getpid():
+                # Process con sau fork: không dùng lại socket của process cha
+                self._sessions = {}
+                self._pid = os.getpid()
+            session = self._sessions.get(profile)
+            if session is None:
+                session = self._build_session(profile)
+                self._sessions[profile] = session
+            return session
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+    def stats(self):
+        return {
+            "pid": self._pid,
+            "profiles": sorted(self._sessions),
+            "pool_connections": self._pool_connections,
+            "pool_maxsize": self._pool_maxsize,
+            "host_maxsize": self._host_maxsize,
+            **HTTP_POOL_STATS.snapshot(),
+        }
+
+
+HTTP_POOL = HttpPool(
+    HTTP_RETRY_PROFILES,
+    pool_connections=HTTP_POOL_CONNECTIONS,
+    pool_maxsize=HTTP_POOL_MAXSIZE,
+    host_maxsize=_parse_host_sizes(HTTP_POOL_HOST_MAXSIZE),
+)
+
+# === Metrics (Prometheus text format) ===
+# Nhãn endpoint của request hiện tại; được copy sang thread pool qua ForkSafeExecutor
+CURRENT_ENDPOINT = contextvars.ContextVar("endpoint", default="background")
+
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+# Nhiều worker (gunicorn): mỗi worker ghi counter/histogram ra <dir>/<pid>.json, /metrics cộng dồn mọi file
+# để scrape về worker nào cũng thấy tổng. Để trống = chỉ số liệu của process trả lời (1 worker)
+METRICS_MULTIPROC_DIR = os.getenv("METRICS_MULTIPROC_DIR")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "1"))  # giây giữa 2 lần worker ghi file
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class MetricsRegistry:
+    """Counter + histogram trong memory của từng worker (mỗi lần ghi chỉ 1 lock + bisect), xuất dạng Prometheus text.
+    Có multiproc_dir thì cộng dồn counter/histogram của mọi worker; số liệu từ collector chỉ là của worker trả lời
+    nên được gắn thêm nhãn pid (Prometheus tự sum theo pid khi cần)"""
+
+    def __init__(self, multiproc_dir=None, flush_interval=METRICS_FLUSH_INTERVAL):
+        self._lock = threading.Lock()
+        self._metrics = {}  # name -> {"type", "help", "labels", "buckets", "series"}
+        self._collectors = []
+        self.multiproc_dir = multiproc_dir
+        self.flush_interval = flush_interval
+        self._writer_started = False
+        if multiproc_dir:
+            os.makedirs(multiproc_dir, exist_ok=True)
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # Worker đếm từ 0, không cộng lại số liệu kế thừa từ master; thread ghi file không sống qua fork
+        self._lock = threading.Lock()
+        for metric in self._metrics.values():
+            metric["series"] = {}
+        self._writer_started = False
+
+    def counter(self, name, help_text, labels=()):
+        self._metrics[name] = {"type": "counter", "help": help_text, "labels": tuple(labels), "series": {}}
+
+    def histogram(self, name, help_text, labels=(), buckets=METRICS_LATENCY_BUCKETS):
+        self._metrics[name] = {
+            "type": "histogram", "help": help_text, "labels": tuple(labels), "buckets": tuple(buckets), "series": {},
+        }
+
+    def register_collector(self, collector):
+        """collector() -> list (name, type, help, [(labels dict, value)]) đọc từ stats có sẵn lúc scrape"""
+        self._collectors.append(collector)
+
+    def inc(self, name, value=1, **labels):
+        metric = self._metrics[name]
+        key = tuple(labels.get(label, "") for label in metric["labels"])
+        with self._lock:
+            metric["series"][key] = metric["series"].get(key, 0) + value
+        if self.multiproc_dir and not self._writer_started:
+            self._start_writer()
+
+    def observe(self, name, value, **labels):
+        metric = self._metrics[name]
+        key = tuple(labels.get(label, "") for label in metric["labels"])
+        index = bisect.bisect_left(metric["buckets"], value)
+        with self._lock:
+            series = metric["series"].get(key)
+            if series is None:
+                series = metric["series"][key] = [[0] * (len(metric["buckets"]) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+        if self.multiproc_dir and not self._writer_started:
+            self._start_writer()
+
+    def _snapshot(self):
+        with self._lock:
+            return {
+                name: {
+                    key: [list(value[0]), value[1], value[2]] if metric["type"] == "histogram" else value
+                    for key, value in metric["series"].items()
+                }
+                for name, metric in self._metrics.items()
+            }
+
+    # ---- Cộng dồn giữa các worker qua file ----
+    def _start_writer(self):
+        with self._lock:
+            if self._writer_started:
+                return
+            self._writer_started = True
+        threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"Metrics flush failed: {e}")
+
+    def _write(self, path, snapshot):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({name: [[list(key), value] for key, value in series.items()] for name, series in snapshot.items()}, f)
+        os.replace(tmp, path)  # người đọc luôn thấy file đầy đủ
+
+    def flush(self):
+        """Ghi snapshot của process này ra <dir>/<pid>.json"""
+        if self.multiproc_dir:
+            self._write(os.path.join(self.multiproc_dir, f"{os.getpid()}.json"), self._snapshot())
+
+    def _merge(self, merged, data):
+        for name, series in data.items():
+            metric = self._metrics.get(name)
+            if metric is None:
+                continue
+            target = merged.setdefault(name, {})
+            for key, value in series:
+                key = tuple(key)
+                if metric["type"] != "histogram":
+                    target[key] = target.get(key, 0) + value
+                    continue
+                current = target.setdefault(key, [[0] * len(value[0]), 0.0, 0])
+                current[0] = [a + b for a, b in zip(current[0], value[0])]
+                current[1] += value[1]
+                current[2] += value[2]
+
+    def _locked_dir(self, mode):
+        lock = open(os.path.join(self.multiproc_dir, "metrics.lock"), "a")
+        fcntl.flock(lock, mode)
+        return lock
+
+    def _load(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _read_all(self):
+        merged = {}
+        with self._locked_dir(fcntl.LOCK_SH):
+            for entry in os.scandir(self.multiproc_dir):
+                if entry.name.endswith(".json"):
+                    self._merge(merged, self._load(entry.path))
+        return merged
+
+    def mark_dead(self, pid):
+        """Gọi ở master khi worker thoát: gộp file của worker vào archive.json để counter không giảm
+        và thư mục không phình theo mỗi lần max_requests thay worker"""
+        if not self.multiproc_dir:
+            return
+        path = os.path.join(self.multiproc_dir, f"{pid}.json")
+        if not os.path.exists(path):
+            return
+        archive = os.path.join(self.multiproc_dir, "archive.json")
+        with self._locked_dir(fcntl.LOCK_EX):
+            merged = {}
+            self._merge(merged, self._load(archive))
+            self._merge(merged, self._load(path))
+            self._write(archive, merged)
+            os.remove(path)
+
+    def render(self):
+        lines = []
+        if self.multiproc_dir:
+            self.flush()
+            merged = self._read_all()
+        else:
+            merged = self._snapshot()
+        for name, metric in self._metrics.items():
+            series = merged.get(name, {})
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            for key, value in sorted(series.items()):
+                if metric["type"] == "counter":
+                    lines.append(f"{name}{_format_labels(metric['labels'], key)} {value}")
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(metric["buckets"] + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    labels = _format_labels(metric["labels"], key, f'le="{le}"')
+                    lines.append(f"{name}_bucket{labels} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(metric['labels'], key)} {total}")
+                lines.append(f"{name}_count{_format_labels(metric['labels'], key)} {count}")
+
+        for collector in self._collectors:
+            try:
+                families = collector()
+            except Exception as e:
+                print(f"Metrics collector failed: {e}")
+                continue
+            for name, metric_type, help_text, samples in families:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in samples:
+                    if isinstance(value, bool) or not isinstance(value, (int, float)):
+                        continue
+                    if self.multiproc_dir:
+                        labels = {**labels, "pid": str(os.getpid())}
+                    lines.append(f"{name}{_format_labels(labels.keys(), labels.values())} {value}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry(METRICS_MULTIPROC_DIR)
+METRICS.histogram("app_http_request_duration_seconds", "Thời gian xử lý request HTTP", ("endpoint", "method", "status"))
+METRICS.histogram("app_stage_duration_seconds", "Thời gian từng bước của pipeline", ("endpoint", "stage", "outcome"))
+METRICS.counter("app_stage_errors_total", "Số lỗi theo bước và loại exception", ("endpoint", "stage", "error"))
+METRICS.counter("app_stage_bytes_total", "Số bytes xử lý theo bước", ("endpoint", "stage"))
+METRICS.histogram("app_provider_request_duration_seconds", "Thời gian 1 lần gọi provider", ("endpoint", "provider", "outcome"))
+METRICS.histogram("app_provider_queue_wait_seconds", "Thời gian đợi limiter của provider", ("provider",))
+METRICS.counter("app_provider_retries_total", "Số lần gọi lại provider sau 429", ("provider",))
+METRICS.counter("app_download_attempts_total", "Số lần thử tải ảnh theo method", ("method", "outcome"))
+
+
+class timed:
+    """Đo thời gian 1 bước pipeline theo endpoint hiện tại: `with timed("upload"): ...`"""
+
+    __slots__ = ("stage", "started")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        endpoint = CURRENT_ENDPOINT.get()
+        outcome = "ok" if exc_type is None else "error"
+        METRICS.observe("app_stage_duration_seconds", time.perf_counter() - self.started,
+                        endpoint=endpoint, stage=self.stage, outcome=outcome)
+        if exc_type is not None:
+            METRICS.inc("app_stage_errors_total", endpoint=endpoint, stage=self.stage, error=exc_type.__name__)
+        return False
+
+
+def record_bytes(stage, size):
+    METRICS.inc("app_stage_bytes_total", size, endpoint=CURRENT_ENDPOINT.get(), stage=stage)
+
+
+class ForkSafeExecutor:
+    """ThreadPoolExecutor tạo lazy, tạo lại trong process con sau fork (thread không sống sót qua fork)"""
+
+    def __init__(self, max_workers, name):
+        self.max_workers = max_workers
+        self.name = name
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def _get(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name)
+                self._pid = os.getpid()
+            return self._executor
+
+    def submit(self, fn, *args, **kwargs):
+        # Chạy trong bản copy context của thread gọi để giữ nhãn endpoint cho metrics
+        return self._get().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+class TTLCache:
+    """Map giới hạn số phần tử (bỏ phần tử dùng lâu nhất khi đầy), mỗi phần tử hết hạn sau ttl giây"""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return item[1] if item else default
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+# Thời gian tối đa 1 request trùng đợi request đang chạy (giây), sau đó trả lỗi thay vì treo
+SINGLEFLIGHT_WAIT_TIMEOUT = float(os.getenv("SINGLEFLIGHT_WAIT_TIMEOUT", "600"))
+
+
+class SingleFlight:
+    """Gộp các lời gọi trùng key đang chạy: 1 lời gọi thực thi, các lời gọi khác đợi và nhận cùng kết quả hoặc exception"""
+
+    def __init__(self, name, wait_timeout=None):
+        self.name = name
+        self.wait_timeout = wait_timeout or SINGLEFLIGHT_WAIT_TIMEOUT
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> Future
+        self._stats = {"executed": 0, "collapsed": 0, "errors": 0, "wait_timeouts": 0}
+
+    def do(self, key, fn, *args, wait_timeout=None, **kwargs):
+        """wait_timeout: thời gian tối đa lời gọi này đợi nếu phải join (mặc định self.wait_timeout);
+        mỗi lời gọi join đợi theo deadline của chính nó, không thừa hưởng deadline của lời gọi đang chạy"""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+                self._stats["executed"] += 1
+            else:
+                self._stats["collapsed"] += 1
+
+        if not leader:
+            print(f"Single-flight {self.name}: joined in-flight call")
+            try:
+                return future.result(timeout=wait_timeout or self.wait_timeout)
+            except FuturesTimeoutError:
+                # Chỉ lời gọi này bỏ cuộc, lời gọi đang chạy vẫn tiếp tục cho các lời gọi khác
+                with self._lock:
+                    self._stats["wait_timeouts"] += 1
+                raise Exception(f"Timed out waiting for identical in-flight request ({self.name})")
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            # Kể cả khi bị hủy (KeyboardInterrupt, SystemExit...) các lời gọi đang đợi vẫn được giải phóng
+            with self._lock:
+                self._stats["errors"] += 1
+                self._calls.pop(key, None)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._calls.pop(key, None)
+        future.set_result(result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "in_flight": len(self._calls)}
+
+
+def _flight_key(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+# Gộp request trùng: tải ảnh theo URL, phân tích /gen_prompt theo (hash ảnh, style), sinh ảnh theo (prompt, tham số).
+# Gộp sinh ảnh mặc định tắt: hai người dùng cùng prompt sẽ nhận chung một bộ ảnh/URL GCS, chỉ bật khi chấp nhận điều đó
+SINGLEFLIGHT_GENERATION = os.getenv("SINGLEFLIGHT_GENERATION", "0") == "1"
+DOWNLOAD_FLIGHT = SingleFlight("download")
+PROMPT_FLIGHT = SingleFlight("gen_prompt")
+GENERATION_FLIGHT = SingleFlight("generation")
+
+
+class ProviderClients:
+    """Registry client OpenAI / GCS / Gemini: khởi tạo lazy 1 lần mỗi worker, thread-safe, tự tạo lại sau fork hoặc khi credentials đổi"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._build_locks = {}
+        self._clients = {}  # name -> {"client", "fingerprint", "created_at"}
+        self._build_count = {}
+        self._pid = os.getpid()
+        self._providers = {
+            "openai": (self._build_openai, self._openai_fingerprint),
+            "openai_async": (self._build_openai_async, self._openai_fingerprint),  # app_async
+            "gcs": (self._build_gcs, self._gcs_fingerprint),
+            "gemini": (self._build_gemini, self._gemini_fingerprint),
+            "gemini_vertex": (self._build_gemini_vertex, self._gemini_vertex_fingerprint),
+        }
+
+    # ---- Factory + fingerprint cho từng provider ----
+    # Key đọc lại từ môi trường mỗi lần (không dùng hằng lúc import) để rotate credentials rồi reset là nhận key mới
+    def _build_openai(self):
+        return openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"), base_url=OPENAI_BASE_URL, max_retries=OPENAI_MAX_RETRIES)
+
+    def _build_openai_async(self):
+        return openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), base_url=OPENAI_BASE_URL, max_retries=OPENAI_MAX_RETRIES)
+
+    def _openai_fingerprint(self):
+        return os.getenv("OPENAI_API_KEY")
+
+    def _build_gcs(self):
+        if GCS_API_ENDPOINT:
+            # Emulator / fake server không cần credentials
+            return storage.Client(
+                project="local", credentials=google_auth_credentials.AnonymousCredentials(), client_options={"api_endpoint": GCS_API_ENDPOINT}
+            )
+        return storage.Client.from_service_account_json(GCS_CREDENTIALS_JSON)
+
+    def _gcs_fingerprint(self):
+        # File credentials được rotate -> mtime/size thay đổi -> tạo client mới
+        try:
+            st = os.stat(GCS_CREDENTIALS_JSON)
+            return (GCS_CREDENTIALS_JSON, st.st_mtime_ns, st.st_size)
+        except OSError:
+            return (GCS_CREDENTIALS_JSON, None, None)
+
+    def _build_gemini(self):
+        http_options = genai_types.HttpOptions(base_url=GEMINI_BASE_URL) if GEMINI_BASE_URL else None
+        return genai.Client(api_key=os.getenv("GEMINI_API_KEY"), http_options=http_options)
+
+    def _gemini_fingerprint(self):
+        return (os.getenv("GEMINI_API_KEY"), os.getenv("GOOGLE_GENAI_USE_VERTEXAI"), os.getenv("GOOGLE_CLOUD_PROJECT"))
+
+    def _build_gemini_vertex(self):
+        project, location = self._gemini_vertex_fingerprint()
+        if not project:
+            raise Exception("GOOGLE_CLOUD_PROJECT is not configured")
+        http_options = genai_types.HttpOptions(base_url=GEMINI_BASE_URL) if GEMINI_BASE_URL else None
+        return genai.Client(vertexai=True, project=project, location=location, http_options=http_options)
+
+    def _gemini_vertex_fingerprint(self):
+        return (os.getenv("GOOGLE_CLOUD_PROJECT"), os.getenv("GOOGLE_CLOUD_LOCATION", GEMINI_VERTEX_LOCATION))
+
+    # ---- Registry ----
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            # Không dùng lại client (và socket) kế thừa từ process cha
+            self._clients = {}
+            self._build_locks = {}
+            self._pid = os.getpid()
+
+    def get(self, name):
+        if name not in self._providers:
+            raise ValueError(f"Unknown provider client: {name}")
+        build, fingerprint = self._providers[name]
+        current = fingerprint()
+
+        with self._lock:
+            self._check_fork()
+            entry = self._clients.get(name)
+            if entry and entry["fingerprint"] == current:
+                return entry["client"]
+            build_lock = self._build_locks.setdefault(name, threading.Lock())
+
+        # Chỉ 1 thread build client, các thread khác đợi rồi dùng lại
+        with build_lock:
+            with self._lock:
+                entry = self._clients.get(name)
+                if entry and entry["fingerprint"] == current:
+                    return entry["client"]
+            client = build()
+            with self._lock:
+                self._clients[name] = {"client": client, "fingerprint": current, "created_at": datetime.now().isoformat()}
+                self._build_count[name] = self._build_count.get(name, 0) + 1
+            print(f"Initialized {name} client (pid {os.getpid()})")
+            return client
+
+    def openai(self):
+        return self.get("openai")
+
+    def cached(self, name):
+        """Client đang cache trong process này (không tạo mới), None nếu chưa có"""
+        with self._lock:
+            entry = self._clients.get(name) if self._pid == os.getpid() else None
+            return entry["client"] if entry else None
+
+    def gcs_bucket(self):
+        return self.get("gcs").bucket(GCS_BUCKET_NAME)
+
+    def gemini(self):
+        return self.get("gemini")
+
+    def gemini_edit(self):
+        """Client gọi được edit_image (Vertex AI), None nếu chưa cấu hình Vertex"""
+        client = self.gemini()
+        if client.vertexai:
+            return client
+        return self.get("gemini_vertex") if os.getenv("GOOGLE_CLOUD_PROJECT") else None
+
+    def reset(self, names=None):
+        """Bỏ client đang cache (vd sau khi rotate credentials), lần gọi sau sẽ tạo lại.
+        Chỉ bỏ tham chiếu, không close(): thread khác có thể đang gọi dở bằng client cũ, GC dọn khi họ xong"""
+        with self._lock:
+            names = list(self._clients) if names is None else [n for n in names if n in self._clients]
+            for n in names:
+                self._clients.pop(n)
+        return names
+
+    def health(self):
+        with self._lock:
+            clients = {
+                name: {
+                    "initialized": name in self._clients,
+                    "created_at": self._clients[name]["created_at"] if name in self._clients else None,
+                    "build_count": self._build_count.get(name, 0),
+                }
+                for name in self._providers
+            }
+        clients["gcs"]["credentials_file_found"] = os.path.exists(GCS_CREDENTIALS_JSON)
+        clients["openai"]["api_key_configured"] = bool(os.getenv("OPENAI_API_KEY"))
+        clients["gemini"]["api_key_configured"] = bool(os.getenv("GEMINI_API_KEY"))
+        return {"pid": self._pid, "clients": clients}
+
+
+PROVIDER_CLIENTS = ProviderClients()
+
+
+def warm_up():
+    """Import trước SDK provider + plugin PIL. Gọi ở master gunicorn (preload_app) trước khi fork
+    để worker dùng chung các trang bộ nhớ này (copy-on-write) và request đầu tiên không phải đợi import"""
+    timings = {}
+    for module in LAZY_MODULES:
+        started = time.perf_counter()
+        module.load()
+        timings[module._name] = round(time.perf_counter() - started, 3)
+    Image.init()
+    return timings
+
+
+# === Giới hạn tốc độ + concurrency thích ứng theo provider ===
+# Request đợi tối đa PROVIDER_QUEUE_TIMEOUT giây để được gọi provider, quá hạn -> 503 + Retry-After
+PROVIDER_QUEUE_TIMEOUT = float(os.getenv("PROVIDER_QUEUE_TIMEOUT", "30"))
+PROVIDER_THROTTLE_RETRIES = int(os.getenv("PROVIDER_THROTTLE_RETRIES", "2"))  # số lần gọi lại khi bị 429
+# Lỗi tạm thời (408/409/5xx, timeout, mất kết nối): gọi lại sau PROVIDER_ERROR_BACKOFF * 2^lần (như retry của SDK OpenAI)
+PROVIDER_ERROR_RETRIES = int(os.getenv("PROVIDER_ERROR_RETRIES", "2"))
+PROVIDER_ERROR_BACKOFF = float(os.getenv("PROVIDER_ERROR_BACKOFF", "0.5"))
+PROVIDER_DEFAULT_COOLDOWN = float(os.getenv("PROVIDER_DEFAULT_COOLDOWN", "1"))  # khi 429 không có Retry-After
+PROVIDER_AIMD_DECREASE = float(os.getenv("PROVIDER_AIMD_DECREASE", "0.5"))
+PROVIDER_ASYNC_POLL_INTERVAL = 0.05
+# Retry của SDK OpenAI không biết gì về limiter (gọi lại ngay cả khi đang cooldown 429) -> mặc định tắt,
+# ProviderLimiter.call tự gọi lại 429 và lỗi tạm thời cho mọi provider
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "0"))
+
+
+class ProviderOverloaded(Exception):
+    """Provider đang quá tải / hết quota, request không được gửi đi trong thời gian cho phép"""
+
+    def __init__(self, provider, retry_after):
+        super().__init__(f"{provider} is overloaded, retry after {math.ceil(retry_after)}s")
+        self.provider = provider
+        self.retry_after = retry_after
+
+
+def _provider_error_status(e):
+    """Lấy (status_code, response) từ exception của requests / httpx / openai / google-genai"""
+    response = getattr(e, "response", None)
+    status = getattr(e, "status_code", None) or getattr(response, "status_code", None)
+    if status is None and isinstance(getattr(e, "code", None), int):
+        status = e.code
+    return status, response
+
+
+def _provider_retry_after(response):
+    if response is None:
+        return None
+    retry_after_ms = response.headers.get("retry-after-ms")  # header riêng của OpenAI
+    if retry_after_ms:
+        try:
+            return max(0.0, float(retry_after_ms) / 1000)
+        except ValueError:
+            pass
+    return _retry_after_seconds(response)
+
+
+def _is_connection_error(e):
+    if isinstance(e, (requests.ConnectionError, requests.Timeout, TimeoutError)):
+        return True
+    # Chỉ kiểm tra lỗi của SDK OpenAI / httpx (app_async) khi đã được load (không import chỉ để isinstance)
+    httpx_module = sys.modules.get("httpx")
+    if httpx_module is not None and isinstance(e, httpx_module.TransportError):
+        return True
+    openai_module = sys.modules.get("openai")
+    return openai_module is not None and isinstance(e, openai_module.APIConnectionError)
+
+
+def _is_transient_error(e):
+    """Lỗi đáng gọi lại cùng provider (giống danh sách retry của SDK OpenAI, trừ 429 do limiter xử lý riêng)"""
+    status, _ = _provider_error_status(e)
+    return status in (408, 409) or (status is not None and status >= 500) or _is_connection_error(e)
+
+
+class ProviderLimiter:
+    """Token bucket (rate/burst theo quota) + giới hạn concurrency AIMD: tăng dần khi thành công, giảm nửa khi 429/5xx/timeout.
+    429 kèm Retry-After tạm dừng mọi request tới provider cho tới hết thời gian đó."""
+
+    def __init__(self, name, rate, burst, min_limit, max_limit, initial_limit=None, queue_timeout=None):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.queue_timeout = queue_timeout if queue_timeout is not None else PROVIDER_QUEUE_TIMEOUT
+        self._cond = threading.Condition()
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._limit = float(initial_limit or max_limit)
+        self._in_flight = 0
+        self._blocked_until = 0.0
+        self._stats = {"admitted": 0, "queued": 0, "rejected": 0, "throttled": 0, "errors": 0, "retries": 0}
+        self._queue_wait_total = 0.0
+
+    # ---- Admission ----
+    def _try_acquire(self, now):
+        """0 = được gọi; số dương = cần đợi ít nhất bấy nhiêu giây; None = đợi 1 request khác xong"""
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        if self._in_flight >= int(self._limit):
+            return None
+        if self._tokens < 1:
+            return (1 - self._tokens) / self.rate
+        self._tokens -= 1
+        self._in_flight += 1
+        return 0
+
+    def _estimate_retry_after(self, now):
+        return max(1.0, self._blocked_until - now, (1 - self._tokens) / self.rate)
+
+    def _admitted(self, started):
+        waited = time.monotonic() - started
+        METRICS.observe("app_provider_queue_wait_seconds", waited, provider=self.name)
+        self._stats["admitted"] += 1
+        if waited > 0.001:
+            self._stats["queued"] += 1
+            self._queue_wait_total += waited
+
+    def _reject(self, now):
+        self._stats["rejected"] += 1
+        return ProviderOverloaded(self.name, self._estimate_retry_after(now))
+
+    def acquire(self, timeout=None):
+        started = time.monotonic()
+        deadline = started + (self.queue_timeout if timeout is None else timeout)
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                wait = self._try_acquire(now)
+                if wait == 0:
+                    self._admitted(started)
+                    return
+                remaining = deadline - now
+                if remaining <= 0 or (wait is not None and wait > remaining):
+                    raise self._reject(now)
+                self._cond.wait(remaining if wait is None else wait)
+
+    async def acquire_async(self, timeout=None):
+        started = time.monotonic()
+        deadline = started + (self.queue_timeout if timeout is None else timeout)
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                wait = self._try_acquire(now)
+                if wait == 0:
+                    self._admitted(started)
+                    return
+                remaining = deadline - now
+                if remaining <= 0 or (wait is not None and wait > remaining):
+                    raise self._reject(now)
+            await asyncio.sleep(min(remaining, wait or PROVIDER_ASYNC_POLL_INTERVAL))
+
+    def _observe_call(self, started, error=None):
+        if error is None:
+            outcome = "ok"
+        else:
+            status, _ = _provider_error_status(error)
+            outcome = str(status) if status else type(error).__name__
+        METRICS.observe("app_provider_request_duration_seconds", time.perf_counter() - started,
+                        endpoint=CURRENT_ENDPOINT.get(), provider=self.name, outcome=outcome)
+
+    def release(self, error=None, adjust=True):
+        """Trả slot và điều chỉnh limit theo kết quả. Trả về True nếu lỗi là 429 (đáng gọi lại)"""
+        throttled = False
+        status, response = _provider_error_status(error) if error is not None else (None, None)
+        with self._cond:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if not adjust:
+                pass
+            elif error is None:
+                # Additive increase: +1 sau khoảng 1 "cửa sổ" request thành công
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            elif status == 429 or (status is not None and status >= 500) or _is_connection_error(error):
+                self._limit = max(self.min_limit, self._limit * PROVIDER_AIMD_DECREASE)
+                retry_after = _provider_retry_after(response)
+                if status == 429:
+                    throttled = True
+                    self._stats["throttled"] += 1
+                    retry_after = PROVIDER_DEFAULT_COOLDOWN if retry_after is None else retry_after
+                else:
+                    self._stats["errors"] += 1
+                if retry_after:
+                    self._blocked_until = max(self._blocked_until, now + retry_after)
+            self._cond.notify_all()
+        return throttled
+
+    # ---- Gọi provider ----
+    def _finished(self, started):
+        self._observe_call(started)
+        self.release()
+
+    def _retry_delay(self, attempt, started, error, deadline):
+        """Ghi nhận lần gọi lỗi và trả slot. Trả về số giây đợi trước khi gọi lại (429: 0, acquire tự đợi
+        hết cooldown; lỗi tạm thời: backoff), None nếu không gọi lại; hết lượt gọi lại khi bị 429 -> ProviderOverloaded"""
+        self._observe_call(started, error)
+        if self.release(error):
+            if attempt >= PROVIDER_THROTTLE_RETRIES:
+                raise ProviderOverloaded(self.name, self._estimate_retry_after(time.monotonic())) from error
+            delay = 0.0
+        elif attempt < PROVIDER_ERROR_RETRIES and _is_transient_error(error):
+            delay = PROVIDER_ERROR_BACKOFF * 2 ** attempt
+            if time.monotonic() + delay >= deadline:
+                return None  # không đủ thời gian cho lần gọi lại: trả lỗi gốc
+        else:
+            return None
+        with self._cond:
+            self._stats["retries"] += 1
+        METRICS.inc("app_provider_retries_total", provider=self.name)
+        return 0.0
+
+    def call(self, fn, *args, **kwargs):
+        """Gọi fn trong 1 slot; bị 429 thì đợi theo Retry-After, lỗi tạm thời thì backoff, rồi gọi lại
+        trong phần thời gian đợi còn lại"""
+        deadline = time.monotonic() + self.queue_timeout
+        for attempt in itertools.count():
+            self.acquire(timeout=max(0.0, deadline - time.monotonic()))
+            started = time.perf_counter()
+            released = False
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                released = True
+                delay = self._retry_delay(attempt, started, e, deadline)
+                if delay is None:
+                    raise
+                time.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+            else:
+                released = True
+                self._finished(started)
+                return result
+            finally:
+                if not released:
+                    # GeneratorExit / KeyboardInterrupt...: trả slot, không tính là thành công hay lỗi của provider
+                    self.release(adjust=False)
+
+    async def call_async(self, fn, *args, **kwargs):
+        deadline = time.monotonic() + self.queue_timeout
+        for attempt in itertools.count():
+            await self.acquire_async(timeout=max(0.0, deadline - time.monotonic()))
+            started = time.perf_counter()
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                delay = self._retry_delay(attempt, started, e, deadline)
+                if delay is None:
+                    raise
+                await asyncio.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+            except BaseException:
+                self.release(adjust=False)  # bị hủy: không tính là thành công hay lỗi của provider
+                raise
+            else:
+                self._finished(started)
+                return result
+
+    def stats(self):
+        with self._cond:
+            now = time.monotonic()
+            queued = self._stats["queued"]
+            return {
+                **self._stats,
+                "limit": round(self._limit, 2),
+                "in_flight": self._in_flight,
+                "tokens": round(min(self.burst, self._tokens + (now - self._refilled_at) * self.rate), 2),
+                "cooldown_remaining": round(max(0.0, self._blocked_until - now), 2),
+                "avg_queue_wait": round(self._queue_wait_total / queued, 3) if queued else 0.0,
+            }
+
+
+def _create_provider_limiter(name, rate, burst, max_limit):
+    prefix = name.upper()
+    return ProviderLimiter(
+        name,
+        rate=float(os.getenv(f"{prefix}_RATE_LIMIT", str(rate))),  # request/giây
+        burst=float(os.getenv(f"{prefix}_RATE_BURST", str(burst))),
+        min_limit=int(os.getenv(f"{prefix}_MIN_CONCURRENCY", "1")),
+        max_limit=int(os.getenv(f"{prefix}_MAX_CONCURRENCY", str(max_limit))),
+        initial_limit=int(os.getenv(f"{prefix}_INITIAL_CONCURRENCY", str(max_limit))),
+    )
+
+
+OPENAI_LIMITER = _create_provider_limiter("openai", rate=5, burst=10, max_limit=16)
+IDEOGRAM_LIMITER = _create_provider_limiter("ideogram", rate=2, burst=5, max_limit=10)
+GEMINI_LIMITER = _create_provider_limiter("gemini", rate=2, burst=5, max_limit=8)
+PROVIDER_LIMITERS = (OPENAI_LIMITER, IDEOGRAM_LIMITER, GEMINI_LIMITER)
+
+
+def _overloaded_result(e):
+    return {"error": str(e), "provider": e.provider, "retry_after": e.retry_after}, 503
+
+
+# === Định tuyến provider: circuit breaker + hedged request ===
+# Mặc định tắt: mỗi route chỉ gọi đúng 1 provider như trước. Bật ROUTING_ENABLED=1 thì các route tạo ảnh
+# (/generate_image, /generate_image_from_prompt, /ideogram/generate, /gemini/generate) đi qua PROVIDER_ROUTER: bỏ qua provider đang mở breaker, chuyển sang provider dự phòng khi lỗi,
+# và khi provider đang chạy chậm hơn percentile độ trễ gần đây của chính nó thì gửi thêm 1 request (hedge)
+# tới provider dự phòng, lấy kết quả về trước, hủy bên thua.
+ROUTING_ENABLED = os.getenv("ROUTING_ENABLED", "0") == "1"
+# Provider dự phòng theo thứ tự cho từng provider chính: "openai=gemini,ideogram;gemini=openai"
+ROUTING_ALTERNATES = os.getenv("ROUTING_ALTERNATES", "openai=gemini,ideogram;gemini=openai,ideogram;ideogram=openai,gemini")
+ROUTING_MAX_CONCURRENCY = int(os.getenv("ROUTING_MAX_CONCURRENCY", "64"))
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "1") == "1"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))  # hedge khi request chậm hơn p95 của provider
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "2"))
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "30"))  # khi chưa đủ mẫu độ trễ
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_SAMPLE_SIZE = int(os.getenv("HEDGE_SAMPLE_SIZE", "200"))
+HEDGE_MAX = int(os.getenv("HEDGE_MAX", "1"))  # số request hedge tối đa / lần gọi (không tính failover)
+BREAKER_WINDOW = float(os.getenv("BREAKER_WINDOW", "60"))  # giây
+BREAKER_MIN_REQUESTS = int(os.getenv("BREAKER_MIN_REQUESTS", "10"))
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_LATENCY_PERCENTILE = float(os.getenv("BREAKER_LATENCY_PERCENTILE", "90"))
+BREAKER_LATENCY_THRESHOLD = float(os.getenv("BREAKER_LATENCY_THRESHOLD", "120"))  # giây
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+ROUTING_DECISION_LOG_SIZE = int(os.getenv("ROUTING_DECISION_LOG_SIZE", "1000"))
+ROUTING_DECISION_LOG_PATH = os.getenv("ROUTING_DECISION_LOG_PATH", "")  # JSONL, trống = chỉ giữ trong memory
+
+
+# Event hủy của lần thử hiện tại (bản sync): bên thua hedge tự dừng ở các điểm kiểm tra, vd trước khi upload
+ROUTE_CANCEL = contextvars.ContextVar("route_cancel", default=None)
+
+
+class RouteCancelled(Exception):
+    """Lần thử bị bỏ vì provider khác đã thắng"""
+
+
+def _check_route_cancelled():
+    cancel = ROUTE_CANCEL.get()
+    if cancel is not None and cancel.is_set():
+        raise RouteCancelled("Another provider already won")
+
+
+def _parse_alternates(value):
+    """'openai=gemini,ideogram;gemini=openai' -> {"openai": ["gemini", "ideogram"], "gemini": ["openai"]}"""
+    result = {}
+    for part in (value or "").split(";"):
+        if "=" not in part:
+            continue
+        primary, alternates = part.split("=", 1)
+        result[primary.strip()] = [name.strip() for name in alternates.split(",") if name.strip()]
+    return result
+
+
+def _percentile(values, percentile):
+    """Percentile kiểu nearest-rank, None nếu không có mẫu"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(percentile / 100 * len(ordered)) - 1))]
+
+
+def _is_provider_failure(e):
+    """Lỗi cho thấy provider không khỏe (429 sau khi hết lượt gọi lại, 5xx, timeout, mất kết nối).
+    Lỗi do request (4xx, prompt bị từ chối...) thì provider khác cũng sẽ từ chối -> không chuyển provider."""
+    seen = set()
+    while e is not None and id(e) not in seen:
+        seen.add(id(e))
+        status, _ = _provider_error_status(e)
+        if status == 429 or (status is not None and status >= 500) or _is_connection_error(e):
+            return True
+        if status is not None:
+            return False
+        e = e.__cause__ or e.__context__
+    return False
+
+
+class RoutingDecisionLog:
+    """Ghi lại mọi quyết định định tuyến (ring buffer + JSONL tùy chọn + counter) để chỉnh ngưỡng"""
+
+    def __init__(self, max_entries, path=None):
+        self._entries = deque(maxlen=max_entries)
+        self._lock = threading.Lock()
+        self.path = path
+        directory = os.path.dirname(path) if path else None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def record(self, route, run_id, decision, provider, **details):
+        entry = {"ts": round(time.time(), 3), "route": route, "run": run_id, "decision": decision,
+                 "provider": provider, **details}
+        METRICS.inc("app_routing_decisions_total", route=route or "-", decision=decision, provider=provider)
+        with self._lock:
+            self._entries.append(entry)
+            if self.path:
+                try:
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                except OSError as e:
+                    print(f"Cannot write routing decision log: {e}")
+
+    def recent(self, limit=100, route=None, provider=None):
+        with self._lock:
+            entries = list(self._entries)
+        entries = [e for e in entries if (route is None or e["route"] == route) and (provider is None or e["provider"] == provider)]
+        return entries[-limit:] if limit else entries
+
+
+class CircuitBreaker:
+    """Breaker theo cửa sổ trượt BREAKER_WINDOW giây: mở khi tỉ lệ lỗi hoặc độ trễ percentile vượt ngưỡng.
+    Sau BREAKER_OPEN_SECONDS chuyển half-open: cho 1 request thử, thành công thì đóng, lỗi thì mở lại.
+    Giữ thêm độ trễ các lần gọi gần đây để tính thời điểm hedge."""
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+    PROBE = "probe"  # allow() trả về cho request thử ở half-open
+
+    def __init__(self, name, decision_log):
+        self.name = name
+        self._log = decision_log
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._window = deque()  # (thời điểm, ok/None = bị hủy, độ trễ)
+        self._latencies = deque(maxlen=HEDGE_SAMPLE_SIZE)
+        self._stats = {"opened": 0, "short_circuited": 0, "successes": 0, "failures": 0, "cancelled": 0}
+
+    def _trim(self, now):
+        while self._window and self._window[0][0] < now - BREAKER_WINDOW:
+            self._window.popleft()
+
+    def _health(self):
+        """(số request, tỉ lệ lỗi, độ trễ percentile) trong cửa sổ hiện tại"""
+        finished = [ok for _, ok, _ in self._window if ok is not None]
+        error_rate = finished.count(False) / len(finished) if finished else 0.0
+        latency = _percentile([latency for _, _, latency in self._window], BREAKER_LATENCY_PERCENTILE)
+        return len(self._window), error_rate, latency
+
+    def _transition(self, state, now, **details):
+        self._state = state
+        if state == self.OPEN:
+            self._opened_at = now
+            self._stats["opened"] += 1
+        elif state == self.CLOSED:
+            self._window.clear()  # bắt đầu cửa sổ mới sau khi hồi phục
+        return {"state": state, **details}
+
+    def allow(self):
+        """Truthy nếu được gửi request: True khi đóng, PROBE cho request thử ở half-open (1 request tại 1 thời điểm).
+        Giá trị này truyền lại cho record()/abandon() để chỉ request thử mới quyết định trạng thái half-open"""
+        transition = None
+        with self._lock:
+            now = time.monotonic()
+            if self._state == self.OPEN and now - self._opened_at >= BREAKER_OPEN_SECONDS:
+                transition = self._transition(self.HALF_OPEN, now)
+            if self._state == self.CLOSED:
+                allowed = True
+            elif self._state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                allowed = self.PROBE
+            else:
+                allowed = False
+                self._stats["short_circuited"] += 1
+        if transition:
+            self._log.record(None, None, "breaker", self.name, **transition)
+        return allowed
+
+    def record(self, ok, latency, probe=False):
+        """ok: True/False theo kết quả, None nếu request bị hủy (độ trễ là cận dưới); probe: giá trị allow() đã trả"""
+        transition = None
+        with self._lock:
+            now = time.monotonic()
+            self._window.append((now, ok, latency))
+            self._trim(now)
+            self._latencies.append(latency)
+            self._stats["cancelled" if ok is None else "successes" if ok else "failures"] += 1
+            if self._state == self.HALF_OPEN and probe == self.PROBE:
+                # Request gửi từ lúc còn đóng (về muộn) không được coi là kết quả của request thử
+                self._probe_in_flight = False
+                if ok and latency < BREAKER_LATENCY_THRESHOLD:
+                    transition = self._transition(self.CLOSED, now, latency=round(latency, 3))
+                else:
+                    reason = "probe_cancelled" if ok is None else "probe_failed"
+                    transition = self._transition(self.OPEN, now, reason=reason, latency=round(latency, 3))
+            elif self._state == self.CLOSED:
+                count, error_rate, p_latency = self._health()
+                reason = None
+                if count >= BREAKER_MIN_REQUESTS and error_rate >= BREAKER_ERROR_RATE:
+                    reason = "error_rate"
+                elif count >= BREAKER_MIN_REQUESTS and p_latency >= BREAKER_LATENCY_THRESHOLD:
+                    reason = "latency"
+                if reason:
+                    transition = self._transition(self.OPEN, now, reason=reason, requests=count,
+                                                  error_rate=round(error_rate, 3), latency=round(p_latency, 3))
+        if transition:
+            self._log.record(None, None, "breaker", self.name, **transition)
+
+    def abandon(self, probe):
+        """Request đã được allow() nhưng không gửi đi (hủy trước khi chạy); chỉ trả lượt thử nếu đó là request thử"""
+        if probe == self.PROBE:
+            with self._lock:
+                self._probe_in_flight = False
+
+    def hedge_delay(self):
+        """Giây đợi trước khi hedge: percentile HEDGE_PERCENTILE độ trễ gần đây, tối thiểu HEDGE_MIN_DELAY"""
+        with self._lock:
+            samples = list(self._latencies)
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        return max(HEDGE_MIN_DELAY, _percentile(samples, HEDGE_PERCENTILE))
+
+    def retry_after(self):
+        with self._lock:
+            return max(1.0, self._opened_at + BREAKER_OPEN_SECONDS - time.monotonic())
+
+    def stats(self):
+        with self._lock:
+            self._trim(time.monotonic())
+            count, error_rate, latency = self._health()
+            state = self._state
+            stats = dict(self._stats)
+        return {
+            **stats,
+            "state": state,
+            "window_requests": count,
+            "error_rate": round(error_rate, 3),
+            "latency_p": round(latency, 3) if latency is not None else None,
+            "hedge_delay": round(self.hedge_delay(), 3),
+        }
+
+
+class ProviderRouter:
+    """Chạy 1 việc trên provider chính + các provider dự phòng.
+    attempts: list (provider, fn) theo thứ tự ưu tiên, mọi fn trả kết quả cùng dạng cho route; trả về (provider, kết quả).
+    Bản sync không dừng được thread đang gọi provider: bên thua chạy nốt lời gọi provider rồi dừng ở điểm kiểm tra
+    ROUTE_CANCEL (vd trước khi upload), kết quả bị bỏ (vẫn tính vào breaker)."""
+
+    def __init__(self, providers, alternates, decision_log):
+        self.log = decision_log
+        self.alternates = alternates
+        self.breakers = {name: CircuitBreaker(name, decision_log) for name in providers}
+        self._executor = ForkSafeExecutor(ROUTING_MAX_CONCURRENCY, "route")
+
+    def candidates(self, primary):
+        return [primary] + [name for name in self.alternates.get(primary, []) if name != primary and name in self.breakers]
+
+    def _record(self, provider, started, probe, error=None, cancelled=False):
+        elapsed = time.perf_counter() - started
+        breaker = self.breakers[provider]
+        if cancelled or isinstance(error, RouteCancelled):
+            breaker.record(None, elapsed, probe)
+        elif error is None:
+            breaker.record(True, elapsed, probe)
+        elif isinstance(error, ProviderOverloaded) and error.__cause__ is None:
+            # Limiter của chính mình từ chối (hết slot/quota local), provider không nhận request nào
+            breaker.abandon(probe)
+        else:
+            # Lỗi do request (4xx) vẫn là provider trả lời bình thường
+            breaker.record(not _is_provider_failure(error), elapsed, probe)
+        return elapsed
+
+    def _attempt(self, provider, fn, probe, cancel):
+        ROUTE_CANCEL.set(cancel)  # chạy trong bản copy context của executor, không ảnh hưởng thread gọi
+        started = time.perf_counter()
+        try:
+            result = fn()
+        except Exception as e:
+            self._record(provider, started, probe, e)
+            raise
+        self._record(provider, started, probe)
+        return result
+
+    def _next_allowed(self, remaining, log):
+        """Lấy provider kế tiếp đang cho phép gửi request (provider, fn, probe), ghi lại các provider bị bỏ qua"""
+        while remaining:
+            provider, fn = remaining.pop(0)
+            probe = self.breakers[provider].allow()
+            if probe:
+                return provider, fn, probe
+            log("skip", provider, reason="breaker_open")
+        return None, None, None
+
+    def _all_open(self, attempts, log):
+        provider = attempts[0][0]
+        log("reject", provider, reason="all_breakers_open")
+        return ProviderOverloaded(provider, min(self.breakers[name].retry_after() for name, _ in attempts))
+
+    def run(self, route, attempts):
+        run_id = uuid.uuid4().hex[:12]
+        log = lambda decision, provider, **details: self.log.record(route, run_id, decision, provider, **details)
+        remaining = list(attempts)
+        in_flight = {}  # future -> (provider, thời điểm gửi, hedge delay, probe, event hủy)
+        hedges = 0
+        errors = []
+
+        def launch(decision, **details):
+            provider, fn, probe = self._next_allowed(remaining, log)
+            if provider is None:
+                return False
+            delay = self.breakers[provider].hedge_delay() if HEDGE_ENABLED else None
+            cancel = threading.Event()
+            future = self._executor.submit(self._attempt, provider, fn, probe, cancel)
+            in_flight[future] = (provider, time.perf_counter(), delay, probe, cancel)
+            log(decision, provider, hedge_delay=round(delay, 3) if delay is not None else None, **details)
+            return True
+
+        if not launch("primary"):
+            raise self._all_open(attempts, log)
+        while in_flight:
+            timeout = None
+            if HEDGE_ENABLED and remaining and hedges < HEDGE_MAX:
+                _, started, delay, *_ = list(in_flight.values())[-1]
+                timeout = max(0.0, started + delay - time.perf_counter())
+            done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                hedges += 1
+                slow, started, *_ = list(in_flight.values())[-1]
+                launch("hedge", after=slow, elapsed=round(time.perf_counter() - started, 3))
+                continue
+            for future in done:
+                provider, started, *_ = in_flight.pop(future)
+                elapsed = round(time.perf_counter() - started, 3)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    errors.append(e)
+                    log("error", provider, elapsed=elapsed, error=type(e).__name__, detail=str(e)[:200])
+                    retryable = isinstance(e, ProviderOverloaded) or _is_provider_failure(e)
+                    if retryable and not in_flight:
+                        launch("failover", after=provider)
+                    continue
+                log("win", provider, elapsed=elapsed, hedged=hedges > 0)
+                for loser, (name, loser_started, _, probe, cancel) in in_flight.items():
+                    cancel.set()
+                    if loser.cancel():
+                        self.breakers[name].abandon(probe)
+                    log("cancel", name, elapsed=round(time.perf_counter() - loser_started, 3), running=not loser.cancelled())
+                return provider, result
+        # Lỗi đầu tiên (thường của provider chính) giữ đúng dạng lỗi route vẫn trả trước đây
+        log("fail", attempts[0][0], error=type(errors[0]).__name__)
+        raise errors[0]
+
+    async def run_async(self, route, attempts):
+        """Như run() nhưng fn là coroutine function; bên thua bị cancel thật (đóng request HTTP đang chờ)"""
+        run_id = uuid.uuid4().hex[:12]
+        log = lambda decision, provider, **details: self.log.record(route, run_id, decision, provider, **details)
+        remaining = list(attempts)
+        in_flight = {}  # task -> (provider, thời điểm gửi, hedge delay, probe, trạng thái)
+        hedges = 0
+        errors = []
+
+        async def attempt(provider, fn, probe, state):
+            state["started"] = True
+            started = time.perf_counter()
+            try:
+                result = await fn()
+            except asyncio.CancelledError:
+                self._record(provider, started, probe, cancelled=True)
+                raise
+            except Exception as e:
+                self._record(provider, started, probe, e)
+                raise
+            self._record(provider, started, probe)
+            return result
+
+        def launch(decision, **details):
+            provider, fn, probe = self._next_allowed(remaining, log)
+            if provider is None:
+                return False
+            delay = self.breakers[provider].hedge_delay() if HEDGE_ENABLED else None
+            state = {"started": False}
+            in_flight[asyncio.ensure_future(attempt(provider, fn, probe, state))] = (provider, time.perf_counter(), delay, probe, state)
+            log(decision, provider, hedge_delay=round(delay, 3) if delay is not None else None, **details)
+            return True
+
+        if not launch("primary"):
+            raise self._all_open(attempts, log)
+        try:
+            while in_flight:
+                timeout = None
+                if HEDGE_ENABLED and remaining and hedges < HEDGE_MAX:
+                    _, started, delay, *_ = list(in_flight.values())[-1]
+                    timeout = max(0.0, started + delay - time.perf_counter())
+                done, _ = await asyncio.wait(in_flight, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedges += 1
+                    slow, started, *_ = list(in_flight.values())[-1]
+                    launch("hedge", after=slow, elapsed=round(time.perf_counter() - started, 3))
+                    continue
+                for task in done:
+                    provider, started, *_ = in_flight.pop(task)
+                    elapsed = round(time.perf_counter() - started, 3)
+                    error = task.exception()
+                    if error is not None:
+                        errors.append(error)
+                        log("error", provider, elapsed=elapsed, error=type(error).__name__, detail=str(error)[:200])
+                        retryable = isinstance(error, ProviderOverloaded) or _is_provider_failure(error)
+                        if retryable and not in_flight:
+                            launch("failover", after=provider)
+                        continue
+                    log("win", provider, elapsed=elapsed, hedged=hedges > 0)
+                    for name, loser_started, *_ in in_flight.values():
+                        log("cancel", name, elapsed=round(time.perf_counter() - loser_started, 3), running=True)
+                    return provider, task.result()
+            log("fail", attempts[0][0], error=type(errors[0]).__name__)
+            raise errors[0]
+        finally:
+            # Thắng / lỗi / client ngắt kết nối: hủy mọi request còn chạy
+            for task, (name, _, _, probe, state) in in_flight.items():
+                task.cancel()
+                if not state["started"]:
+                    # Task chưa chạy tới attempt() thì không ghi gì vào breaker -> trả lượt thử ở đây
+                    self.breakers[name].abandon(probe)
+
+    def stats(self):
+        return {name: breaker.stats() for name, breaker in self.breakers.items()}
+
+
+METRICS.counter("app_routing_decisions_total", "Quyết định định tuyến provider (primary/hedge/failover/win/cancel/skip/...)",
+                ("route", "decision", "provider"))
+
+ROUTING_DECISIONS = RoutingDecisionLog(ROUTING_DECISION_LOG_SIZE, ROUTING_DECISION_LOG_PATH or None)
+PROVIDER_ROUTER = ProviderRouter(
+    [limiter.name for limiter in PROVIDER_LIMITERS], _parse_alternates(ROUTING_ALTERNATES), ROUTING_DECISIONS,
+)
+
+
+# Mặc định ảnh được encode và upload hoàn toàn trong memory.
+# Bật GCS_SPOOL_TO_DISK=1 để ghi tạm ra UPLOAD_FOLDER trước khi upload (vd khi cần giữ RAM thấp).
+GCS_SPOOL_TO_DISK = os.getenv("GCS_SPOOL_TO_DISK", "0") == "1"
+# optimize=True cho file nhỏ hơn nhưng encode chậm hơn nhiều lần với ảnh 1024px
+GENERATED_PNG_OPTIMIZE = os.getenv("GENERATED_PNG_OPTIMIZE", "1") == "1"
+
+def _generated_filename(ext="png"):
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    unique_id = str(uuid.uuid4())[:8]
+    return f"generated_{timestamp}_{unique_id}.{ext}"
+
+def upload_to_gcs(local_file_path, destination_blob_name=None):
+    """Upload file lên GCS và trả về public URL"""
+    try:
+        bucket = PROVIDER_CLIENTS.gcs_bucket()
+
+        # Luôn lưu vào folder 'history_redesign/'
+        filename = os.path.basename(local_file_path)
+        destination_blob_name = destination_blob_name or f"history_redesign/{filename}"
+
+        # Tên file trên GCS
+        if not destination_blob_name:
+            destination_blob_name = os.path.basename(local_file_path)
+
+        blob = bucket.blob(destination_blob_name)
+        with timed("upload"):
+            blob.upload_from_filename(local_file_path)
+
+        # Thiết lập quyền public
+        with timed("make_public"):
+            blob.make_public()
+        return blob.public_url
+    except Exception as e:
+        print(f"Upload to GCS failed: {e}")
+        return None
+    finally:
+        # Luôn dọn file tạm, kể cả khi upload lỗi
+        try:
+            os.remove(local_file_path)
+        except OSError:
+            pass
+
+def upload_bytes_to_gcs(data, destination_blob_name=None, content_type="image/png"):
+    """Upload bytes trong memory lên GCS và trả về public URL, raise nếu lỗi"""
+    try:
+        bucket = PROVIDER_CLIENTS.gcs_bucket()
+        destination_blob_name = destination_blob_name or f"history_redesign/{_generated_filename()}"
+
+        blob = bucket.blob(destination_blob_name)
+        with timed("upload"):
+            blob.upload_from_string(data, content_type=content_type)
+        record_bytes("upload", len(data))
+
+        # Thiết lập quyền public
+        with timed("make_public"):
+            blob.make_public()
+        return blob.public_url
+    except Exception as e:
+        print(f"Upload to GCS failed: {e}")
+        raise Exception(f"Upload to GCS failed: {str(e)}")
+
+
+# === Upload theo nội dung (dedup) ===
+# Object đặt tên theo sha256 của ảnh nguồn: ảnh trùng (client retry, crop lại, provider trả ảnh giống hệt)
+# trả lại public URL đã có, không encode / upload / set ACL lần nữa.
+# Bytes lưu là ảnh đã encode nên tên object kèm tham số encode (GENERATED_PNG_OPTIMIZE, phiên bản Pillow):
+# <prefix>/<sha256 ảnh nguồn>.<tham số encode>.<ext>; đổi tham số -> object mới, 1 tên luôn đúng 1 nội dung.
+# Thứ tự kiểm tra: index local (TTL) -> metadata object trên GCS -> upload với ifGenerationMatch=0
+# (request khác vừa upload cùng nội dung thì GCS trả 412, dùng luôn object đó).
+# Object được upload kèm predefinedAcl=publicRead nên public ngay khi tồn tại, không cần gọi make_public riêng.
+GCS_DEDUP_ENABLED = os.getenv("GCS_DEDUP", "1") == "1"
+GCS_DEDUP_PREFIX = os.getenv("GCS_DEDUP_PREFIX", "history_redesign/content")
+GCS_DEDUP_INDEX_SIZE = int(os.getenv("GCS_DEDUP_INDEX_SIZE", "20000"))
+GCS_DEDUP_INDEX_TTL = int(os.getenv("GCS_DEDUP_INDEX_TTL", str(24 * 3600)))
+
+
+class ContentAddressedUploader:
+    """Upload ảnh lên GCS với tên object = sha256 nội dung; nội dung đã có thì trả URL sẵn có"""
+
+    def __init__(self, prefix, index_size, index_ttl, encoding_tag):
+        self.prefix = prefix
+        self.encoding_tag = encoding_tag  # ext -> chuỗi mô tả cách encode ra bytes được lưu
+        self._index = TTLCache(index_size, index_ttl)  # object name -> (public URL, size)
+        self._lock = threading.Lock()
+        self._stats = {"local_hits": 0, "remote_hits": 0, "uploads": 0, "races": 0, "lookup_errors": 0, "bytes_saved": 0}
+
+    def object_name(self, image, ext):
+        return f"{self.prefix}/{image.sha256}.{self.encoding_tag(ext)}.{ext}"
+
+    def _record(self, outcome, size=0):
+        with self._lock:
+            self._stats[outcome] += 1
+            if outcome != "uploads":
+                self._stats["bytes_saved"] += size
+        METRICS.inc("app_gcs_dedup_total", outcome=outcome)
+        if size and outcome != "uploads":
+            METRICS.inc("app_gcs_dedup_bytes_saved_total", size)
+
+    def lookup(self, image, ext):
+        """Public URL nếu nội dung đã có trên GCS, None nếu chưa (hoặc không kiểm tra được)"""
+        name = self.object_name(image, ext)
+        cached = self._index.get(name)
+        if cached:
+            self._record("local_hits", cached[1])
+            return cached[0]
+        try:
+            with timed("dedup_lookup"):
+                blob = PROVIDER_CLIENTS.gcs_bucket().get_blob(name)
+        except Exception as e:
+            # Dedup chỉ là tối ưu: lỗi kiểm tra coi như chưa có, upload (ifGenerationMatch=0) vẫn an toàn khi trùng
+            print(f"GCS dedup lookup failed, uploading: {e}")
+            self._record("lookup_errors")
+            return None
+        if blob is None:
+            return None
+        self._index.set(name, (blob.public_url, blob.size or 0))
+        self._record("remote_hits", blob.size or 0)
+        return blob.public_url
+
+    def upload(self, image, ext, data, content_type):
+        name = self.object_name(image, ext)
+        try:
+            blob = PROVIDER_CLIENTS.gcs_bucket().blob(name)
+            with timed("upload"):
+                blob.upload_from_string(data, content_type=content_type, predefined_acl="publicRead",
+                                        if_generation_match=0)
+            record_bytes("upload", len(data))
+            self._record("uploads")
+        except google_api_exceptions.PreconditionFailed:
+            # Request khác (worker khác) vừa ghi cùng nội dung
+            self._record("races", len(data))
+        except Exception as e:
+            print(f"Upload to GCS failed: {e}")
+            raise Exception(f"Upload to GCS failed: {str(e)}")
+        self._index.set(name, (blob.public_url, len(data)))
+        return blob.public_url
+
+    def store(self, image, encode, ext, content_type):
+        """encode(image) -> bytes chỉ chạy khi nội dung chưa có trên GCS"""
+        return self.lookup(image, ext) or self.upload(image, ext, encode(image), content_type)
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "index_entries": len(self._index)}
 
-def upload_to_gcs(local_file_path, destination_blob_name=None):
-    """Upload file lên GCS và trả về public URL"""
-    try:
-        # Tạo client
-        storage_client = storage.Client.from_service_account_json(GCS_CREDENTIALS_JSON)
-        bucket = storage_client.bucket(GCS_BUCKET_NAME)
 
-        # Luôn lưu vào folder 'history_redesign/'
-        filename = os.path.basename(local_file_path)
-        destination_blob_name = destination_blob_name or f"history_redesign/{filename}"
+METRICS.counter("app_gcs_dedup_total", "Kết quả upload theo nội dung (local_hits / remote_hits / uploads / races / lookup_errors)",
+                ("outcome",))
+METRICS.counter("app_gcs_dedup_bytes_saved_total", "Bytes không phải upload lại nhờ dedup theo nội dung")
 
-        # Tên file trên GCS
-        if not destination_blob_name:
-            destination_blob_name = os.path.basename(local_file_path)
+def _generated_encoding_tag(ext):
+    """Tham số quyết định bytes encode_generated_png tạo ra (xem encode_png)"""
+    return f"opt{int(GENERATED_PNG_OPTIMIZE)}-pil{Image.__version__}"
 
-        blob = bucket.blob(destination_blob_name)
-        blob.upload_from_filename(local_file_path)
 
-        # Thiết lập quyền public
-        blob.make_public()
-        os.remove(local_file_path)
-        return blob.public_url
-    except Exception as e:
-        print(f"Upload to GCS failed: {e}")
-        return None
+GCS_DEDUP_UPLOADER = ContentAddressedUploader(
+    GCS_DEDUP_PREFIX, GCS_DEDUP_INDEX_SIZE, GCS_DEDUP_INDEX_TTL, _generated_encoding_tag,
+) if GCS_DEDUP_ENABLED else None
+
+
+def encode_png(image_data):
+    """Bytes ảnh bất kỳ -> PNG (nền trắng cho ảnh trong suốt); giữ nguyên nếu đã là PNG không cần làm phẳng"""
+    # Image.open chỉ đọc header, chưa decode pixel
+    image = Image.open(io.BytesIO(image_data))
+    if image.format == 'PNG' and image.mode not in ('RGBA', 'P'):
+        return image_data
+    
+    # Chuyển sang RGB nếu cần
+    if image.mode in ('RGBA', 'P'):
+        # Tạo background trắng cho RGBA
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        if image.mode == 'RGBA':
+            background.paste(image, mask=image.split()[-1])
+        else:
+            background.paste(image)
+        image = background
+    
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG', optimize=GENERATED_PNG_OPTIMIZE)
+    return buffer.getvalue()
 
 
 def base64_to_image_file(b64_data, filename=None):
     """Chuyển base64 thành file ảnh và lưu local"""
+    return image_to_file(ImagePayload.from_base64(b64_data), filename)
+
+
+def image_to_file(image, filename=None):
+    """Encode ImagePayload thành PNG và lưu local"""
     try:
         # Tạo filename nếu không có
         if not filename:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            unique_id = str(uuid.uuid4())[:8]
-            filename = f"generated_{timestamp}_{unique_id}.png"
+            filename = _generated_filename()
         
         # Đường dẫn đầy đủ
         filepath = os.path.join(UPLOAD_FOLDER, filename)
         
-        # Decode base64
-        image_data = base64.b64decode(b64_data)
-        
-        # Mở và xử lý ảnh bằng PIL
-        image = Image.open(io.BytesIO(image_data))
-        
-        # Chuyển sang RGB nếu cần (để lưu JPEG)
-        if image.mode in ('RGBA', 'P'):
-            # Tạo background trắng cho RGBA
-            background = Image.new('RGB', image.size, (255, 255, 255))
-            if image.mode == 'RGBA':
-                background.paste(image, mask=image.split()[-1])
-            else:
-                background.paste(image)
-            image = background
-        
-        # Lưu ảnh
-        image.save(filepath, format='PNG', quality=95, optimize=True)
+        with open(filepath, 'wb') as f:
+            f.write(encode_png(image.data))
         
         print(f"Saved image to: {filepath}")
         return filepath
         
     except Exception as e:
-        print(f"Error saving base64 to file: {str(e)}")
+        print(f"Error saving image to file: {str(e)}")
         return None
 
+
+def store_generated_image(image):
+    """Chuyển ảnh (ImagePayload) thành PNG và upload lên GCS, trả về public URL, raise nếu lỗi"""
+    if GCS_SPOOL_TO_DISK:
+        local_path = image_to_file(image)
+        if not local_path:
+            raise Exception("Cannot save image to local spool")
+        public_url = upload_to_gcs(local_path)
+        if not public_url:
+            raise Exception("Upload to GCS failed")
+        return public_url
+
+    if GCS_DEDUP_UPLOADER:
+        return GCS_DEDUP_UPLOADER.store(image, encode_generated_png, "png", "image/png")
+    return upload_bytes_to_gcs(encode_generated_png(image))
+
+
+def encode_generated_png(image):
+    try:
+        with timed("encode"):
+            return encode_png(image.data)
+    except Exception as e:
+        raise Exception(f"Cannot encode generated image: {str(e)}")
+
+
+# Số ảnh được encode + upload song song (dùng chung cho mọi request trong worker)
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "8"))
+UPLOAD_EXECUTOR = ForkSafeExecutor(UPLOAD_CONCURRENCY, "upload")
+
+def store_generated_images(images):
+    """Encode + upload nhiều ảnh (ImagePayload) song song, giữ thứ tự; trả về (urls, errors theo index)"""
+    return _collect_uploads([UPLOAD_EXECUTOR.submit(store_generated_image, image) for image in images])
+
+def upload_image_bytes(image):
+    """Upload ảnh đã encode sẵn (vd PNG từ Imagen) nguyên bytes, không decode/encode lại"""
+    if GCS_DEDUP_UPLOADER:
+        return GCS_DEDUP_UPLOADER.store(image, lambda image: image.data, image.extension, image.mime_type)
+    return upload_bytes_to_gcs(image.data, f"history_redesign/{_generated_filename(image.extension)}",
+                               content_type=image.mime_type)
+
+def store_image_bytes(images):
+    """Upload song song list ImagePayload nguyên bytes, giữ thứ tự; trả về (urls, errors theo index)"""
+    return _collect_uploads([UPLOAD_EXECUTOR.submit(upload_image_bytes, image) for image in images])
+
+def images_from_response(response):
+    """ImagePayload từ response images.edit / images.generate (b64_json): decode 1 lần ở biên provider"""
+    return images_from_base64(response_b64_images(response))
+
+def response_b64_images(response):
+    return [img.b64_json for img in response.data if getattr(img, 'b64_json', None)]
+
+def images_from_base64(values):
+    return [ImagePayload.from_base64(value) for value in values]
+
+def _collect_uploads(futures):
+    public_urls = []
+    errors = []
+    for index, future in enumerate(futures):
+        try:
+            public_urls.append(future.result())
+        except Exception as e:
+            print(f"Image {index} failed: {e}")
+            errors.append({"index": index, "error": str(e)})
+    return public_urls, errors
+
+def _upload_result(public_urls, errors):
+    """Body + status cho các endpoint trả nhiều ảnh; chỉ báo lỗi 500 khi không ảnh nào thành công"""
+    body = {"urls": public_urls}
+    if errors:
+        body["errors"] = errors
+    if errors and not public_urls:
+        body["error"] = "All image uploads failed"
+        return body, 500
+    return body, 200
+
 def validate_image_url(url):
     """Kiểm tra URL ảnh có hợp lệ không"""
     try:
@@ -111,154 +1778,690 @@ def validate_image_url(url):
     except:
         return False
 
-def download_image(image_url):
-    """Download ảnh từ URL và trả về base64 string với nhiều phương pháp fallback"""
+# Cấu hình cache ảnh tham chiếu (memory LRU + disk)
+REF_CACHE_ENABLED = os.getenv("REF_CACHE_ENABLED", "1") == "1"
+REF_CACHE_DIR = os.getenv("REF_CACHE_DIR", "cache/reference_images")
+REF_CACHE_MEMORY_BYTES = int(os.getenv("REF_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024)))
+REF_CACHE_DISK_BYTES = int(os.getenv("REF_CACHE_DISK_BYTES", str(512 * 1024 * 1024)))
+REF_CACHE_TTL = int(os.getenv("REF_CACHE_TTL", "3600"))  # giây, quá hạn thì revalidate bằng ETag/Last-Modified
+
+
+class ReferenceImageCache:
+    """Cache 2 tầng cho ảnh tham chiếu đã chuẩn hóa (JPEG), key theo URL, nội dung lưu theo content hash"""
+
+    def __init__(self, directory, memory_bytes, disk_bytes, ttl):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # url -> entry
+        self._memory_size = 0
+        self._disk_size = None  # tính lazy khi ghi lần đầu
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "revalidated": 0, "misses": 0, "bytes_saved": 0}
+        self._index_dir = os.path.join(directory, "index")
+        self._blob_dir = os.path.join(directory, "blobs")
+        os.makedirs(self._index_dir, exist_ok=True)
+        os.makedirs(self._blob_dir, exist_ok=True)
+
+    @staticmethod
+    def _url_key(url):
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def _blob_path(self, content_hash):
+        return os.path.join(self._blob_dir, f"{content_hash}.jpg")
+
+    def _index_path(self, url):
+        return os.path.join(self._index_dir, f"{self._url_key(url)}.json")
+
+    def is_fresh(self, entry):
+        return time.time() - entry["fetched_at"] < self.ttl
+
+    # ---- Memory tier ----
+    def _memory_put(self, url, entry):
+        with self._lock:
+            old = self._memory.pop(url, None)
+            if old:
+                self._memory_size -= len(old["data"])
+            if len(entry["data"]) > self.memory_bytes:
+                return
+            self._memory[url] = entry
+            self._memory_size += len(entry["data"])
+            while self._memory_size > self.memory_bytes and self._memory:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_size -= len(evicted["data"])
+
+    def _memory_get(self, url):
+        with self._lock:
+            entry = self._memory.get(url)
+            if entry:
+                self._memory.move_to_end(url)
+            return entry
+
+    # ---- Disk tier ----
+    def _disk_get(self, url):
+        try:
+            with open(self._index_path(url), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            blob_path = self._blob_path(meta["content_hash"])
+            with open(blob_path, "rb") as f:
+                data = f.read()
+            os.utime(blob_path)  # đánh dấu vừa dùng để eviction theo LRU
+        except (OSError, ValueError, KeyError):
+            return None
+        return {**meta, "data": data}
+
+    def _write_atomic(self, path, payload):
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+
+    def _scan_disk_size(self):
+        # Tính cả file index theo URL, không chỉ blob
+        total = 0
+        for directory in (self._blob_dir, self._index_dir):
+            for entry in os.scandir(directory):
+                if entry.is_file():
+                    total += entry.stat().st_size
+        return total
+
+    def _disk_put(self, url, entry):
+        blob_path = self._blob_path(entry["content_hash"])
+        meta = {k: v for k, v in entry.items() if k != "data"}
+        try:
+            added = 0
+            if not os.path.exists(blob_path):
+                self._write_atomic(blob_path, entry["data"])
+                added = len(entry["data"])
+            index_path = self._index_path(url)
+            index_payload = json.dumps(meta).encode("utf-8")
+            try:
+                added -= os.path.getsize(index_path)  # ghi đè index cũ (refresh / nội dung mới)
+            except OSError:
+                pass
+            self._write_atomic(index_path, index_payload)
+            added += len(index_payload)
+            with self._lock:
+                if self._disk_size is None:
+                    self._disk_size = self._scan_disk_size()
+                else:
+                    self._disk_size += added
+                over = self._disk_size > self.disk_bytes
+            if over:
+                self._evict_disk()
+        except OSError as e:
+            print(f"Reference cache disk write failed: {e}")
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            return size
+        except OSError:
+            return 0
+
+    def _evict_disk(self):
+        """Xóa blob dùng lâu nhất (kèm các index trỏ tới nó) cho tới khi về dưới ~90% dung lượng cho phép;
+        index trỏ tới blob không còn (hỏng / bị xóa) cũng được dọn"""
+        blobs = {}
+        for entry in os.scandir(self._blob_dir):
+            if entry.is_file() and entry.name.endswith(".jpg"):
+                st = entry.stat()
+                blobs[entry.name[:-len(".jpg")]] = (st.st_mtime, st.st_size, entry.path)
+        total = sum(size for _, size, _ in blobs.values())
+        indexes = {}  # content_hash -> [đường dẫn index]
+        for entry in os.scandir(self._index_dir):
+            if not (entry.is_file() and entry.name.endswith(".json")):
+                continue
+            try:
+                with open(entry.path, "r", encoding="utf-8") as f:
+                    content_hash = json.load(f)["content_hash"]
+            except (OSError, ValueError, KeyError, TypeError):
+                content_hash = None
+            if content_hash not in blobs:
+                self._remove(entry.path)
+                continue
+            indexes.setdefault(content_hash, []).append(entry.path)
+            total += entry.stat().st_size
+        target = int(self.disk_bytes * 0.9)
+        for content_hash, (_, size, path) in sorted(blobs.items(), key=lambda item: item[1]):
+            if total <= target:
+                break
+            for index_path in indexes.get(content_hash, ()):
+                total -= self._remove(index_path)
+            total -= self._remove(path)
+        with self._lock:
+            self._disk_size = total
+
+    # ---- API ----
+    def get(self, url):
+        entry = self._memory_get(url)
+        if entry:
+            return entry, "memory"
+        entry = self._disk_get(url)
+        if entry:
+            self._memory_put(url, entry)
+            return entry, "disk"
+        return None, None
+
+    def put(self, url, data, etag=None, last_modified=None, source_size=0):
+        entry = {
+            "url": url,
+            "data": data,
+            "content_hash": hashlib.sha256(data).hexdigest(),
+            "etag": etag,
+            "last_modified": last_modified,
+            "source_size": source_size,
+            "fetched_at": time.time(),
+        }
+        self._memory_put(url, entry)
+        self._disk_put(url, entry)
+        return entry
+
+    def refresh(self, url, entry):
+        """Server trả 304: giữ nội dung cũ, gia hạn thời điểm fetch"""
+        entry = {**entry, "fetched_at": time.time()}
+        self._memory_put(url, entry)
+        self._disk_put(url, entry)
+        return entry
+
+    def record(self, outcome, bytes_saved=0):
+        with self._lock:
+            self._stats[outcome] += 1
+            self._stats["bytes_saved"] += bytes_saved
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._memory)
+            stats["memory_bytes"] = self._memory_size
+            stats["disk_bytes"] = self._disk_size
+        hits = stats["memory_hits"] + stats["disk_hits"] + stats["revalidated"]
+        total = hits + stats["misses"]
+        stats["hit_ratio"] = round(hits / total, 4) if total else 0.0
+        return stats
+
+
+REFERENCE_IMAGE_CACHE = ReferenceImageCache(
+    REF_CACHE_DIR,
+    memory_bytes=REF_CACHE_MEMORY_BYTES,
+    disk_bytes=REF_CACHE_DISK_BYTES,
+    ttl=REF_CACHE_TTL,
+) if REF_CACHE_ENABLED else None
+
+
+# Giới hạn khi tải ảnh tham chiếu
+DOWNLOAD_MAX_BYTES = int(os.getenv("DOWNLOAD_MAX_BYTES", str(25 * 1024 * 1024)))
+DOWNLOAD_MIN_BYTES = int(os.getenv("DOWNLOAD_MIN_BYTES", "1024"))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Content-Type chắc chắn không phải ảnh (trang lỗi, trang login, API lỗi...)
+NON_IMAGE_CONTENT_TYPES = ('text/', 'application/json', 'application/xml', 'application/xhtml')
+
+
+# Deadline tổng cho 1 lần tải ảnh, tính trên mọi method và mọi lần thử
+DOWNLOAD_DEADLINE = float(os.getenv("DOWNLOAD_DEADLINE", "90"))
+# Ghi nhớ method tải thành công theo host để lần sau thử method đó trước
+DOWNLOAD_HOST_MEMORY_SIZE = int(os.getenv("DOWNLOAD_HOST_MEMORY_SIZE", "1024"))
+DOWNLOAD_HOST_MEMORY_TTL = int(os.getenv("DOWNLOAD_HOST_MEMORY_TTL", str(6 * 3600)))
+DOWNLOAD_HOST_STRATEGY = TTLCache(DOWNLOAD_HOST_MEMORY_SIZE, DOWNLOAD_HOST_MEMORY_TTL)
+
+
+class ImageTooLargeError(Exception):
+    pass
+
+
+class DownloadDeadlineExceeded(Exception):
+    pass
+
+
+def sniff_image_format(head):
+    """Nhận dạng ảnh qua magic bytes, trả về tên format hoặc None"""
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if head.startswith((b'GIF87a', b'GIF89a')):
+        return 'gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    if head.startswith(b'BM'):
+        return 'bmp'
+    return None
+
+
+class ImagePayload:
+    """Ảnh trong memory đi xuyên pipeline (download -> phân tích -> provider -> upload): giữ 1 bản bytes,
+    format, kích thước, sha256; base64 / data URL chỉ được tạo (1 lần) ở chỗ provider cần."""
+
+    __slots__ = ("data", "format", "_size", "_sha256", "_b64")
+
+    def __init__(self, data, format=None, size=None):
+        self.data = data
+        self.format = format or sniff_image_format(data[:16]) or "png"
+        self._size = size
+        self._sha256 = None
+        self._b64 = None
+
+    @classmethod
+    def from_base64(cls, value):
+        """Từ base64 thuần hoặc data URL"""
+        payload = cls(base64.b64decode(value.rpartition(",")[2]))
+        if "," not in value:
+            payload._b64 = value  # base64 gốc dùng lại được nếu provider cần
+        return payload
+
+    @property
+    def mime_type(self):
+        return f"image/{self.format}"
+
+    @property
+    def extension(self):
+        return "jpg" if self.format == "jpeg" else self.format
+
+    @property
+    def size(self):
+        """(width, height), đọc từ header khi cần (không decode pixel)"""
+        if self._size is None:
+            self._size = Image.open(io.BytesIO(self.data)).size
+        return self._size
+
+    @property
+    def sha256(self):
+        if self._sha256 is None:
+            self._sha256 = hashlib.sha256(self.data).hexdigest()
+        return self._sha256
+
+    def b64(self):
+        if self._b64 is None:
+            self._b64 = base64.b64encode(self.data).decode("ascii")
+        return self._b64
+
+    def data_url(self):
+        return f"data:{self.mime_type};base64,{self.b64()}"
+
+    def as_file(self, name="image"):
+        """Tuple (filename, bytes, mime) cho upload multipart của SDK / requests; gửi lại được khi retry"""
+        return (f"{name}.{self.extension}", self.data, self.mime_type)
+
+    def __len__(self):
+        return len(self.data)
+
+class ImageBodyReader:
+    """Gom body ảnh theo từng chunk vào buffer cấp phát trước; kiểm tra header, magic bytes, dung lượng và deadline.
+    Dùng chung cho requests (sync) và httpx (async)."""
+
+    def __init__(self, headers, max_bytes=None, deadline=None):
+        self.max_bytes = max_bytes or DOWNLOAD_MAX_BYTES
+        self.deadline = deadline
+        
+        # Kiểm tra content type
+        content_type = headers.get('content-type', '').lower()
+        print(f"Content-Type: {content_type}")
+        if content_type.startswith(NON_IMAGE_CONTENT_TYPES):
+            raise Exception(f"Response is not an image (Content-Type: {content_type})")
+        
+        # Content-Length chỉ đúng với kích thước thật khi không bị nén
+        expected = None
+        content_length = headers.get('content-length')
+        if content_length and content_length.isdigit() and not headers.get('content-encoding'):
+            expected = int(content_length)
+            if expected > self.max_bytes:
+                raise ImageTooLargeError(f"Image too large: {expected} bytes (limit {self.max_bytes})")
+        
+        self.buffer = bytearray(expected if expected else DOWNLOAD_CHUNK_SIZE)
+        self.size = 0
+        self.sniffed = False
+
+    def feed(self, chunk):
+        end = self.size + len(chunk)
+        if end > self.max_bytes:
+            raise ImageTooLargeError(f"Image exceeds {self.max_bytes} bytes, download aborted")
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise DownloadDeadlineExceeded(f"Download deadline exceeded after {self.size} bytes")
+        if end > len(self.buffer):
+            self.buffer.extend(bytes(max(end, len(self.buffer) * 2) - len(self.buffer)))
+        self.buffer[self.size:end] = chunk
+        self.size = end
+        
+        # Kiểm tra magic bytes ngay khi có đủ 12 byte đầu
+        if not self.sniffed and self.size >= 12:
+            if not sniff_image_format(bytes(self.buffer[:12])):
+                raise Exception("Response body is not a supported image (JPEG/PNG/GIF/WebP/BMP)")
+            self.sniffed = True
+
+    def finish(self):
+        if not self.sniffed and not sniff_image_format(bytes(self.buffer[:self.size])):
+            raise Exception("Response body is not a supported image (JPEG/PNG/GIF/WebP/BMP)")
+        return bytes(memoryview(self.buffer)[:self.size])
+
+
+def _read_image_body(response, max_bytes=None, deadline=None):
+    """Đọc body dạng stream của requests qua ImageBodyReader"""
+    reader = ImageBodyReader(response.headers, max_bytes=max_bytes, deadline=deadline)
     
-    # Danh sách các phương pháp download khác nhau
-    methods = [
-        # Method 1: Standard request with longer timeout
-        {
-            'timeout': 60,
-            'verify': True,
-            'stream': True,
-            'allow_redirects': True,
-            'headers': {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                'Accept': 'image/webp,image/apng,image/*,*/*;q=0.8',
-                'Accept-Language': 'en-US,en;q=0.9',
-                'Accept-Encoding': 'gzip, deflate, br',
-                'Connection': 'keep-alive',
-                'Upgrade-Insecure-Requests': '1',
-            }
-        },
-        # Method 2: Disable SSL verification
-        {
-            'timeout': 60,
-            'verify': False,
-            'stream': True,
-            'allow_redirects': True,
-            'headers': {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-                'Accept': 'image/*,*/*;q=0.8',
-            }
-        },
-        # Method 3: Simple request without stream
-        {
-            'timeout': 90,
-            'verify': False,
-            'stream': False,
-            'allow_redirects': True,
-            'headers': {
-                'User-Agent': 'Python-requests/2.31.0',
-                'Accept': '*/*',
-            }
-        },
-        # Method 4: Minimal headers
-        {
-            'timeout': 120,
-            'verify': False,
-            'stream': False,
-            'allow_redirects': True,
-            'headers': {}
+    # read1 trả về ngay phần dữ liệu đã có (không đợi đủ chunk) để kiểm tra deadline sát hơn
+    raw = getattr(response, 'raw', None)
+    if hasattr(raw, 'read1'):
+        chunks = iter(lambda: raw.read1(DOWNLOAD_CHUNK_SIZE, decode_content=True), b'')
+    else:
+        chunks = response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE)
+    
+    for chunk in chunks:
+        reader.feed(chunk)
+    return reader.finish()
+
+# Danh sách các phương pháp download khác nhau
+DOWNLOAD_METHODS = [
+    # Method 1: Standard request with longer timeout
+    {
+        'timeout': 60,
+        'verify': True,
+        'allow_redirects': True,
+        'headers': {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+            'Accept': 'image/webp,image/apng,image/*,*/*;q=0.8',
+            'Accept-Language': 'en-US,en;q=0.9',
+            'Accept-Encoding': 'gzip, deflate, br',
+            'Connection': 'keep-alive',
+            'Upgrade-Insecure-Requests': '1',
         }
-    ]
+    },
+    # Method 2: Disable SSL verification
+    {
+        'timeout': 60,
+        'verify': False,
+        'allow_redirects': True,
+        'headers': {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+            'Accept': 'image/*,*/*;q=0.8',
+        }
+    },
+    # Method 3: Simple request with generic headers
+    {
+        'timeout': 90,
+        'verify': False,
+        'allow_redirects': True,
+        'headers': {
+            'User-Agent': 'Python-requests/2.31.0',
+            'Accept': '*/*',
+        }
+    },
+    # Method 4: Minimal headers
+    {
+        'timeout': 120,
+        'verify': False,
+        'allow_redirects': True,
+        'headers': {}
+    }
+]
+
+def _retry_after_seconds(response):
+    """Đọc header Retry-After dạng số giây (bỏ qua dạng ngày giờ)"""
+    value = response.headers.get('Retry-After', '') if response is not None else ''
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+def _fetch_image_bytes(image_url, extra_headers=None, deadline_seconds=None):
+    """Tải bytes ảnh gốc với nhiều phương pháp fallback trong 1 deadline chung, trả về (status_code, bytes, headers)"""
+    deadline = time.monotonic() + (deadline_seconds or DOWNLOAD_DEADLINE)
+    host = urlparse(image_url).netloc.lower()
+    
+    methods = DOWNLOAD_METHODS
     
     last_error = None
     
-    for i, method in enumerate(methods, 1):
+    # Host đã biết method nào chạy được -> thử method đó trước
+    order = list(range(1, len(methods) + 1))
+    preferred = DOWNLOAD_HOST_STRATEGY.get(host)
+    if preferred in order:
+        order.remove(preferred)
+        order.insert(0, preferred)
+    
+    for attempt, i in enumerate(order):
+        method = methods[i - 1]
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            last_error = f"deadline of {deadline_seconds or DOWNLOAD_DEADLINE}s exceeded"
+            break
         try:
             print(f"Trying download method {i}/{len(methods)}...")
             
-            # Tạo session mới cho mỗi method
-            session = requests.Session()
-            
-            # Cài đặt timeout cho adapter
-            from requests.adapters import HTTPAdapter
-            from urllib3.util.retry import Retry
-            
-            retry_strategy = Retry(
-                total=3,
-                backoff_factor=1,
-                status_forcelist=[429, 500, 502, 503, 504],
-            )
-            
-            adapter = HTTPAdapter(max_retries=retry_strategy)
-            session.mount("http://", adapter)
-            session.mount("https://", adapter)
-            
-            # Cập nhật headers
-            session.headers.update(method['headers'])
+            # Dùng session chung để giữ keep-alive giữa các request
+            session = HTTP_POOL.session("image")
             
             # Thực hiện request
+            headers = dict(method['headers'])
+            headers.update(extra_headers or {})
             response = session.get(
                 image_url,
-                timeout=method['timeout'],
+                headers=headers,
+                timeout=min(method['timeout'], remaining),
                 verify=method['verify'],
-                stream=method['stream'],
+                stream=True,
                 allow_redirects=method['allow_redirects']
             )
             
-            response.raise_for_status()
-            
-            # Kiểm tra content type
-            content_type = response.headers.get('content-type', '').lower()
-            print(f"Content-Type: {content_type}")
-            
-            # Đọc dữ liệu ảnh
-            image_data = response.content
-            print(f"Downloaded {len(image_data)} bytes")
-            
-            if len(image_data) < 1024:  # Nhỏ hơn 1KB có thể là lỗi
-                raise Exception("Downloaded file too small, might be an error page")
-            
-            # Mở ảnh bằng PIL để xác thực
-            try:
-                image = Image.open(io.BytesIO(image_data))
-                print(f"Image opened successfully: {image.size}, mode: {image.mode}")
+            with response:
+                response.raise_for_status()
                 
-                # Chuyển về RGB nếu cần
-                if image.mode != 'RGB':
-                    if image.mode == 'RGBA':
-                        background = Image.new('RGB', image.size, (255, 255, 255))
-                        background.paste(image, mask=image.split()[-1])
-                        image = background
-                    else:
-                        image = image.convert('RGB')
+                # Ảnh không đổi so với bản trong cache
+                if response.status_code == 304:
+                    print("Not modified (304), using cached image")
+                    DOWNLOAD_HOST_STRATEGY.set(host, i)
+                    return 304, b"", response.headers
                 
-                # Resize nếu ảnh quá lớn (để tránh lỗi với OpenAI API)
-                max_size = 2048
-                if image.size[0] > max_size or image.size[1] > max_size:
-                    image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
-                    print(f"Image resized to: {image.size}")
+                # Đọc dữ liệu ảnh (dừng sớm nếu không phải ảnh, quá lớn hoặc hết deadline)
+                image_data = _read_image_body(response, deadline=deadline)
+                print(f"Downloaded {len(image_data)} bytes")
                 
-                # Lưu lại thành bytes
-                img_byte_arr = io.BytesIO()
-                image.save(img_byte_arr, format='JPEG', quality=85, optimize=True)
-                img_byte_arr.seek(0)
+                if len(image_data) < DOWNLOAD_MIN_BYTES:  # Nhỏ hơn 1KB có thể là lỗi
+                    raise Exception("Downloaded file too small, might be an error page")
                 
-                # Chuyển thành base64
-                base64_string = base64.b64encode(img_byte_arr.getvalue()).decode('utf-8')
-                print(f"Base64 string length: {len(base64_string)}")
-                
-                return f"data:image/jpeg;base64,{base64_string}"
-                
-            except Exception as e:
-                raise Exception(f"Cannot process image with PIL: {str(e)}")
+                DOWNLOAD_HOST_STRATEGY.set(host, i)
+                METRICS.inc("app_download_attempts_total", method=str(i), outcome="ok")
+                record_bytes("download", len(image_data))
+                return response.status_code, image_data, response.headers
                 
+        except (ImageTooLargeError, DownloadDeadlineExceeded) as e:
+            # Method khác cũng tải về cùng file / không còn thời gian -> không thử tiếp
+            METRICS.inc("app_download_attempts_total", method=str(i), outcome=type(e).__name__)
+            DOWNLOAD_HOST_STRATEGY.pop(host)
+            raise
         except Exception as e:
+            METRICS.inc("app_download_attempts_total", method=str(i), outcome=type(e).__name__)
             last_error = str(e)
             print(f"Method {i} failed: {last_error}")
+            
+            # Lỗi tạm thời (429/5xx/mạng): chờ backoff trước method tiếp theo, không vượt deadline
+            # (lỗi SSL thì chuyển ngay sang method không verify)
+            response = getattr(e, 'response', None)
+            status = response.status_code if response is not None else None
+            transient = status in HTTP_RETRY_STATUSES or (
+                isinstance(e, (requests.ConnectionError, requests.Timeout))
+                and not isinstance(e, requests.exceptions.SSLError)
+            )
+            if transient and attempt + 1 < len(order):
+                wait = _retry_after_seconds(response)
+                if wait is None:
+                    wait = HTTP_RETRY_BACKOFF * (2 ** attempt)
+                wait = min(wait, deadline - time.monotonic())
+                if wait > 0:
+                    time.sleep(wait)
             continue
     
     # Nếu tất cả methods đều thất bại
+    DOWNLOAD_HOST_STRATEGY.pop(host)
     raise Exception(f"All download methods failed. Last error: {last_error}")
 
-def describe_image_with_gpt4o_2D(base64_image):
-    """Sử dụng GPT-4o để mô tả ảnh chi tiết"""
-    client = openai.OpenAI(api_key=OPENAI_API_KEY)
-    
+# Cấu hình chuẩn hóa ảnh tham chiếu
+REF_IMAGE_MAX_SIZE = int(os.getenv("REF_IMAGE_MAX_SIZE", "2048"))  # cạnh dài tối đa (giới hạn của OpenAI)
+REF_IMAGE_JPEG_QUALITY = int(os.getenv("REF_IMAGE_JPEG_QUALITY", "85"))
+REF_IMAGE_JPEG_OPTIMIZE = os.getenv("REF_IMAGE_JPEG_OPTIMIZE", "1") == "1"
+# Bước reduce() rẻ trước LANCZOS: ảnh được thu nhỏ nguyên lần tới còn >= reducing_gap lần kích thước đích
+REF_IMAGE_REDUCING_GAP = float(os.getenv("REF_IMAGE_REDUCING_GAP", "2.0"))
+# Cho phép JPEG decode thẳng ra ảnh nhỏ hơn cạnh tối đa một chút (>= 90%) để bỏ hẳn bước LANCZOS
+REF_IMAGE_DRAFT_MIN_SCALE = float(os.getenv("REF_IMAGE_DRAFT_MIN_SCALE", "0.9"))
+# JPEG RGB đã đủ nhỏ thì giữ nguyên bytes, không decode/encode lại
+REF_IMAGE_PASSTHROUGH = os.getenv("REF_IMAGE_PASSTHROUGH", "1") == "1"
+REF_IMAGE_PASSTHROUGH_MAX_BYTES = int(os.getenv("REF_IMAGE_PASSTHROUGH_MAX_BYTES", str(2 * 1024 * 1024)))
+
+EXIF_ORIENTATION_TAG = 0x0112
+
+def _fit_size(size, max_size):
+    """Kích thước sau khi thu nhỏ giữ tỉ lệ để cạnh dài <= max_size"""
+    width, height = size
+    scale = min(max_size / width, max_size / height, 1.0)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def _normalize_reference_image(image_data):
+    """Chuẩn hóa ảnh tham chiếu: RGB, tối đa REF_IMAGE_MAX_SIZE px, JPEG"""
     try:
-        analysis_prompt = """'**Role:**
+        # Image.open chỉ đọc header, pixel chưa được decode
+        image = Image.open(io.BytesIO(image_data))
+        print(f"Image opened successfully: {image.size}, mode: {image.mode}")
+        
+        max_size = REF_IMAGE_MAX_SIZE
+        fits = image.size[0] <= max_size and image.size[1] <= max_size
+        
+        # Fast path: JPEG RGB đủ nhỏ, không cần xoay theo EXIF -> trả nguyên bytes
+        if (
+            REF_IMAGE_PASSTHROUGH
+            and fits
+            and image.format == 'JPEG'
+            and image.mode == 'RGB'
+            and len(image_data) <= REF_IMAGE_PASSTHROUGH_MAX_BYTES
+            and image.getexif().get(EXIF_ORIENTATION_TAG, 1) == 1
+        ):
+            print("Image already normalized, passthrough")
+            return image_data
+        
+        # JPEG lớn: decoder thu nhỏ 1/2, 1/4, 1/8 ngay khi decode (DCT scaling)
+        if not fits and image.format == 'JPEG':
+            image.draft('RGB', _fit_size(image.size, int(max_size * REF_IMAGE_DRAFT_MIN_SCALE)))
+            print(f"JPEG draft decode at: {image.size}")
+        
+        # Chuyển về RGB nếu cần (RGBA được làm phẳng sau khi resize cho rẻ hơn)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGB')
+        
+        # Resize nếu ảnh quá lớn (để tránh lỗi với OpenAI API)
+        if image.size[0] > max_size or image.size[1] > max_size:
+            image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS, reducing_gap=REF_IMAGE_REDUCING_GAP)
+            print(f"Image resized to: {image.size}")
+        
+        if image.mode == 'RGBA':
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.split()[-1])
+            image = background
+        
+        # Lưu lại thành bytes
+        img_byte_arr = io.BytesIO()
+        image.save(img_byte_arr, format='JPEG', quality=REF_IMAGE_JPEG_QUALITY, optimize=REF_IMAGE_JPEG_OPTIMIZE)
+        return img_byte_arr.getvalue()
+        
+    except Exception as e:
+        raise Exception(f"Cannot process image with PIL: {str(e)}")
+
+def download_image(image_url):
+    """Download ảnh từ URL, trả về ImagePayload JPEG đã chuẩn hóa, dùng cache nếu ảnh đã được tải trước đó"""
+    return ImagePayload(download_image_bytes(image_url), "jpeg")
+
+def download_image_bytes(image_url, deadline_seconds=None):
+    """Download + chuẩn hóa ảnh từ URL, trả về JPEG bytes (qua cache); request trùng URL dùng chung 1 lần tải"""
+    return DOWNLOAD_FLIGHT.do(
+        image_url, _download_image_bytes, image_url, deadline_seconds,
+        wait_timeout=deadline_seconds or DOWNLOAD_DEADLINE,
+    )
+
+def _download_image_bytes(image_url, deadline_seconds=None):
+    cache = REFERENCE_IMAGE_CACHE
+    cached, tier = cache.get(image_url) if cache else (None, None)
+
+    if cached and cache.is_fresh(cached):
+        print(f"Reference cache hit ({tier}): {image_url}")
+        cache.record(f"{tier}_hits", cached["source_size"])
+        return cached["data"]
+
+    # Bản cache đã cũ: revalidate bằng conditional request
+    conditional = {}
+    if cached:
+        if cached.get("etag"):
+            conditional["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            conditional["If-Modified-Since"] = cached["last_modified"]
+
+    with timed("download"):
+        status, image_data, headers = _fetch_image_bytes(image_url, conditional, deadline_seconds)
+    if status == 304 and cached:
+        cache.refresh(image_url, cached)
+        cache.record("revalidated", cached["source_size"])
+        return cached["data"]
+
+    with timed("normalize"):
+        jpeg_bytes = _normalize_reference_image(image_data)
+    record_bytes("normalize", len(jpeg_bytes))
+    if cache:
+        cache.record("misses")
+        cache.put(
+            image_url,
+            jpeg_bytes,
+            etag=headers.get("ETag"),
+            last_modified=headers.get("Last-Modified"),
+            source_size=len(image_data),
+        )
+    return jpeg_bytes
+
+# Tải ảnh tham chiếu cho Ideogram / Gemini
+MAX_REFERENCE_IMAGES = 3
+REFERENCE_FETCH_DEADLINE = float(os.getenv("REFERENCE_FETCH_DEADLINE", "60"))
+REFERENCE_FETCH_CONCURRENCY = int(os.getenv("REFERENCE_FETCH_CONCURRENCY", "6"))
+REFERENCE_EXECUTOR = ForkSafeExecutor(REFERENCE_FETCH_CONCURRENCY, "reference")
+
+
+class ReferenceFetchError(Exception):
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__(f"Cannot fetch {len(errors)} image reference(s)")
+
+
+def fetch_reference_images(urls, limit=MAX_REFERENCE_IMAGES, deadline_seconds=None):
+    """Tải song song tối đa `limit` ảnh tham chiếu trong 1 deadline chung, trả về list JPEG bytes theo thứ tự URL"""
+    urls = list(urls)[:limit]
+    deadline_seconds = deadline_seconds or REFERENCE_FETCH_DEADLINE
+    deadline = time.monotonic() + deadline_seconds
+
+    futures = []
+    errors = []
+    for index, url in enumerate(urls):
+        parsed = urlparse(url) if isinstance(url, str) else None
+        if not parsed or parsed.scheme not in ("http", "https") or not parsed.netloc:
+            errors.append({"index": index, "url": url, "error": "Invalid image URL"})
+            futures.append(None)
+            continue
+        futures.append(REFERENCE_EXECUTOR.submit(download_image_bytes, url, deadline_seconds))
+
+    results = []
+    for index, future in enumerate(futures):
+        if future is None:
+            continue
+        try:
+            results.append(future.result(timeout=max(0.0, deadline - time.monotonic())))
+        except FuturesTimeoutError:
+            future.cancel()
+            errors.append({"index": index, "url": urls[index], "error": f"deadline of {deadline_seconds}s exceeded"})
+        except Exception as e:
+            errors.append({"index": index, "url": urls[index], "error": str(e)})
+
+    if errors:
+        raise ReferenceFetchError(sorted(errors, key=lambda item: item["index"]))
+    return results
+
+# Prompt phân tích ảnh cho GPT-4o (dùng chung cho chế độ sync và async)
+ANALYSIS_PROMPT_2D = """'**Role:**
 You are a professional AI visual designer with expertise in design analysis and prompt engineering for high-fidelity image generation.
 
 **Task:**
@@ -310,38 +2513,8 @@ Analyze the given image and generate a detailed visual analysis followed by a co
 - ONLY describe what IS in the image, not what COULD BE
 - Focus on complete visual fidelity to the design elements only
 """
-        
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text", 
-                            "text": analysis_prompt
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {"url": base64_image}
-                        }
-                    ]
-                }
-            ],
-            max_tokens=800
-        )
-        
-        return response.choices[0].message.content
-        
-    except Exception as e:
-        raise Exception(f"Cannot analyze image with GPT-4o: {str(e)}")
 
-def describe_image_with_gpt4o_3D(base64_image):
-    """Sử dụng GPT-4o để mô tả ảnh chi tiết"""
-    client = openai.OpenAI(api_key=OPENAI_API_KEY)
-    
-    try:
-        analysis_prompt = """'**Role:**
+ANALYSIS_PROMPT_3D = """'**Role:**
 You are a professional AI visual designer with expertise in 3D design analysis and prompt engineering for high-fidelity, three-dimensional image generation.
 **Task:**
 Analyze the given image and generate a detailed 3D visual analysis followed by a complete prompt that can recreate the design with accurate three-dimensional depth, lighting, and perspective, exactly as it appears.
@@ -387,38 +2560,8 @@ Required Response Format:
 - ONLY describe what IS in the image, not what COULD BE
 - Highlight 3D depth, realistic lighting, shadows, and perspective
 """
-        
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text", 
-                            "text": analysis_prompt
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {"url": base64_image}
-                        }
-                    ]
-                }
-            ],
-            max_tokens=800
-        )
-        
-        return response.choices[0].message.content
-        
-    except Exception as e:
-        raise Exception(f"Cannot analyze image with GPT-4o: {str(e)}")
-    
-def generate_dalle_prompt(image_description):
-    """Sử dụng GPT-4o để tạo prompt tối ưu cho DALL-E"""
-    client = openai.OpenAI(api_key=OPENAI_API_KEY)
-    
-    try:
-        prompt_generation_request = f"""Dựa trên mô tả ảnh này, hãy tạo một prompt tối ưu cho DALL-E để vẽ lại ảnh giống y hệt:
+
+DALLE_PROMPT_TEMPLATE = """Dựa trên mô tả ảnh này, hãy tạo một prompt tối ưu cho DALL-E để vẽ lại ảnh giống y hệt:
 
 Mô tả ảnh: {image_description}
 
@@ -430,23 +2573,345 @@ Yêu cầu tạo prompt:
 - Format: detailed description, art style, quality modifiers
 
 Chỉ trả về prompt, không giải thích."""
+
+def build_dalle_prompt_request(image_description):
+    return DALLE_PROMPT_TEMPLATE.format(image_description=image_description)
+
+# === Chuẩn bị ảnh cho GPT-4o vision ===
+# legacy: gửi nguyên JPEG đã chuẩn hóa (tới 2048px), không kèm detail
+# high: resize sẵn về đúng kích thước model sẽ dùng (vừa 2048, cạnh ngắn 768) rồi căn theo tile 512px, detail=high
+# low: ảnh <= 512px, detail=low (85 token cố định, đủ cho bố cục nhưng đọc chữ nhỏ kém)
+VISION_MODES = ("legacy", "high", "low")
+VISION_PREP_MODE = os.getenv("VISION_PREP_MODE", "high")
+VISION_TILE_SIZE = 512
+VISION_HIGH_MAX_SIZE = 2048
+VISION_HIGH_SHORT_SIDE = 768
+# Cho phép thu nhỏ thêm tới 15% nếu nhờ đó bớt được 1 hàng/cột tile (mỗi tile 170 token)
+VISION_TILE_SNAP = float(os.getenv("VISION_TILE_SNAP", "0.85"))
+VISION_JPEG_QUALITY = int(os.getenv("VISION_JPEG_QUALITY", "85"))
+
+METRICS.histogram("app_openai_call_duration_seconds", "Thời gian gọi OpenAI chat theo loại lời gọi và vision mode", ("call", "mode"))
+METRICS.counter("app_openai_tokens_total", "Token OpenAI theo loại (prompt / cached / completion)", ("call", "mode", "kind"))
+METRICS.counter("app_vision_image_bytes_total", "Bytes ảnh gửi cho GPT-4o vision", ("mode",))
+# So với app_openai_tokens_total{kind="prompt"} để thấy phần token do ảnh và kiểm tra cách chọn kích thước theo tile
+METRICS.counter("app_vision_image_tokens_estimated_total", "Token ảnh ước tính (theo tile) gửi cho GPT-4o vision", ("mode",))
+
+
+def vision_tokens(width, height, detail):
+    """Số token ảnh ước tính theo cách tính của GPT-4o: 85 + 170 mỗi tile 512px (detail=low: 85)"""
+    if detail == "low":
+        return 85
+    return 85 + 170 * math.ceil(width / VISION_TILE_SIZE) * math.ceil(height / VISION_TILE_SIZE)
+
+
+def _vision_high_size(width, height):
+    """Kích thước model tự resize về với detail=high: vừa 2048px, cạnh ngắn tối đa 768px"""
+    width, height = _fit_size((width, height), VISION_HIGH_MAX_SIZE)
+    short_side = min(width, height)
+    if short_side > VISION_HIGH_SHORT_SIDE:
+        scale = VISION_HIGH_SHORT_SIDE / short_side
+        width, height = max(1, round(width * scale)), max(1, round(height * scale))
+    return width, height
+
+
+def vision_target_size(width, height, mode):
+    if mode == "low":
+        return _fit_size((width, height), VISION_TILE_SIZE)
+
+    width, height = _vision_high_size(width, height)
+
+    # Cạnh vừa vượt bội số 512 một chút -> thu nhỏ về đúng biên tile
+    best = None
+    for side in (width, height):
+        tiles = math.ceil(side / VISION_TILE_SIZE)
+        if tiles > 1:
+            scale = (tiles - 1) * VISION_TILE_SIZE / side
+            if scale >= VISION_TILE_SNAP and (best is None or scale > best):
+                best = scale
+    if best:
+        width, height = max(1, int(width * best)), max(1, int(height * best))
+    return width, height
+
+
+def prepare_vision_image(image, mode=None):
+    """ImagePayload -> (ImagePayload gửi cho model, detail, info) theo vision mode; chỉ encode lại khi kích thước thay đổi"""
+    mode = mode or VISION_PREP_MODE
+    detail = None if mode == "legacy" else mode
+    target = image.size if mode == "legacy" else vision_target_size(*image.size, mode)
+
+    if target != image.size:
+        pil_image = Image.open(io.BytesIO(image.data))
+        if pil_image.format == 'JPEG':
+            pil_image.draft('RGB', target)
+        if pil_image.mode != 'RGB':
+            pil_image = pil_image.convert('RGB')
+        pil_image = pil_image.resize(target, Image.Resampling.LANCZOS, reducing_gap=REF_IMAGE_REDUCING_GAP)
+        buffer = io.BytesIO()
+        pil_image.save(buffer, format='JPEG', quality=VISION_JPEG_QUALITY)
+        image = ImagePayload(buffer.getvalue(), "jpeg", target)
+
+    info = {
+        "mode": mode,
+        "size": target,
+        "bytes": len(image),
+        # legacy không gửi detail -> model tự chọn, thường là high
+        "estimated_tokens": vision_tokens(*_vision_high_size(*target), detail or "high"),
+    }
+    return image, detail, info
+
+
+def vision_image_part(image, mode=None):
+    """Content part image_url (data URL tạo ở đây, ngay trước khi gửi) cho chat completions + info để ghi metrics"""
+    prepared, detail, info = prepare_vision_image(image, mode)
+    image_url = {"url": prepared.data_url()}
+    if detail:
+        image_url["detail"] = detail
+    return {"type": "image_url", "image_url": image_url}, info
+
+
+def record_vision_image(info):
+    """Ghi bytes + token ước tính của ảnh vision (info từ vision_image_part) trước lời gọi chat"""
+    METRICS.inc("app_vision_image_bytes_total", info["bytes"], mode=info["mode"])
+    METRICS.inc("app_vision_image_tokens_estimated_total", info["estimated_tokens"], mode=info["mode"])
+
+
+def record_openai_usage(call, mode, response, elapsed):
+    """Ghi latency + token (kể cả cached_tokens của prompt caching) của 1 lời gọi chat"""
+    METRICS.observe("app_openai_call_duration_seconds", elapsed, call=call, mode=mode)
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) or 0
+    METRICS.inc("app_openai_tokens_total", usage.prompt_tokens or 0, call=call, mode=mode, kind="prompt")
+    METRICS.inc("app_openai_tokens_total", cached, call=call, mode=mode, kind="cached")
+    METRICS.inc("app_openai_tokens_total", usage.completion_tokens or 0, call=call, mode=mode, kind="completion")
+    print(f"OpenAI {call} ({mode}): {elapsed:.2f}s, prompt {usage.prompt_tokens} tokens "
+          f"(cached {cached}), completion {usage.completion_tokens}")
+
+
+def _analysis_request(style, image_part):
+    """Prompt phân tích cố định đặt trước ảnh: prefix giống hệt nhau giữa các request để dùng được prompt caching"""
+    analysis_prompt = ANALYSIS_PROMPT_2D if style == "2D" else ANALYSIS_PROMPT_3D
+    return {
+        "model": "gpt-4o",
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": analysis_prompt},
+                    image_part,
+                ],
+            }
+        ],
+        "max_tokens": 800,
+        "prompt_cache_key": f"analysis-{style.lower()}-v{PROMPT_TEMPLATE_VERSION}",
+    }
+
+def describe_image_with_gpt4o_2D(image, vision_mode=None):
+    """Sử dụng GPT-4o để mô tả ảnh chi tiết"""
+    client = PROVIDER_CLIENTS.openai()
+    
+    try:
+        image_part, info = vision_image_part(image, vision_mode)
+        record_vision_image(info)
+
+        started = time.perf_counter()
+        with timed("describe"):
+            response = OPENAI_LIMITER.call(client.chat.completions.create, **_analysis_request("2D", image_part))
+        record_openai_usage("describe", info["mode"], response, time.perf_counter() - started)
+        
+        return response.choices[0].message.content
+        
+    except ProviderOverloaded:
+        raise
+    except Exception as e:
+        raise Exception(f"Cannot analyze image with GPT-4o: {str(e)}")
+
+def describe_image_with_gpt4o_3D(image, vision_mode=None):
+    """Sử dụng GPT-4o để mô tả ảnh chi tiết"""
+    client = PROVIDER_CLIENTS.openai()
+    
+    try:
+        image_part, info = vision_image_part(image, vision_mode)
+        record_vision_image(info)
+
+        started = time.perf_counter()
+        with timed("describe"):
+            response = OPENAI_LIMITER.call(client.chat.completions.create, **_analysis_request("3D", image_part))
+        record_openai_usage("describe", info["mode"], response, time.perf_counter() - started)
+        
+        return response.choices[0].message.content
+        
+    except ProviderOverloaded:
+        raise
+    except Exception as e:
+        raise Exception(f"Cannot analyze image with GPT-4o: {str(e)}")
+    
+def generate_dalle_prompt(image_description):
+    """Sử dụng GPT-4o để tạo prompt tối ưu cho DALL-E"""
+    client = PROVIDER_CLIENTS.openai()
+    
+    try:
+        prompt_generation_request = build_dalle_prompt_request(image_description)
         
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "user",
-                    "content": prompt_generation_request
-                }
-            ],
-            max_tokens=400
-        )
+        started = time.perf_counter()
+        with timed("prompt"):
+            response = OPENAI_LIMITER.call(
+                client.chat.completions.create,
+                model="gpt-4o",
+                messages=[
+                    {
+                        "role": "user",
+                        "content": prompt_generation_request
+                    }
+                ],
+                max_tokens=400
+            )
+        record_openai_usage("prompt", "text", response, time.perf_counter() - started)
         
         return response.choices[0].message.content.strip()
         
+    except ProviderOverloaded:
+        raise
     except Exception as e:
         raise Exception(f"Cannot generate DALL-E prompt: {str(e)}")
 
+# Cache kết quả /gen_prompt (SQLite, bền qua restart)
+# Tăng PROMPT_TEMPLATE_VERSION mỗi khi sửa prompt phân tích hoặc prompt DALL-E để bỏ kết quả cũ
+PROMPT_TEMPLATE_VERSION = "1"
+PROMPT_CACHE_ENABLED = os.getenv("PROMPT_CACHE_ENABLED", "1") == "1"
+PROMPT_CACHE_PATH = os.getenv("PROMPT_CACHE_PATH", "cache/prompt_results.sqlite3")
+PROMPT_CACHE_TTL = int(os.getenv("PROMPT_CACHE_TTL", str(7 * 24 * 3600)))
+PROMPT_CACHE_MAX_ENTRIES = int(os.getenv("PROMPT_CACHE_MAX_ENTRIES", "10000"))
+# Giây chờ khi DB đang bị worker khác khóa; cache nằm trên đường request nên chờ ngắn rồi coi như miss
+PROMPT_CACHE_BUSY_TIMEOUT = float(os.getenv("PROMPT_CACHE_BUSY_TIMEOUT", "2"))
+
+
+class PromptResultCache:
+    """Lưu prompt đã sinh theo key (hash ảnh đã chuẩn hóa, style, version template), có TTL và giới hạn số entry"""
+
+    def __init__(self, path, ttl, max_entries, busy_timeout=PROMPT_CACHE_BUSY_TIMEOUT):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.busy_timeout = busy_timeout
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._stats = {"hits": 0, "misses": 0, "expired": 0, "evicted": 0, "errors": 0}
+
+    @staticmethod
+    def make_key(image, style, vision_mode=None):
+        content_hash = image.sha256
+        # Ảnh gửi cho model khác nhau theo vision mode -> kết quả cache riêng (legacy giữ key cũ)
+        mode = vision_mode or VISION_PREP_MODE
+        style_key = style if mode == "legacy" else f"{style}:{mode}"
+        return f"{content_hash}:{style_key}:v{PROMPT_TEMPLATE_VERSION}"
+
+    def _connection(self):
+        # Mỗi process (sau fork) mở connection riêng
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS prompt_results ("
+                " key TEXT PRIMARY KEY, prompt TEXT NOT NULL,"
+                " created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_prompt_results_accessed ON prompt_results (accessed_at)")
+            conn.commit()
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def _failed(self, action, error):
+        # Gọi khi đang giữ _lock: cache lỗi (DB khóa, đầy đĩa, hỏng file) không được làm hỏng request
+        self._stats["errors"] += 1
+        print(f"Prompt cache {action} failed: {error}")
+        if self._conn is not None and self._pid == os.getpid():
+            try:
+                self._conn.rollback()
+            except sqlite3.Error:
+                pass
+
+    def get(self, key):
+        """Lỗi sqlite được coi là miss"""
+        now = time.time()
+        with self._lock:
+            try:
+                return self._get(self._connection(), key, now)
+            except (sqlite3.Error, OSError) as e:
+                self._failed("get", e)
+                self._stats["misses"] += 1
+                return None
+
+    def _get(self, conn, key, now):
+        row = conn.execute("SELECT prompt, created_at FROM prompt_results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self._stats["misses"] += 1
+            return None
+        prompt, created_at = row
+        if now - created_at > self.ttl:
+            conn.execute("DELETE FROM prompt_results WHERE key = ?", (key,))
+            conn.commit()
+            self._stats["expired"] += 1
+            self._stats["misses"] += 1
+            return None
+        conn.execute("UPDATE prompt_results SET accessed_at = ? WHERE key = ?", (now, key))
+        conn.commit()
+        self._stats["hits"] += 1
+        return prompt
+
+    def put(self, key, prompt):
+        """Lỗi sqlite chỉ log, không lưu"""
+        now = time.time()
+        with self._lock:
+            try:
+                self._put(self._connection(), key, prompt, now)
+            except (sqlite3.Error, OSError) as e:
+                self._failed("put", e)
+
+    def _put(self, conn, key, prompt, now):
+        conn.execute(
+            "INSERT OR REPLACE INTO prompt_results (key, prompt, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (key, prompt, now, now),
+        )
+        # Xóa entry hết hạn, sau đó cắt bớt entry ít dùng nhất nếu vượt giới hạn
+        conn.execute("DELETE FROM prompt_results WHERE created_at < ?", (now - self.ttl,))
+        count = conn.execute("SELECT COUNT(*) FROM prompt_results").fetchone()[0]
+        if count > self.max_entries:
+            overflow = count - self.max_entries
+            conn.execute(
+                "DELETE FROM prompt_results WHERE key IN ("
+                " SELECT key FROM prompt_results ORDER BY accessed_at ASC LIMIT ?)",
+                (overflow,),
+            )
+            self._stats["evicted"] += overflow
+        conn.commit()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            try:
+                stats["entries"] = self._connection().execute("SELECT COUNT(*) FROM prompt_results").fetchone()[0]
+            except sqlite3.Error as e:
+                stats["entries"] = None
+                print(f"Prompt cache stats failed: {e}")
+        total = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / total, 4) if total else 0.0
+        return stats
+
+
+PROMPT_RESULT_CACHE = PromptResultCache(
+    PROMPT_CACHE_PATH,
+    ttl=PROMPT_CACHE_TTL,
+    max_entries=PROMPT_CACHE_MAX_ENTRIES,
+) if PROMPT_CACHE_ENABLED else None
+
 def create_local_url(filepath, base_url="http://localhost:5000"):
     """Tạo URL local cho file ảnh"""
     if filepath and os.path.exists(filepath):
@@ -454,27 +2919,31 @@ def create_local_url(filepath, base_url="http://localhost:5000"):
         return f"{base_url}/images/{filename}"
     return None
 
-def generate_image(prompt, base64_image,n):
-    """Sử dụng DALL-E để tạo ảnh từ prompt và hình ảnh tham chiếu"""
-    client = openai.OpenAI(api_key=OPENAI_API_KEY)
+def generate_image(prompt, image, n):
+    """Sử dụng DALL-E để tạo ảnh từ prompt và hình ảnh tham chiếu (ImagePayload), trả về list ImagePayload"""
+    client = PROVIDER_CLIENTS.openai()
     
     try:
-        image_bytes = base64.b64decode(base64_image.split(',')[1])
-        image_file = io.BytesIO(image_bytes)
-        image_file.name = "reference_image.jpg"
+        if image is None:
+            raise Exception("reference image is required")
+        # Truyền bytes (không phải file object) để lần gọi lại sau 429 vẫn gửi đủ nội dung
+        image_file = image.as_file("reference_image")
         
-        response = client.images.edit(
-            model="gpt-image-1",
-            image=image_file,  
-            prompt=prompt,
-            size="1024x1024",
-            quality="auto",  
-            n=n
-        )
+        with timed("generate"):
+            response = OPENAI_LIMITER.call(
+                client.images.edit,
+                model="gpt-image-1",
+                image=image_file,  
+                prompt=prompt,
+                size="1024x1024",
+                quality="auto",  
+                n=n
+            )
         
-        base64_images = [img.b64_json for img in response.data if hasattr(img, 'b64_json')]
-        return base64_images
+        return images_from_response(response)
         
+    except ProviderOverloaded:
+        raise
     except Exception as e:
         raise Exception(f"Cannot generate image with DALL-E: {str(e)}")
 
@@ -495,187 +2964,990 @@ def validate_image_url(url):
         return False
 
 # xử lý ideogram
+IDEOGRAM_DEFAULT_RENDERING_SPEED = "TURBO"        # tốc độ
+IDEOGRAM_DEFAULT_ASPECT_RATIO   = "16x9"          # tỉ lệ
+IDEOGRAM_DEFAULT_NEGATIVE_PROMPT = "no text, no watermark"
+
+def _ideogram_form_fields(prompt, num_images):
+    return [
+        ("prompt", prompt),
+        ("num_images", str(num_images)),
+        ("rendering_speed", IDEOGRAM_DEFAULT_RENDERING_SPEED),
+        ("aspect_ratio", IDEOGRAM_DEFAULT_ASPECT_RATIO),
+        ("negative_prompt", IDEOGRAM_DEFAULT_NEGATIVE_PROMPT),
+    ]
+
 def _call_ideogram(files_form):
     headers = {"Api-Key": IDEOGRAM_API_KEY}
-    r = requests.post(IDEOGRAM_API_URL, headers=headers, files=files_form, timeout=300)
-    r.raise_for_status()
-    return r.json()
-
-def _prepare_reference_files_from_urls(urls):
-    """Tải tối đa 3 URL ảnh và đóng gói dạng multipart để gửi lên Ideogram."""
-    refs = []
-    for idx, u in enumerate(urls[:3]):
-        resp = requests.get(u, timeout=180)
-        resp.raise_for_status()
-        content_type = resp.headers.get("Content-Type", "image/png")
-        filename = f"ref_{idx}.png" if "png" in content_type else f"ref_{idx}.jpg"
-        refs.append(("style_reference_images", (filename, io.BytesIO(resp.content), content_type)))
-    return refs
+
+    def post():
+        # Gọi lại sau 429 -> tua file reference về đầu
+        for _, (_, content, *_) in files_form:
+            if hasattr(content, "seek"):
+                content.seek(0)
+        r = HTTP_POOL.session("api").post(IDEOGRAM_API_URL, headers=headers, files=files_form, timeout=300)
+        r.raise_for_status()
+        return r.json()
+
+    with timed("generate"):
+        return IDEOGRAM_LIMITER.call(post)
+
+def ideogram_image_urls(prompt, num_images, reference_files=()):
+    """Gọi Ideogram, trả về list URL ảnh (do Ideogram host). reference_files: list (filename, bytes/file, mimetype)"""
+    files_form = [(name, (None, value)) for name, value in _ideogram_form_fields(prompt, num_images)]
+    for filename, content, mimetype in reference_files[:3]:
+        files_form.append(("style_reference_images", (filename, content, mimetype)))
+    ideogram_json = _call_ideogram(files_form)
+    return [item.get("url") for item in ideogram_json.get("data", []) if item.get("url")]
+
+def _ideogram_reference_files(jpeg_images):
+    """Ảnh tham chiếu (JPEG bytes đã tải + chuẩn hóa) -> file style_reference_images gửi lên Ideogram"""
+    return [(f"ref_{idx}.jpg", jpeg_bytes, "image/jpeg") for idx, jpeg_bytes in enumerate(jpeg_images)]
+
+# === Job bất đồng bộ cho các endpoint chạy lâu ===
+# memory chỉ đúng khi 1 process (poll /jobs/<id> phải về đúng worker); gunicorn.conf.py mặc định sqlite
+JOB_STORE_BACKEND = os.getenv("JOB_STORE", "memory")  # memory | sqlite
+JOB_STORE_PATH = os.getenv("JOB_STORE_PATH", "cache/jobs.sqlite3")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "32"))
+JOB_MAX_PENDING = int(os.getenv("JOB_MAX_PENDING", "500"))
+JOB_TTL = int(os.getenv("JOB_TTL", str(24 * 3600)))  # giây giữ lại job đã xong
+JOB_CALLBACK_TIMEOUT = int(os.getenv("JOB_CALLBACK_TIMEOUT", "10"))
+# Danh sách host (phân tách bằng dấu phẩy) được nhận callback; để trống = mọi host công khai
+JOB_CALLBACK_ALLOWED_HOSTS = {h.strip().lower() for h in os.getenv("JOB_CALLBACK_ALLOWED_HOSTS", "").split(",") if h.strip()}
+
+
+def _callback_url_error(callback_url):
+    """Chặn SSRF: callback chỉ được gửi tới host công khai (không private/loopback/link-local/metadata).
+    Trả về lý do từ chối, None nếu hợp lệ"""
+    parsed = urlparse(callback_url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        return "Invalid callback_url"
+    host = parsed.hostname.lower()
+    if JOB_CALLBACK_ALLOWED_HOSTS and host not in JOB_CALLBACK_ALLOWED_HOSTS:
+        return "callback_url host is not allowed"
+    try:
+        infos = socket.getaddrinfo(host, parsed.port or (443 if parsed.scheme == "https" else 80), proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError, ValueError):
+        return "callback_url host cannot be resolved"
+    for info in infos:
+        addr = ipaddress.ip_address(info[4][0].split("%", 1)[0])
+        if not addr.is_global:
+            return "callback_url must point to a public address"
+    return None
+
+
+class InMemoryJobStore:
+    """Lưu trạng thái job trong process (mặc định). Chỉ dùng được khi poll về đúng worker đã nhận job"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._jobs = {}
+
+    def create(self, job):
+        with self._lock:
+            self._purge()
+            self._jobs[job["id"]] = dict(job)
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            job.update(fields, updated_at=time.time())
+            return dict(job)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def _purge(self):
+        cutoff = time.time() - self.ttl
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job["status"] in ("succeeded", "failed") and job["updated_at"] < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+
+class SQLiteJobStore:
+    """Lưu trạng thái job vào SQLite, dùng chung được giữa các worker trên cùng máy"""
+
+    _COLUMNS = ("id", "kind", "status", "status_code", "result", "error", "callback_url", "created_at", "updated_at")
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connection(self):
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY, kind TEXT NOT NULL, status TEXT NOT NULL,"
+                " status_code INTEGER, result TEXT, error TEXT, callback_url TEXT,"
+                " created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.commit()
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def _row_to_job(self, row):
+        job = dict(zip(self._COLUMNS, row))
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def create(self, job):
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "DELETE FROM jobs WHERE status IN ('succeeded', 'failed') AND updated_at < ?",
+                (time.time() - self.ttl,),
+            )
+            values = [job.get(c) for c in self._COLUMNS]
+            values[self._COLUMNS.index("result")] = json.dumps(job["result"]) if job.get("result") is not None else None
+            conn.execute(f"INSERT INTO jobs ({', '.join(self._COLUMNS)}) VALUES ({', '.join('?' * len(self._COLUMNS))})", values)
+            conn.commit()
+
+    def update(self, job_id, **fields):
+        fields["updated_at"] = time.time()
+        if "result" in fields:
+            fields["result"] = json.dumps(fields["result"]) if fields["result"] is not None else None
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            conn = self._connection()
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+            conn.commit()
+            row = conn.execute(f"SELECT {', '.join(self._COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._connection().execute(
+                f"SELECT {', '.join(self._COLUMNS)} FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return self._row_to_job(row) if row else None
+
+
+def _create_job_store(backend):
+    if backend == "sqlite":
+        return SQLiteJobStore(JOB_STORE_PATH, ttl=JOB_TTL)
+    if backend == "memory":
+        return InMemoryJobStore(ttl=JOB_TTL)
+    raise ValueError(f"Unknown JOB_STORE backend: {backend}")
+
+
+class JobRunner:
+    """Chạy pipeline trong thread pool giới hạn, trả job id ngay cho client"""
+
+    def __init__(self, store, max_workers, max_pending):
+        self.store = store
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = ForkSafeExecutor(max_workers, "job")
+        self._pid = os.getpid()
+        self._lock = threading.Condition()
+        self._pending = 0
+        self._active = set()  # id job đã nhận nhưng chưa xong
+
+    def submit(self, kind, fn, *args, callback_url=None):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Job đang chạy thuộc về process cha
+                self._pending = 0
+                self._active = set()
+                self._pid = os.getpid()
+            if self._pending >= self.max_pending:
+                return None
+            self._pending += 1
+
+        now = time.time()
+        job = {
+            "id": uuid.uuid4().hex,
+            "kind": kind,
+            "status": "queued",
+            "status_code": None,
+            "result": None,
+            "error": None,
+            "callback_url": callback_url,
+            "created_at": now,
+            "updated_at": now,
+        }
+        try:
+            self.store.create(job)
+        except Exception:
+            # Không lưu được job (vd. sqlite lỗi/khóa): trả lại slot, nếu không _pending rò dần tới max_pending
+            with self._lock:
+                self._pending -= 1
+            raise
+        with self._lock:
+            self._active.add(job["id"])
+        self._executor.submit(self._run, job["id"], fn, args, callback_url)
+        return job
+
+    def _run(self, job_id, fn, args, callback_url):
+        try:
+            self.store.update(job_id, status="running")
+            try:
+                body, status_code = fn(*args)
+                job = self.store.update(
+                    job_id,
+                    status="succeeded" if status_code < 400 else "failed",
+                    status_code=status_code,
+                    result=body,
+                    error=body.get("error") if status_code >= 400 else None,
+                )
+            except Exception as e:
+                job = self.store.update(job_id, status="failed", status_code=500, error=str(e))
+            if callback_url and job:
+                self._send_callback(callback_url, job)
+        finally:
+            with self._lock:
+                self._pending -= 1
+                self._active.discard(job_id)
+                self._lock.notify_all()
+
+    def drain(self, timeout):
+        """Worker sắp thoát (max_requests / deploy): đợi job đang chạy xong; job chưa xong kịp thì báo failed
+        thay vì để client poll mãi ở trạng thái running. Trả về số job bị bỏ dở"""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while self._active and time.monotonic() < deadline:
+                self._lock.wait(deadline - time.monotonic())
+            unfinished = list(self._active)
+        for job_id in unfinished:
+            self.store.update(job_id, status="failed", status_code=503,
+                              error="Worker restarted before the job finished, please resubmit")
+        return len(unfinished)
+
+    def _send_callback(self, callback_url, job):
+        # Kiểm tra lại lúc gửi (DNS có thể đã đổi sau khi nhận job), không theo redirect sang host khác
+        error = _callback_url_error(callback_url)
+        if error:
+            print(f"Job callback skipped for {job['id']}: {error}")
+            return
+        try:
+            r = HTTP_POOL.session("api").post(callback_url, json=job, timeout=JOB_CALLBACK_TIMEOUT, allow_redirects=False)
+            r.raise_for_status()
+        except Exception as e:
+            print(f"Job callback failed for {job['id']}: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {"pending": self._pending, "max_pending": self.max_pending, "workers": self.max_workers}
+
+
+JOB_RUNNER = JobRunner(_create_job_store(JOB_STORE_BACKEND), max_workers=JOB_WORKERS, max_pending=JOB_MAX_PENDING)
+
+
+def _wants_job(data):
+    """Client yêu cầu chạy dạng job qua body ("async": true) hoặc query ?async=1"""
+    flag = (data or {}).get("async", request.args.get("async"))
+    return str(flag).lower() in ("1", "true", "yes")
+
+def _submit_job(kind, fn, *args, callback_url=None):
+    if callback_url:
+        error = _callback_url_error(callback_url)
+        if error:
+            return jsonify({"error": error}), 400
+
+    job = JOB_RUNNER.submit(kind, fn, *args, callback_url=callback_url)
+    if job is None:
+        return jsonify({"error": "Too many pending jobs, retry later"}), 503
+    return jsonify({
+        "job_id": job["id"],
+        "status": job["status"],
+        "status_url": f"/jobs/{job['id']}",
+    }), 202
 
 # === API 1: Sinh prompt từ ảnh ===
-@app.route('/gen_prompt', methods=['POST'])
-def generate_prompt_api():
-    data = request.get_json()
+def _analyze_image(image, style, cache_key=None, vision_mode=None):
+    """Mô tả ảnh bằng GPT-4o rồi sinh prompt; lưu cache nếu có cache_key"""
+    if style == "2D":
+        image_description = describe_image_with_gpt4o_2D(image, vision_mode)
+    else:
+        image_description = describe_image_with_gpt4o_3D(image, vision_mode)
+    dalle_prompt = generate_dalle_prompt(image_description)
+
+    if cache_key and PROMPT_RESULT_CACHE:
+        PROMPT_RESULT_CACHE.put(cache_key, dalle_prompt)
+    return dalle_prompt
+
+def _run_gen_prompt(data):
     image_url = data.get('image_url')
     style = data.get('style_type')
 
     if not image_url or not validate_image_url(image_url):
-        return jsonify({"error": "Missing or invalid image_url"}), 400
+        return {"error": "Missing or invalid image_url"}, 400
+
+    vision_mode = data.get('vision_mode') or VISION_PREP_MODE
+    if vision_mode not in VISION_MODES:
+        return {"error": f"vision_mode must be one of {', '.join(VISION_MODES)}"}, 400
+
+    # bypass_cache: không đọc/ghi cache; refresh_cache: bỏ qua kết quả cũ và ghi kết quả mới
+    bypass_cache = bool(data.get('bypass_cache'))
+    refresh_cache = bool(data.get('refresh_cache'))
+    cache = PROMPT_RESULT_CACHE if not bypass_cache else None
+
+    try:
+        image = download_image(image_url)
+        style_key = "2D" if style == "2D" else "3D"
+        content_key = PromptResultCache.make_key(image, style_key, vision_mode)
+
+        if cache and not refresh_cache:
+            cached_prompt = cache.get(content_key)
+            if cached_prompt is not None:
+                print(f"Prompt cache hit: {content_key}")
+                return {
+                    "prompt": cached_prompt,
+                    "cached": True
+                }, 200
+
+        # Cùng ảnh + style đang được phân tích ở request khác -> đợi kết quả đó
+        dalle_prompt = PROMPT_FLIGHT.do(
+            content_key, _analyze_image, image, style_key, content_key if cache else None, vision_mode
+        )
+        return {
+            "prompt": dalle_prompt,
+            "cached": False
+        }, 200
+    except ProviderOverloaded as e:
+        return _overloaded_result(e)
+    except Exception as e:
+        return {"success": False, "error": str(e)}, 500
+
+@app.route('/gen_prompt', methods=['POST'])
+def generate_prompt_api():
+    data = request.get_json()
+    body, status = _run_gen_prompt(data)
+    return jsonify(body), status
+
+# === API 1b: Sinh prompt hàng loạt, trả kết quả dạng NDJSON ngay khi từng ảnh xong ===
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "5000"))
+BATCH_DEFAULT_CONCURRENCY = int(os.getenv("BATCH_DEFAULT_CONCURRENCY", "8"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "32"))  # giới hạn chung cho mọi batch trong worker
+BATCH_EXECUTOR = ForkSafeExecutor(BATCH_MAX_CONCURRENCY, "batch")
 
+def _run_batch_item(index, item):
     try:
-        base64_image = download_image(image_url)
-        if style == "2D":
-            image_description = describe_image_with_gpt4o_2D(base64_image)
+        if not isinstance(item, dict):
+            body, status = {"error": "Item must be an object"}, 400
         else:
-            image_description = describe_image_with_gpt4o_3D(base64_image)
-        dalle_prompt = generate_dalle_prompt(image_description)
-        return jsonify({
-            "prompt": dalle_prompt
-        }), 200
+            body, status = _run_gen_prompt(item)
+    except Exception as e:
+        body, status = {"error": str(e)}, 500
+    image_url = item.get("image_url") if isinstance(item, dict) else None
+    return {"index": index, "image_url": image_url, "status": status, **body}
+
+def _stream_batch_results(items, concurrency):
+    """Chạy tối đa `concurrency` item cùng lúc, yield từng dòng JSON theo thứ tự hoàn thành"""
+    pending = set()
+    queue = iter(enumerate(items))
+    succeeded = failed = 0
+
+    def refill():
+        for index, item in queue:
+            pending.add(BATCH_EXECUTOR.submit(_run_batch_item, index, item))
+            if len(pending) >= concurrency:
+                break
+
+    try:
+        refill()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.discard(future)
+                result = future.result()
+                if result["status"] < 400:
+                    succeeded += 1
+                else:
+                    failed += 1
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+            refill()
+        yield json.dumps({"done": True, "total": len(items), "succeeded": succeeded, "failed": failed}) + "\n"
+    finally:
+        # Client ngắt kết nối giữa chừng -> bỏ các item chưa bắt đầu
+        for future in pending:
+            future.cancel()
+
+@app.route('/gen_prompt/batch', methods=['POST'])
+def generate_prompt_batch_api():
+    data = request.get_json(silent=True) or {}
+    items = data.get("items")
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "items must be a non-empty list"}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"Too many items (max {BATCH_MAX_ITEMS})"}), 400
+
+    try:
+        concurrency = int(data.get("concurrency") or BATCH_DEFAULT_CONCURRENCY)
+    except (TypeError, ValueError):
+        return jsonify({"error": "concurrency must be an integer"}), 400
+    concurrency = max(1, min(concurrency, BATCH_MAX_CONCURRENCY))
+
+    # Cờ cache ở cấp batch áp dụng cho item không tự khai báo
+    defaults = {key: data[key] for key in ("style_type", "vision_mode", "bypass_cache", "refresh_cache") if key in data}
+    items = [{**defaults, **item} if isinstance(item, dict) else item for item in items]
+
+    return Response(_stream_batch_results(items, concurrency), mimetype="application/x-ndjson")
+
+# === Stream kết quả tạo ảnh: gửi từng URL ngay khi upload xong thay vì đợi đủ image_count ảnh ===
+# Bật bằng "stream": "sse" | "ndjson" (true = sse) trong body hoặc ?stream=..., hoặc header Accept: text/event-stream.
+# Event: progress (stage download/generate/upload: started/done), image, image_error, error, done.
+# Request stream không gộp qua GENERATION_FLIGHT: mỗi client nhận progress của chính pipeline mình.
+STREAM_FORMATS = ("sse", "ndjson")
+STREAM_HEARTBEAT_SECONDS = float(os.getenv("STREAM_HEARTBEAT_SECONDS", "15"))
+# Stage download/generate chạy ở thread riêng để generator vẫn gửi heartbeat trong lúc chờ provider
+STREAM_EXECUTOR = ForkSafeExecutor(int(os.getenv("STREAM_MAX_CONCURRENCY", "32")), "stream")
+STREAM_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def stream_format(data, args, accept_mimetypes):
+    """Format stream client yêu cầu (sse / ndjson), None nếu không stream; ValueError nếu giá trị lạ"""
+    value = (data or {}).get("stream", args.get("stream"))
+    if value in (None, False, "", "0", "false"):
+        return "sse" if accept_mimetypes.best == "text/event-stream" else None
+    if value is True or str(value).lower() in ("1", "true", "yes"):
+        return "sse"
+    value = str(value).lower()
+    if value not in STREAM_FORMATS:
+        raise ValueError(f"stream must be one of {', '.join(STREAM_FORMATS)}")
+    return value
+
+def encode_stream_event(fmt, event, data=None):
+    data = data or {}
+    if fmt == "sse":
+        return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+    return json.dumps({"event": event, **data}, ensure_ascii=False) + "\n"
+
+def encode_stream_heartbeat(fmt):
+    # SSE comment bị client bỏ qua; NDJSON cần 1 dòng JSON hợp lệ
+    return ": keep-alive\n\n" if fmt == "sse" else encode_stream_event(fmt, "heartbeat")
+
+def _stream_response(fmt, events):
+    mimetype = "text/event-stream" if fmt == "sse" else "application/x-ndjson"
+    return Response(events, mimetype=mimetype, headers=STREAM_HEADERS)
+
+def _stream_stage(fmt, stage, fn, *args):
+    """Chạy 1 stage ở STREAM_EXECUTOR, yield progress + heartbeat; trả kết quả qua `yield from`"""
+    started = time.perf_counter()
+    yield encode_stream_event(fmt, "progress", {"stage": stage, "status": "started"})
+    future = STREAM_EXECUTOR.submit(fn, *args)
+    while not wait([future], timeout=STREAM_HEARTBEAT_SECONDS).done:
+        yield encode_stream_heartbeat(fmt)
+    result = future.result()
+    yield encode_stream_event(fmt, "progress", {
+        "stage": stage, "status": "done", "elapsed": round(time.perf_counter() - started, 3),
+    })
+    return result
+
+def _stream_generation(fmt, generate, image_url=None):
+    """download (nếu có image_url) -> generate(reference) -> upload song song, yield event theo format"""
+    started = time.perf_counter()
+    pending = {}
+    try:
+        reference = None
+        if image_url:
+            reference = yield from _stream_stage(fmt, "download", download_image, image_url)
+        images = yield from _stream_stage(fmt, "generate", generate, reference)
+
+        upload_started = time.perf_counter()
+        yield encode_stream_event(fmt, "progress", {"stage": "upload", "status": "started", "count": len(images)})
+        pending = {UPLOAD_EXECUTOR.submit(store_generated_image, image): index for index, image in enumerate(images)}
+        results = {}
+        while pending:
+            done, _ = wait(pending, timeout=STREAM_HEARTBEAT_SECONDS, return_when=FIRST_COMPLETED)
+            if not done:
+                yield encode_stream_heartbeat(fmt)
+            for future in done:
+                index = pending.pop(future)
+                elapsed = round(time.perf_counter() - started, 3)
+                try:
+                    results[index] = future.result()
+                except Exception as e:
+                    print(f"Image {index} failed: {e}")
+                    results[index] = e
+                    yield encode_stream_event(fmt, "image_error", {"index": index, "error": str(e), "elapsed": elapsed})
+                else:
+                    yield encode_stream_event(fmt, "image", {"index": index, "url": results[index], "elapsed": elapsed})
+        yield encode_stream_event(fmt, "progress", {
+            "stage": "upload", "status": "done", "elapsed": round(time.perf_counter() - upload_started, 3),
+        })
+
+        # Event cuối giống body của response thường (urls theo thứ tự index)
+        public_urls = [results[i] for i in sorted(results) if not isinstance(results[i], Exception)]
+        errors = [{"index": i, "error": str(results[i])} for i in sorted(results) if isinstance(results[i], Exception)]
+        body, status = _upload_result(public_urls, errors)
+    except ProviderOverloaded as e:
+        body, status = _overloaded_result(e)
     except Exception as e:
-        return jsonify({"success": False, "error": str(e)}), 500
+        body, status = {"success": False, "error": str(e)}, 500
+    finally:
+        # Client ngắt kết nối giữa chừng -> bỏ các upload chưa bắt đầu
+        for future in pending:
+            future.cancel()
+    if "error" in body:
+        yield encode_stream_event(fmt, "error", {**body, "status": status})
+    yield encode_stream_event(fmt, "done", {**body, "status": status, "elapsed": round(time.perf_counter() - started, 3)})
 
 # === API 2: Tạo ảnh từ prompt and url===
-@app.route('/generate_image', methods=['POST'])
-def generate_image_api():
-    data = request.get_json()
+def _generate_image_request_error(data):
+    if not data.get('prompt'):
+        return {"error": "Missing prompt"}
+    image_url = data.get('image_url')
+    if image_url and not validate_image_url(image_url):
+        return {"error": "Invalid image_url"}
+    return None
+
+def _run_generate_image(data):
     prompt = data.get('prompt')
     image_url = data.get('image_url')
     n = data.get('image_count')
 
-    if not prompt:
-        return jsonify({"error": "Missing prompt"}), 400
+    error = _generate_image_request_error(data)
+    if error:
+        return error, 400
+
+    if SINGLEFLIGHT_GENERATION:
+        key = _flight_key("generate_image", prompt, image_url, n)
+        return GENERATION_FLIGHT.do(key, _generate_image_pipeline, prompt, image_url, n)
+    return _generate_image_pipeline(prompt, image_url, n)
 
+def generate_image_with_reference(prompt, reference, n):
+    """/generate_image: DALL-E edit, hoặc qua PROVIDER_ROUTER (ảnh tham chiếu làm style reference cho provider khác)"""
+    if reference is None or not ROUTING_ENABLED:
+        return generate_image(prompt, reference, n)
+    return generate_images_routed("generate_image", "openai", prompt, n, [reference.data])
+
+def _generate_image_pipeline(prompt, image_url, n):
     try:
-        base64_image = None
+        reference = None
         if image_url:
-            if not validate_image_url(image_url):
-                return jsonify({"error": "Invalid image_url"}), 400
-            base64_image = download_image(image_url)
-
-        base64_images = generate_image(prompt,base64_image,n)
-
-        public_urls = []
-        for b64 in base64_images:
-            local_path = base64_to_image_file(b64)
-            if local_path:
-                gcs_url = upload_to_gcs(local_path)
-                if gcs_url:
-                    public_urls.append(gcs_url)
-        return jsonify({
-            "urls": public_urls,
-        }), 200
+            reference = download_image(image_url)
+
+        images = generate_image_with_reference(prompt, reference, n)
+
+        public_urls, errors = store_generated_images(images)
+        return _upload_result(public_urls, errors)
+    except ProviderOverloaded as e:
+        return _overloaded_result(e)
     except Exception as e:
-        return jsonify({"success": False, "error": str(e)}), 500
+        return {"success": False, "error": str(e)}, 500
+
+@app.route('/generate_image', methods=['POST'])
+def generate_image_api():
+    data = request.get_json()
+    if _wants_job(data):
+        return _submit_job("generate_image", _run_generate_image, data, callback_url=data.get("callback_url"))
+    try:
+        fmt = stream_format(data, request.args, request.accept_mimetypes)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if fmt:
+        error = _generate_image_request_error(data)
+        if error:
+            return jsonify(error), 400
+        prompt, n = data['prompt'], data.get('image_count')
+        events = _stream_generation(fmt, lambda reference: generate_image_with_reference(prompt, reference, n), data.get('image_url'))
+        return _stream_response(fmt, events)
+    body, status = _run_generate_image(data)
+    return jsonify(body), status
 
 # === generate_image_from_prompt ===
-@app.route('/generate_image_from_prompt', methods=['POST'])
-def generate_image_from_prompt():
+def _run_generate_image_from_prompt(data):
     try:
-        data = request.get_json()
         prompt = data.get("prompt")
         n = data.get('image_count')
         if not prompt:
-            return jsonify({"error": "Missing prompt"}), 400
+            return {"error": "Missing prompt"}, 400
+    except Exception as e:
+        return {"error": str(e)}, 500
+
+    if SINGLEFLIGHT_GENERATION:
+        key = _flight_key("generate_image_from_prompt", prompt, n)
+        return GENERATION_FLIGHT.do(key, _generate_image_from_prompt_pipeline, prompt, n)
+    return _generate_image_from_prompt_pipeline(prompt, n)
 
-        client = openai.OpenAI(api_key=OPENAI_API_KEY)
-        response = client.images.generate(
+def generate_image_from_text(prompt, n):
+    """Tạo ảnh chỉ từ prompt (gpt-image-1), trả về list ImagePayload"""
+    client = PROVIDER_CLIENTS.openai()
+    with timed("generate"):
+        response = OPENAI_LIMITER.call(
+            client.images.generate,
             model="gpt-image-1",
             prompt=prompt,
             size="1024x1024",
             quality="auto",
             n=n
         )
-        base64_images = [img.b64_json for img in response.data if hasattr(img, 'b64_json')]
-        public_urls = []
-        for b64 in base64_images:
-            local_path = base64_to_image_file(b64)
-            if local_path:
-                gcs_url = upload_to_gcs(local_path)
-                if gcs_url:
-                    public_urls.append(gcs_url)
-        return jsonify({
-            "urls": public_urls,
-        }), 200
+    return images_from_response(response)
 
+def _generate_image_from_prompt_pipeline(prompt, n):
+    try:
+        images = generate_images_routed("generate_image_from_prompt", "openai", prompt, n)
+        public_urls, errors = store_generated_images(images)
+        return _upload_result(public_urls, errors)
+
+    except ProviderOverloaded as e:
+        return _overloaded_result(e)
+    except Exception as e:
+        return {"error": str(e)}, 500
+
+@app.route('/generate_image_from_prompt', methods=['POST'])
+def generate_image_from_prompt():
+    try:
+        data = request.get_json()
+        if _wants_job(data):
+            return _submit_job("generate_image_from_prompt", _run_generate_image_from_prompt, data, callback_url=data.get("callback_url"))
+        fmt = stream_format(data, request.args, request.accept_mimetypes)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+    if fmt:
+        if not data.get("prompt"):
+            return jsonify({"error": "Missing prompt"}), 400
+        prompt, n = data["prompt"], data.get('image_count')
+        return _stream_response(fmt, _stream_generation(fmt, lambda _: generate_images_routed("generate_image_from_prompt", "openai", prompt, n)))
+    body, status = _run_generate_image_from_prompt(data)
+    return jsonify(body), status
 # === Serve local images if needed ===
+# Ảnh crop gửi lên theo 1 trong 3 dạng:
+# 1) body thô Content-Type: image/* (không base64, nhỏ hơn ~25%)
+# 2) multipart/form-data, file ở field "image" (hoặc file đầu tiên)
+# 3) JSON {"image_base64": "data:image/png;base64,..."} như cũ
+UPLOAD_CROPPED_MAX_BYTES = int(os.getenv("UPLOAD_CROPPED_MAX_BYTES", str(20 * 1024 * 1024)))
+UPLOAD_MULTIPART_OVERHEAD = 64 * 1024  # boundary + header các part
+
+
+class UploadRejected(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def _read_image_stream(headers, read, max_bytes):
+    """Đọc stream theo chunk qua ImageBodyReader: kiểm tra magic bytes và giới hạn dung lượng khi đang đọc"""
+    try:
+        reader = ImageBodyReader(headers, max_bytes=max_bytes)
+        for chunk in iter(lambda: read(DOWNLOAD_CHUNK_SIZE), b""):
+            reader.feed(chunk)
+        return reader.finish()
+    except (ImageTooLargeError, RequestEntityTooLarge):
+        raise
+    except Exception as e:
+        raise UploadRejected(str(e))
+
+
+def uploaded_image_kind(content_type):
+    if content_type.startswith("image/"):
+        return "raw"
+    if content_type == "multipart/form-data":
+        return "multipart"
+    return "json"
+
+
+def decode_image_base64(value):
+    """Bytes từ chuỗi base64 có hoặc không có prefix data URL"""
+    if not value:
+        raise UploadRejected("Missing image_base64")
+    _, _, payload = value.rpartition(",")
+    try:
+        return base64.b64decode(payload)
+    except ValueError as e:
+        raise UploadRejected(f"Invalid image_base64: {e}")
+
+
+def _read_cropped_image():
+    kind = uploaded_image_kind(request.mimetype)
+    if kind == "json":
+        data = request.get_json(silent=True) or {}
+        return decode_image_base64(data.get("image_base64", ""))
+
+    # Werkzeug dừng đọc (413) khi body vượt giới hạn, kể cả body chunked không có Content-Length
+    overhead = UPLOAD_MULTIPART_OVERHEAD if kind == "multipart" else 0
+    request.max_content_length = UPLOAD_CROPPED_MAX_BYTES + overhead
+    if kind == "raw":
+        return _read_image_stream(request.headers, request.stream.read, UPLOAD_CROPPED_MAX_BYTES)
+
+    # File lớn được werkzeug spool ra file tạm khi parse -> chỉ giữ 1 bản trong RAM khi đọc ra
+    upload = request.files.get("image") or next(iter(request.files.values()), None)
+    if upload is None:
+        raise UploadRejected("Missing image file part")
+    return _read_image_stream(upload.headers, upload.stream.read, UPLOAD_CROPPED_MAX_BYTES)
+
+
 @app.route("/upload_cropped_image", methods=["POST"])
 def upload_cropped_image():
     try:
-        data = request.get_json()
-        base64_image = data.get("image_base64", "")
-        if "," in base64_image:
-            base64_image = base64_image.split(",")[1]  # Remove prefix like data:image/png;base64,...
-        local_path = base64_to_image_file(base64_image)
-        public_url = upload_to_gcs(local_path)
-        if public_url:
-            return jsonify({"url": public_url})
-        else:
-            return jsonify({"error": "Upload failed"}), 500
+        image_data = _read_cropped_image()
+        record_bytes("upload_body", len(image_data))
+        public_url = UPLOAD_EXECUTOR.submit(store_generated_image, ImagePayload(image_data)).result()
+        return jsonify({"url": public_url})
+    except UploadRejected as e:
+        return jsonify({"error": str(e)}), e.status
+    except (ImageTooLargeError, RequestEntityTooLarge) as e:
+        return jsonify({"error": f"Image too large (limit {UPLOAD_CROPPED_MAX_BYTES} bytes)"}), 413
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+def _run_ideogram_generate(prompt, num_images, image_reference_urls, uploaded_files):
+    """uploaded_files: list (filename, file object, mimetype) của ảnh reference upload trực tiếp"""
+    try:
+        # Nếu có reference (URL hoặc file) thì thêm, ngược lại thì không thêm gì
+        if uploaded_files:
+            image_urls = ideogram_image_urls(prompt, num_images, uploaded_files)
+        else:
+            references = fetch_reference_images(image_reference_urls) if image_reference_urls else []
+            image_urls = ideogram_urls_routed(prompt, num_images, references)
+
+        return {"images": image_urls}, 200
+
+    except ReferenceFetchError as e:
+        return {"error": "Cannot fetch image references", "detail": e.errors}, 400
+    except ProviderOverloaded as e:
+        return _overloaded_result(e)
+    except requests.HTTPError as e:
+        status = e.response.status_code if e.response is not None else 500
+        try:
+            detail = e.response.json()
+        except Exception:
+            detail = e.response.text if e.response is not None else str(e)
+        return {"error": "Ideogram API error", "detail": detail}, status
+    except Exception as e:
+        return {"error": str(e)}, 500
+
 @app.route("/ideogram/generate", methods=["POST"])
 def ideogram_generate():
     try:
         # ---- Đọc input (JSON hoặc multipart) ----
-        DEFAULT_RENDERING_SPEED = "TURBO"        # tốc độ
-        DEFAULT_ASPECT_RATIO   = "16x9"          # tỉ lệ
-        DEFAULT_NEGATIVE_PROMPT = "no text, no watermark"
         image_reference_urls = []
         uploaded_files = []
+        callback_url = None
 
         if request.is_json:
             data = request.get_json(force=True)
             prompt = data.get("prompt")
             num_images = data.get("num_images")
             image_reference_urls = data.get("image_references", []) or []
+            run_as_job = _wants_job(data)
+            callback_url = data.get("callback_url")
         else:
             prompt = request.form.get("prompt")
             num_images = request.form.get("image_count")
-            uploaded_files = request.files.getlist("image_reference_images")
+            uploaded_files = [(f.filename, f.stream, f.mimetype) for f in request.files.getlist("image_reference_images")]
+            run_as_job = _wants_job(request.form)
+            callback_url = request.form.get("callback_url")
 
         if not prompt or not num_images:
             return jsonify({"error": "prompt and num_images are required"}), 400
 
-        # ---- Build form-data gửi Ideogram ----
-        files_list = [
-            ("prompt", (None, prompt)),
-            ("num_images", (None, str(num_images))),
-            ("rendering_speed", (None, DEFAULT_RENDERING_SPEED)),
-            ("aspect_ratio", (None, DEFAULT_ASPECT_RATIO)),
-            ("negative_prompt", (None, DEFAULT_NEGATIVE_PROMPT)),
-        ]
+        if run_as_job:
+            # Stream upload chỉ sống trong request hiện tại -> đọc ra bytes trước khi đưa vào job
+            uploaded_files = [(name, io.BytesIO(stream.read()), mimetype) for name, stream, mimetype in uploaded_files[:3]]
+            return _submit_job(
+                "ideogram_generate", _run_ideogram_generate,
+                prompt, num_images, image_reference_urls, uploaded_files,
+                callback_url=callback_url,
+            )
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-        # Nếu có reference (URL hoặc file) thì thêm, ngược lại thì không thêm gì
-        if uploaded_files:
-            for f in uploaded_files[:3]:
-                files_list.append(("style_reference_images", (f.filename, f.stream, f.mimetype)))
-        elif image_reference_urls:
-            files_list.extend(_prepare_reference_files_from_urls(image_reference_urls))
+    body, status = _run_ideogram_generate(prompt, num_images, image_reference_urls, uploaded_files)
+    return jsonify(body), status
 
-        # ---- Gọi Ideogram ----
-        ideogram_json = _call_ideogram(files_list)
-        image_urls = [item.get("url") for item in ideogram_json.get("data", []) if item.get("url")]
+def _gemini_style_references(jpeg_images):
+    """Đóng gói ảnh tham chiếu (JPEG bytes) thành style reference cho Imagen"""
+    return [
+        genai_types.StyleReferenceImage(
+            reference_id=idx + 1,
+            reference_image=genai_types.Image(image_bytes=jpeg_bytes, mime_type="image/jpeg"),
+        )
+        for idx, jpeg_bytes in enumerate(jpeg_images)
+    ]
 
-        return jsonify({"images": image_urls})
+# === Tạo ảnh qua PROVIDER_ROUTER ===
+# Mỗi provider có 1 hàm cùng dạng (prompt, n, references) -> list ImagePayload, references là list JPEG bytes
+# (có thể rỗng), để provider nào cũng thay được cho provider khác khi failover / hedge.
+def openai_generate_images(prompt, n, references=()):
+    if references:
+        return generate_image(prompt, ImagePayload(references[0], "jpeg"), n)
+    return generate_image_from_text(prompt, n)
 
-    except requests.HTTPError as e:
-        status = e.response.status_code if e.response is not None else 500
-        try:
-            detail = e.response.json()
-        except Exception:
-            detail = e.response.text if e.response is not None else str(e)
-        return jsonify({"error": "Ideogram API error", "detail": detail}), status
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+def _gemini_reference_contents(prompt, references):
+    """Prompt + ảnh tham chiếu dạng inline image part cho generate_content"""
+    return [prompt] + [genai_types.Part.from_bytes(data=jpeg_bytes, mime_type="image/jpeg") for jpeg_bytes in references]
+
+def _gemini_reference_config():
+    return genai_types.GenerateContentConfig(response_modalities=["IMAGE"])
+
+def _gemini_content_images(resp):
+    """ImagePayload từ các inline image part của response generate_content"""
+    out = []
+    for candidate in getattr(resp, "candidates", None) or []:
+        for part in getattr(candidate.content, "parts", None) or []:
+            if part.inline_data is not None and part.inline_data.data:
+                out.append(ImagePayload(part.inline_data.data))
+    return out
+
+# Mỗi lần generate_content chỉ trả 1 ảnh -> n ảnh là n lần gọi song song
+GEMINI_IMAGE_EXECUTOR = ForkSafeExecutor(int(os.getenv("GEMINI_IMAGE_CONCURRENCY", "8")), "gemini_image")
+
+def _gemini_generate_with_references(prompt, n, references):
+    client = PROVIDER_CLIENTS.gemini()
+    contents = _gemini_reference_contents(prompt, references)
+
+    def generate_one():
+        return GEMINI_LIMITER.call(client.models.generate_content, model=GEMINI_REFERENCE_IMAGE_MODEL,
+                                   contents=contents, config=_gemini_reference_config())
+
+    with timed("generate"):
+        futures = [GEMINI_IMAGE_EXECUTOR.submit(generate_one) for _ in range(n or 1)]
+        responses = [future.result() for future in futures]
+    return [image for resp in responses for image in _gemini_content_images(resp)]
+
+def imagen_generate_images(prompt, n, references=()):
+    edit_client = PROVIDER_CLIENTS.gemini_edit() if references else None
+    if references and edit_client is None:
+        return _gemini_generate_with_references(prompt, n, references)
+    if edit_client is not None:
+        # Imagen chỉ nhận ảnh tham chiếu qua edit_image với model capability
+        with timed("generate"):
+            resp = GEMINI_LIMITER.call(
+                edit_client.models.edit_image,
+                model=GEMINI_EDIT_MODEL,
+                prompt=prompt,
+                reference_images=_gemini_style_references(references),
+                config=genai_types.EditImageConfig(number_of_images=n or 1),
+            )
+    else:
+        with timed("generate"):
+            resp = GEMINI_LIMITER.call(
+                PROVIDER_CLIENTS.gemini().models.generate_images,
+                model=GEMINI_IMAGE_MODEL,
+                prompt=prompt,
+                config=genai_types.GenerateImagesConfig(number_of_images=n or 1),
+            )
+    return _gemini_images(resp)
+
+def ideogram_generate_images(prompt, n, references=()):
+    """Ideogram trả URL -> tải về bytes (chỉ dùng khi Ideogram thay provider khác)"""
+    urls = ideogram_image_urls(prompt, n or 1, _ideogram_reference_files(references))
+    futures = [REFERENCE_EXECUTOR.submit(_fetch_image_bytes, url) for url in urls]
+    with timed("download"):
+        return [ImagePayload(future.result()[1]) for future in futures]
+
+PROVIDER_IMAGE_GENERATORS = {
+    "openai": openai_generate_images,
+    "gemini": imagen_generate_images,
+    "ideogram": ideogram_generate_images,
+}
+
+def generate_images_routed(route, primary, prompt, n, references=()):
+    """Tạo ảnh trên provider chính; ROUTING_ENABLED thì qua PROVIDER_ROUTER (breaker, failover, hedge)"""
+    if not ROUTING_ENABLED:
+        return PROVIDER_IMAGE_GENERATORS[primary](prompt, n, references)
+    attempts = [
+        (name, lambda generate=PROVIDER_IMAGE_GENERATORS[name]: generate(prompt, n, references))
+        for name in PROVIDER_ROUTER.candidates(primary)
+    ]
+    return PROVIDER_ROUTER.run(route, attempts)[1]
+
+def _stored_image_urls(generate):
+    """Provider dự phòng cho route trả URL: tạo ảnh rồi upload GCS"""
+    def run():
+        images = generate()
+        # Bên thua hedge: provider khác đã thắng thì bỏ ảnh, không upload GCS vô ích
+        _check_route_cancelled()
+        public_urls, errors = store_generated_images(images)
+        if not public_urls:
+            raise Exception(errors[0]["error"] if errors else "No image generated")
+        return public_urls
+    return run
+
+def ideogram_urls_routed(prompt, num_images, references=()):
+    """/ideogram/generate: URL Ideogram như cũ, hoặc URL GCS khi provider dự phòng thắng"""
+    ideogram = lambda: ideogram_image_urls(prompt, num_images, _ideogram_reference_files(references))
+    if not ROUTING_ENABLED:
+        return ideogram()
+    attempts = [("ideogram", ideogram)] + [
+        (name, _stored_image_urls(lambda generate=PROVIDER_IMAGE_GENERATORS[name]: generate(prompt, int(num_images), references)))
+        for name in PROVIDER_ROUTER.candidates("ideogram")[1:]
+    ]
+    return PROVIDER_ROUTER.run("ideogram_generate", attempts)[1]
+
+# Cách /gemini/generate trả ảnh ("response_mode" trong body hoặc ?response_mode=):
+# url: upload nguyên bytes lên GCS như các route OpenAI, trả {"images": [url, ...]} (dùng làm img src như data URL)
+# multipart: stream bytes ảnh gốc dạng multipart/mixed, mỗi ảnh 1 part, không base64/JSON
+# data_url: format cũ, base64 data URL inline trong JSON (body lớn hơn ảnh ~33%)
+# Mặc định giữ data_url để client cũ không đổi hành vi; client tự chọn url/multipart, hoặc đặt
+# GEMINI_DEFAULT_RESPONSE_MODE=url khi mọi client đã dùng được URL
+GEMINI_RESPONSE_MODES = ("url", "multipart", "data_url")
+GEMINI_DEFAULT_RESPONSE_MODE = os.getenv("GEMINI_DEFAULT_RESPONSE_MODE", "data_url")
+
+def gemini_response_mode(data, args, accept_mimetypes):
+    mode = data.get("response_mode") or args.get("response_mode")
+    if not mode:
+        return "multipart" if accept_mimetypes.best == "multipart/mixed" else GEMINI_DEFAULT_RESPONSE_MODE
+    if mode not in GEMINI_RESPONSE_MODES:
+        raise ValueError(f"response_mode must be one of {', '.join(GEMINI_RESPONSE_MODES)}")
+    return mode
+
+def _gemini_images(resp):
+    """ImagePayload của các ảnh Imagen trả về (bytes gốc, không copy)"""
+    out = []
+    for generated in getattr(resp, "generated_images", None) or []:
+        image = getattr(generated, "image", None)
+        if image is not None and image.image_bytes:
+            out.append(ImagePayload(image.image_bytes))
+    return out
+
+def _gemini_data_urls(images):
+    return [image.data_url() for image in images]
+
+def _gemini_url_result(public_urls, errors):
+    body, status = _upload_result(public_urls, errors)
+    body["images"] = body.pop("urls")
+    return body, status
+
+def multipart_mixed_parts(images, boundary):
+    """Body multipart/mixed theo từng chunk: header part rồi bytes ảnh gốc, không copy/gộp ảnh"""
+    for index, image in enumerate(images):
+        yield (
+            f"--{boundary}\r\n"
+            f"Content-Type: {image.mime_type}\r\n"
+            f"Content-Length: {len(image)}\r\n"
+            f"Content-Disposition: inline; filename=\"image-{index}.{image.extension}\"\r\n\r\n"
+        ).encode("ascii")
+        yield image.data
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode("ascii")
+
+def _gemini_response(mode, images):
+    if mode == "multipart":
+        boundary = uuid.uuid4().hex
+        return Response(
+            multipart_mixed_parts(images, boundary),
+            content_type=f"multipart/mixed; boundary={boundary}",
+            headers={"X-Image-Count": str(len(images))},
+        )
+    if mode == "url":
+        body, status = _gemini_url_result(*store_image_bytes(images))
+        return jsonify(body), status
+    return jsonify({"images": _gemini_data_urls(images)})
 
 @app.route("/gemini/generate", methods=["POST"])
 def gemini_generate():
-    client = genai.Client(api_key=GEMINI_API_KEY)
     try:
         if not request.is_json:
             return jsonify({"error": "Content-Type must be application/json"}), 400
@@ -693,39 +3965,153 @@ def gemini_generate():
 
         if not prompt or num_images < 1:
             return jsonify({"error": "prompt and num_images are required"}), 400
+        try:
+            response_mode = gemini_response_mode(data, request.args, request.accept_mimetypes)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
-        # Convert URL -> bytes/base64 cho Gemini
-        references = []
-        for u in image_reference_urls[:3]:
-            try:
-                references.append(references(u))
-            except Exception as e:
-                print("Download reference failed:", u, e)
+        # Tải song song ảnh tham chiếu (đã chuẩn hóa JPEG)
+        references = fetch_reference_images(image_reference_urls) if image_reference_urls else []
 
-        cfg = GenerateImagesConfig(number_of_images=num_images)
+        images = generate_images_routed("gemini_generate", "gemini", prompt, num_images, references)
+        return _gemini_response(response_mode, images)
 
-        # Một số phiên bản SDK chưa hỗ trợ 'references'.
-        # Nếu bạn gặp lỗi TypeError, bỏ tham số 'references' đi.
-        resp = client.images.generate(
-            model=GEMINI_IMAGE_MODEL,
-            prompt=prompt,
-            config=cfg,
-            references=references if references else None,
-        )
+    except ReferenceFetchError as e:
+        return jsonify({"error": "Cannot fetch image references", "detail": e.errors}), 400
+    except ProviderOverloaded as e:
+        body, status = _overloaded_result(e)
+        return jsonify(body), status
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-        # Chuẩn hóa output thành data URL
-        out = []
-        for img in getattr(resp, "images", []):
-            if hasattr(img, "bytes_base64") and img.bytes_base64:
-                out.append(f"data:image/png;base64,{img.bytes_base64}")
-            elif hasattr(img, "data") and img.data:
-                b64 = base64.b64encode(img.data).decode("utf-8")
-                out.append(f"data:image/png;base64,{b64}")
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    job = JOB_RUNNER.store.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
 
-        return jsonify({"images": out})
+@app.route("/health", methods=["GET"])
+def health():
+    return jsonify(PROVIDER_CLIENTS.health())
 
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+@app.route("/health/reset", methods=["POST"])
+def reset_provider_clients():
+    # Endpoint quản trị: chỉ bật khi đặt HEALTH_RESET_TOKEN, client gửi kèm header X-Admin-Token
+    token = os.getenv("HEALTH_RESET_TOKEN")
+    if not token:
+        return jsonify({"error": "Not found"}), 404
+    if not hmac.compare_digest(request.headers.get("X-Admin-Token", "").encode(), token.encode()):
+        return jsonify({"error": "Unauthorized"}), 401
+    data = request.get_json(silent=True) or {}
+    reset = PROVIDER_CLIENTS.reset(data.get("providers"))
+    return jsonify({"reset": reset})
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify({
+        "http_pool": HTTP_POOL.stats(),
+        "reference_image_cache": REFERENCE_IMAGE_CACHE.stats() if REFERENCE_IMAGE_CACHE else None,
+        "prompt_result_cache": PROMPT_RESULT_CACHE.stats() if PROMPT_RESULT_CACHE else None,
+        "jobs": JOB_RUNNER.stats(),
+        "download_host_strategies": len(DOWNLOAD_HOST_STRATEGY),
+        "single_flight": {
+            flight.name: flight.stats() for flight in (DOWNLOAD_FLIGHT, PROMPT_FLIGHT, GENERATION_FLIGHT)
+        },
+        "provider_limits": {limiter.name: limiter.stats() for limiter in PROVIDER_LIMITERS},
+        "gcs_dedup": GCS_DEDUP_UPLOADER.stats() if GCS_DEDUP_UPLOADER else None,
+        "routing": {"enabled": ROUTING_ENABLED, "breakers": PROVIDER_ROUTER.stats()},
+    })
+
+@app.route("/routing/decisions", methods=["GET"])
+def routing_decisions():
+    """Quyết định định tuyến gần đây (?limit=&route=&provider=) để chỉnh ngưỡng breaker / hedge"""
+    limit = request.args.get("limit", default=100, type=int)
+    return jsonify({"decisions": ROUTING_DECISIONS.recent(limit, request.args.get("route"), request.args.get("provider"))})
+
+def _breaker_gauges(breaker_stats):
+    """state (chuỗi) -> app_routing_breaker_open: 0 closed, 0.5 half-open, 1 open"""
+    levels = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 0.5, CircuitBreaker.OPEN: 1}
+    return {
+        name: {**{k: v for k, v in stats.items() if k != "state" and v is not None}, "open": levels[stats["state"]]}
+        for name, stats in breaker_stats.items()
+    }
+
+def _stats_families(prefix, stats_by_label, label=None, counters=()):
+    """{nhãn: stats dict} -> key trong counters (đếm dồn từ lúc worker chạy) thành counter {prefix}_{key}_total,
+    key còn lại là mức hiện tại (entries, bytes, in_flight, limit, ratio...) thành gauge {prefix}_{key}"""
+    families = {}
+    for label_value, stats in stats_by_label.items():
+        for key, value in (stats or {}).items():
+            families.setdefault(key, []).append(({label: label_value} if label else {}, value))
+    return [
+        (f"{prefix}_{key}_total", "counter", f"{prefix} {key}", samples) if key in counters
+        else (f"{prefix}_{key}", "gauge", f"{prefix} {key}", samples)
+        for key, samples in families.items()
+    ]
+
+def _collect_stats_metrics():
+    hosts = HTTP_POOL_STATS.snapshot()["hosts"]
+    families = [(
+        "app_http_pool_connections_total", "counter", "Số lần lấy connection từ pool (reused = keep-alive)",
+        [({"host": host, "reused": "true"}, c["hits"]) for host, c in hosts.items()]
+        + [({"host": host, "reused": "false"}, c["misses"]) for host, c in hosts.items()],
+    )]
+    families += _stats_families(
+        "app_reference_cache", {None: REFERENCE_IMAGE_CACHE.stats() if REFERENCE_IMAGE_CACHE else None}, counters=(
+            "memory_hits", "disk_hits", "revalidated", "misses", "bytes_saved",
+        ),
+    )
+    families += _stats_families(
+        "app_prompt_cache", {None: PROMPT_RESULT_CACHE.stats() if PROMPT_RESULT_CACHE else None},
+        counters=("hits", "misses", "expired", "evicted", "errors"),
+    )
+    families += _stats_families("app_jobs", {None: JOB_RUNNER.stats()})
+    if GCS_DEDUP_UPLOADER:
+        families.append(("app_gcs_dedup_index_entries", "gauge", "Số object trong index dedup local",
+                         [({}, GCS_DEDUP_UPLOADER.stats()["index_entries"])]))
+    families += _stats_families(
+        "app_single_flight", {f.name: f.stats() for f in (DOWNLOAD_FLIGHT, PROMPT_FLIGHT, GENERATION_FLIGHT)}, "flight",
+        counters=("executed", "collapsed", "errors", "wait_timeouts"),
+    )
+    families += _stats_families(
+        "app_provider_limiter", {l.name: l.stats() for l in PROVIDER_LIMITERS}, "provider",
+        counters=("admitted", "queued", "rejected", "throttled", "errors", "retries"),
+    )
+    families += _stats_families(
+        "app_routing_breaker", _breaker_gauges(PROVIDER_ROUTER.stats()), "provider",
+        counters=("opened", "short_circuited", "successes", "failures", "cancelled"),
+    )
+    families.append(("app_download_host_strategies", "gauge", "Số host đã nhớ method tải", [({}, len(DOWNLOAD_HOST_STRATEGY))]))
+    return families
+
+METRICS.register_collector(_collect_stats_metrics)
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(METRICS.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.before_request
+def _start_request_metrics():
+    g.request_started = time.perf_counter()
+    CURRENT_ENDPOINT.set(request.url_rule.rule if request.url_rule else "unmatched")
+
+@app.after_request
+def _record_request_metrics(response):
+    started = getattr(g, "request_started", None)
+    if started is not None:
+        METRICS.observe("app_http_request_duration_seconds", time.perf_counter() - started,
+                        endpoint=CURRENT_ENDPOINT.get(), method=request.method, status=str(response.status_code))
+    return response
+
+@app.after_request
+def _add_retry_after_header(response):
+    """Body lỗi quá tải có retry_after (vd ProviderOverloaded) -> thêm header Retry-After cho client"""
+    if response.status_code == 503 and response.is_json and "Retry-After" not in response.headers:
+        body = response.get_json(silent=True)
+        if isinstance(body, dict) and body.get("retry_after"):
+            response.headers["Retry-After"] = str(math.ceil(body["retry_after"]))
+    return response
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
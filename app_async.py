@@ -0,0 +1,968 @@
+"""Chế độ serve bất đồng bộ (asyncio) cho các endpoint I/O-bound của app.py.
+
+Các route giữ nguyên request/response như app.py nhưng chạy trên event loop:
+HTTP ra ngoài qua httpx.AsyncClient, OpenAI qua AsyncOpenAI, Gemini qua client.aio.
+PIL (CPU) chạy trên thread/process pool, GCS SDK (chỉ có bản sync) chạy trên thread pool I/O.
+Cache, cấu hình và các hàm xử lý ảnh dùng chung với app.py.
+
+Chạy:
+    hypercorn app_async:app --bind 0.0.0.0:5000
+"""
+import asyncio
+import contextvars
+import math
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import httpx
+from quart import Quart, Response, g, jsonify, request
+from werkzeug.exceptions import RequestEntityTooLarge
+
+import app as sync_app
+from app import (
+    CURRENT_ENDPOINT,
+    METRICS,
+    DownloadDeadlineExceeded,
+    ImageBodyReader,
+    ImagePayload,
+    ImageTooLargeError,
+    PromptResultCache,
+    ProviderOverloaded,
+    ReferenceFetchError,
+    UploadRejected,
+    encode_stream_event,
+    encode_stream_heartbeat,
+    openai,  # _LazyModule: SDK chỉ import khi tạo client lần đầu
+    record_bytes,
+    stream_format,
+    timed,
+)
+
+app = Quart(__name__)
+# Quart mặc định chặn body > 16 MiB trước khi route chạy; nâng lên đúng giới hạn /upload_cropped_image của app.py
+# (ảnh 20 MB + header multipart) để 2 chế độ serve nhận cùng dung lượng
+app.config["MAX_CONTENT_LENGTH"] = sync_app.UPLOAD_CROPPED_MAX_BYTES + sync_app.UPLOAD_MULTIPART_OVERHEAD
+
+ASYNC_CPU_POOL = os.getenv("ASYNC_CPU_POOL", "thread")  # thread | process
+ASYNC_CPU_WORKERS = int(os.getenv("ASYNC_CPU_WORKERS", str(os.cpu_count() or 2)))
+ASYNC_IO_WORKERS = int(os.getenv("ASYNC_IO_WORKERS", "64"))  # cho GCS SDK (sync)
+ASYNC_HTTP_MAX_CONNECTIONS = int(os.getenv("ASYNC_HTTP_MAX_CONNECTIONS", "200"))
+ASYNC_HTTP_MAX_KEEPALIVE = int(os.getenv("ASYNC_HTTP_MAX_KEEPALIVE", "50"))
+
+
+class AsyncResources:
+    """Client async và pool dùng chung trong vòng đời event loop của process"""
+
+    def __init__(self):
+        self.http = None
+        self.http_insecure = None
+        self.cpu_pool = None
+        self.io_pool = None
+        self.upload_semaphore = None
+
+    def start(self):
+        limits = httpx.Limits(
+            max_connections=ASYNC_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=ASYNC_HTTP_MAX_KEEPALIVE,
+        )
+        # httpx đặt verify theo client -> 1 client verify SSL, 1 client cho các method tắt verify
+        self.http = httpx.AsyncClient(limits=limits)
+        self.http_insecure = httpx.AsyncClient(limits=limits, verify=False)
+        if ASYNC_CPU_POOL == "process":
+            self.cpu_pool = ProcessPoolExecutor(max_workers=ASYNC_CPU_WORKERS)
+        else:
+            self.cpu_pool = ThreadPoolExecutor(max_workers=ASYNC_CPU_WORKERS, thread_name_prefix="cpu")
+        self.io_pool = ThreadPoolExecutor(max_workers=ASYNC_IO_WORKERS, thread_name_prefix="io")
+        self.upload_semaphore = asyncio.Semaphore(sync_app.UPLOAD_CONCURRENCY)
+
+    def openai_client(self):
+        # Qua PROVIDER_CLIENTS như client sync: tạo lazy, key đọc lại từ môi trường -> rotate key / reset là tạo client mới
+        return sync_app.PROVIDER_CLIENTS.get("openai_async")
+
+    async def close(self):
+        await self.http.aclose()
+        await self.http_insecure.aclose()
+        client = sync_app.PROVIDER_CLIENTS.cached("openai_async")
+        if client is not None:
+            await client.close()
+        self.cpu_pool.shutdown(wait=False, cancel_futures=True)
+        self.io_pool.shutdown(wait=False, cancel_futures=True)
+
+
+resources = AsyncResources()
+
+
+@app.before_serving
+async def _startup():
+    resources.start()
+
+
+@app.after_serving
+async def _shutdown():
+    await resources.close()
+
+
+async def run_cpu(fn, *args):
+    """Chạy việc nặng CPU (PIL) ngoài event loop"""
+    if ASYNC_CPU_POOL != "process":
+        # Giữ nhãn endpoint cho metrics (context không truyền được sang process khác)
+        return await asyncio.get_running_loop().run_in_executor(resources.cpu_pool, contextvars.copy_context().run, fn, *args)
+    return await asyncio.get_running_loop().run_in_executor(resources.cpu_pool, fn, *args)
+
+
+async def run_io(fn, *args):
+    """Chạy lời gọi I/O blocking (GCS SDK, SQLite, cache disk) ngoài event loop"""
+    return await asyncio.get_running_loop().run_in_executor(resources.io_pool, contextvars.copy_context().run, fn, *args)
+
+
+class AsyncSingleFlight:
+    """Bản asyncio của SingleFlight: công việc chạy trong task riêng, chỉ bị hủy khi mọi request đang đợi đều đã hủy"""
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}  # key -> {"task", "waiters"}
+        self._stats = {"executed": 0, "collapsed": 0, "cancelled": 0}
+
+    async def do(self, key, fn, *args, wait_timeout=None):
+        """wait_timeout: thời gian tối đa lời gọi này đợi kết quả; hết giờ thì chỉ lời gọi này bỏ cuộc như khi bị hủy"""
+        entry = self._calls.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(fn(*args))
+            entry = {"task": task, "waiters": 0}
+            self._calls[key] = entry
+            task.add_done_callback(lambda _, key=key, entry=entry: self._forget(key, entry))
+            self._stats["executed"] += 1
+        else:
+            self._stats["collapsed"] += 1
+
+        entry["waiters"] += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(entry["task"]), timeout=wait_timeout)
+        except asyncio.CancelledError:
+            self._abandon(entry)
+            raise
+        except asyncio.TimeoutError:
+            if entry["task"].done():
+                raise  # chính công việc raise TimeoutError, không phải lời gọi này hết giờ đợi
+            self._abandon(entry)
+            raise Exception(f"Timed out waiting for identical in-flight request ({self.name})") from None
+        finally:
+            entry["waiters"] -= 1
+
+    def _abandon(self, entry):
+        if entry["waiters"] == 1 and not entry["task"].done():
+            entry["task"].cancel()
+            self._stats["cancelled"] += 1
+
+    def _forget(self, key, entry):
+        if self._calls.get(key) is entry:
+            del self._calls[key]
+
+    def stats(self):
+        return {**self._stats, "in_flight": len(self._calls)}
+
+
+DOWNLOAD_FLIGHT = AsyncSingleFlight("download")
+PROMPT_FLIGHT = AsyncSingleFlight("gen_prompt")
+GENERATION_FLIGHT = AsyncSingleFlight("generation")
+
+
+# === Download ảnh tham chiếu ===
+async def _fetch_once(client, image_url, headers, method):
+    async with client.stream(
+        "GET",
+        image_url,
+        headers=headers,
+        timeout=method['timeout'],
+        follow_redirects=method['allow_redirects'],
+    ) as response:
+        # Ảnh không đổi so với bản trong cache
+        if response.status_code == 304:
+            print("Not modified (304), using cached image")
+            return 304, b"", response.headers
+        response.raise_for_status()
+
+        reader = ImageBodyReader(response.headers)
+        async for chunk in response.aiter_bytes(sync_app.DOWNLOAD_CHUNK_SIZE):
+            reader.feed(chunk)
+        image_data = reader.finish()
+        print(f"Downloaded {len(image_data)} bytes")
+
+        if len(image_data) < sync_app.DOWNLOAD_MIN_BYTES:
+            raise Exception("Downloaded file too small, might be an error page")
+        return response.status_code, image_data, response.headers
+
+
+async def _fetch_image_bytes(image_url, extra_headers=None, deadline_seconds=None):
+    """Bản async của app._fetch_image_bytes: cùng ladder method, ghi nhớ theo host và deadline chung"""
+    deadline_seconds = deadline_seconds or sync_app.DOWNLOAD_DEADLINE
+    deadline = time.monotonic() + deadline_seconds
+    host = urlparse(image_url).netloc.lower()
+    methods = sync_app.DOWNLOAD_METHODS
+
+    order = list(range(1, len(methods) + 1))
+    preferred = sync_app.DOWNLOAD_HOST_STRATEGY.get(host)
+    if preferred in order:
+        order.remove(preferred)
+        order.insert(0, preferred)
+
+    last_error = None
+    for attempt, i in enumerate(order):
+        method = methods[i - 1]
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            last_error = f"deadline of {deadline_seconds}s exceeded"
+            break
+        print(f"Trying download method {i}/{len(methods)}...")
+        client = resources.http if method['verify'] else resources.http_insecure
+        headers = {**method['headers'], **(extra_headers or {})}
+        try:
+            result = await asyncio.wait_for(_fetch_once(client, image_url, headers, method), timeout=remaining)
+            sync_app.DOWNLOAD_HOST_STRATEGY.set(host, i)
+            METRICS.inc("app_download_attempts_total", method=str(i), outcome="ok")
+            record_bytes("download", len(result[1]))
+            return result
+        except asyncio.TimeoutError:
+            METRICS.inc("app_download_attempts_total", method=str(i), outcome="DownloadDeadlineExceeded")
+            sync_app.DOWNLOAD_HOST_STRATEGY.pop(host)
+            raise DownloadDeadlineExceeded(f"Download deadline of {deadline_seconds}s exceeded")
+        except (ImageTooLargeError, DownloadDeadlineExceeded) as e:
+            METRICS.inc("app_download_attempts_total", method=str(i), outcome=type(e).__name__)
+            sync_app.DOWNLOAD_HOST_STRATEGY.pop(host)
+            raise
+        except Exception as e:
+            METRICS.inc("app_download_attempts_total", method=str(i), outcome=type(e).__name__)
+            last_error = str(e)
+            print(f"Method {i} failed: {last_error}")
+
+            response = getattr(e, 'response', None) if isinstance(e, httpx.HTTPStatusError) else None
+            status = response.status_code if response is not None else None
+            transient = status in sync_app.HTTP_RETRY_STATUSES or isinstance(e, httpx.TransportError)
+            if transient and attempt + 1 < len(order):
+                wait = sync_app._retry_after_seconds(response)
+                if wait is None:
+                    wait = sync_app.HTTP_RETRY_BACKOFF * (2 ** attempt)
+                wait = min(wait, deadline - time.monotonic())
+                if wait > 0:
+                    await asyncio.sleep(wait)
+
+    sync_app.DOWNLOAD_HOST_STRATEGY.pop(host)
+    raise Exception(f"All download methods failed. Last error: {last_error}")
+
+
+async def download_image(image_url):
+    """ImagePayload JPEG đã chuẩn hóa (xem app.download_image)"""
+    return ImagePayload(await download_image_bytes(image_url), "jpeg")
+
+
+async def download_image_bytes(image_url, deadline_seconds=None):
+    """Download + chuẩn hóa ảnh, trả về JPEG bytes (qua cache chung với app.py)"""
+    return await DOWNLOAD_FLIGHT.do(
+        image_url, _download_image_bytes, image_url, deadline_seconds,
+        wait_timeout=deadline_seconds or sync_app.DOWNLOAD_DEADLINE,
+    )
+
+
+async def _download_image_bytes(image_url, deadline_seconds=None):
+    cache = sync_app.REFERENCE_IMAGE_CACHE
+    cached, tier = await run_io(cache.get, image_url) if cache else (None, None)
+
+    if cached and cache.is_fresh(cached):
+        print(f"Reference cache hit ({tier}): {image_url}")
+        cache.record(f"{tier}_hits", cached["source_size"])
+        return cached["data"]
+
+    conditional = {}
+    if cached:
+        if cached.get("etag"):
+            conditional["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            conditional["If-Modified-Since"] = cached["last_modified"]
+
+    with timed("download"):
+        status, image_data, headers = await _fetch_image_bytes(image_url, conditional, deadline_seconds)
+    if status == 304 and cached:
+        await run_io(cache.refresh, image_url, cached)
+        cache.record("revalidated", cached["source_size"])
+        return cached["data"]
+
+    with timed("normalize"):
+        jpeg_bytes = await run_cpu(sync_app._normalize_reference_image, image_data)
+    record_bytes("normalize", len(jpeg_bytes))
+    if cache:
+        cache.record("misses")
+        await run_io(
+            lambda: cache.put(
+                image_url,
+                jpeg_bytes,
+                etag=headers.get("ETag"),
+                last_modified=headers.get("Last-Modified"),
+                source_size=len(image_data),
+            )
+        )
+    return jpeg_bytes
+
+
+async def fetch_reference_images(urls, limit=sync_app.MAX_REFERENCE_IMAGES, deadline_seconds=None):
+    """Tải song song ảnh tham chiếu trong 1 deadline chung, trả về list JPEG bytes theo thứ tự URL"""
+    urls = list(urls)[:limit]
+    deadline_seconds = deadline_seconds or sync_app.REFERENCE_FETCH_DEADLINE
+
+    errors = []
+    tasks = {}
+    for index, url in enumerate(urls):
+        parsed = urlparse(url) if isinstance(url, str) else None
+        if not parsed or parsed.scheme not in ("http", "https") or not parsed.netloc:
+            errors.append({"index": index, "url": url, "error": "Invalid image URL"})
+            continue
+        tasks[index] = asyncio.ensure_future(download_image_bytes(url, deadline_seconds))
+
+    done, pending = await asyncio.wait(tasks.values(), timeout=deadline_seconds) if tasks else (set(), set())
+    for task in pending:
+        task.cancel()
+
+    results = []
+    for index, task in tasks.items():
+        if task in pending:
+            errors.append({"index": index, "url": urls[index], "error": f"deadline of {deadline_seconds}s exceeded"})
+        elif task.exception() is not None:
+            errors.append({"index": index, "url": urls[index], "error": str(task.exception())})
+        else:
+            results.append(task.result())
+
+    if errors:
+        raise ReferenceFetchError(sorted(errors, key=lambda item: item["index"]))
+    return results
+
+
+# === Provider ===
+async def describe_image_with_gpt4o(image, style, vision_mode=None):
+    """Mô tả ảnh bằng GPT-4o (AsyncOpenAI), dùng chung prompt và cách chuẩn bị ảnh với app.py"""
+    try:
+        image_part, vision_info = await run_cpu(sync_app.vision_image_part, image, vision_mode)
+        sync_app.record_vision_image(vision_info)
+        started = time.perf_counter()
+        with timed("describe"):
+            response = await sync_app.OPENAI_LIMITER.call_async(
+                resources.openai_client().chat.completions.create,
+                **sync_app._analysis_request(style, image_part),
+            )
+        sync_app.record_openai_usage("describe", vision_info["mode"], response, time.perf_counter() - started)
+        return response.choices[0].message.content
+    except ProviderOverloaded:
+        raise
+    except Exception as e:
+        raise Exception(f"Cannot analyze image with GPT-4o: {str(e)}")
+
+
+async def generate_dalle_prompt(image_description):
+    try:
+        started = time.perf_counter()
+        with timed("prompt"):
+            response = await sync_app.OPENAI_LIMITER.call_async(
+                resources.openai_client().chat.completions.create,
+                model="gpt-4o",
+                messages=[{"role": "user", "content": sync_app.build_dalle_prompt_request(image_description)}],
+                max_tokens=400,
+            )
+        sync_app.record_openai_usage("prompt", "text", response, time.perf_counter() - started)
+        return response.choices[0].message.content.strip()
+    except ProviderOverloaded:
+        raise
+    except Exception as e:
+        raise Exception(f"Cannot generate DALL-E prompt: {str(e)}")
+
+
+async def generate_image(prompt, image, n):
+    try:
+        if image is None:
+            raise Exception("reference image is required")
+        with timed("generate"):
+            response = await sync_app.OPENAI_LIMITER.call_async(
+                resources.openai_client().images.edit,
+                model="gpt-image-1",
+                image=image.as_file("reference_image"),
+                prompt=prompt,
+                size="1024x1024",
+                quality="auto",
+                n=n,
+            )
+        return await run_cpu(sync_app.images_from_base64, sync_app.response_b64_images(response))
+    except ProviderOverloaded:
+        raise
+    except Exception as e:
+        raise Exception(f"Cannot generate image with DALL-E: {str(e)}")
+
+
+async def store_generated_image(image):
+    """Encode PNG trên CPU pool, upload GCS trên I/O pool (dedup theo nội dung: ảnh đã có thì bỏ qua cả encode)"""
+    if sync_app.GCS_SPOOL_TO_DISK:
+        return await run_io(sync_app.store_generated_image, image)
+    uploader = sync_app.GCS_DEDUP_UPLOADER
+    if uploader:
+        public_url = await run_io(uploader.lookup, image, "png")
+        if public_url:
+            return public_url
+    try:
+        with timed("encode"):
+            png_bytes = await run_cpu(sync_app.encode_png, image.data)
+    except Exception as e:
+        raise Exception(f"Cannot encode generated image: {str(e)}")
+    if uploader:
+        return await run_io(uploader.upload, image, "png", png_bytes, "image/png")
+    return await run_io(sync_app.upload_bytes_to_gcs, png_bytes)
+
+
+async def _store_with_limit(image):
+    async with resources.upload_semaphore:
+        return await store_generated_image(image)
+
+
+async def store_generated_images(images):
+    """Upload song song (giới hạn UPLOAD_CONCURRENCY), giữ thứ tự, trả về (urls, errors theo index)"""
+    results = await asyncio.gather(*(_store_with_limit(image) for image in images), return_exceptions=True)
+    return _collect_uploads(results)
+
+
+def _collect_uploads(results):
+    """Kết quả gather(return_exceptions=True) -> (urls, errors theo index)"""
+    public_urls = []
+    errors = []
+    for index, result in enumerate(results):
+        if isinstance(result, BaseException):
+            print(f"Image {index} failed: {result}")
+            errors.append({"index": index, "error": str(result)})
+        else:
+            public_urls.append(result)
+    return public_urls, errors
+
+
+async def store_image_bytes(images):
+    """Upload song song list ImagePayload nguyên bytes, giữ thứ tự; trả về (urls, errors theo index)"""
+    async def store(image):
+        async with resources.upload_semaphore:
+            return await run_io(sync_app.upload_image_bytes, image)
+
+    results = await asyncio.gather(*(store(image) for image in images), return_exceptions=True)
+    return _collect_uploads(results)
+
+
+async def generate_image_from_text(prompt, n):
+    with timed("generate"):
+        response = await sync_app.OPENAI_LIMITER.call_async(
+            resources.openai_client().images.generate,
+            model="gpt-image-1",
+            prompt=prompt,
+            size="1024x1024",
+            quality="auto",
+            n=n,
+        )
+    return await run_cpu(sync_app.images_from_base64, sync_app.response_b64_images(response))
+
+
+async def generate_image_with_reference(prompt, reference, n):
+    if reference is None or not sync_app.ROUTING_ENABLED:
+        return await generate_image(prompt, reference, n)
+    return await generate_images_routed("generate_image", "openai", prompt, n, [reference.data])
+
+
+# === Tạo ảnh qua PROVIDER_ROUTER (breaker + decision log dùng chung với app.py) ===
+async def openai_generate_images(prompt, n, references=()):
+    if references:
+        return await generate_image(prompt, ImagePayload(references[0], "jpeg"), n)
+    return await generate_image_from_text(prompt, n)
+
+
+async def _gemini_generate_with_references(prompt, n, references):
+    """Xem app._gemini_generate_with_references: không có Vertex -> model ảnh Gemini với inline image part"""
+    client = sync_app.PROVIDER_CLIENTS.gemini()
+    contents = sync_app._gemini_reference_contents(prompt, references)
+
+    async def generate_one():
+        return await sync_app.GEMINI_LIMITER.call_async(
+            client.aio.models.generate_content,
+            model=sync_app.GEMINI_REFERENCE_IMAGE_MODEL,
+            contents=contents,
+            config=sync_app._gemini_reference_config(),
+        )
+
+    with timed("generate"):
+        responses = await asyncio.gather(*(generate_one() for _ in range(n or 1)))
+    return [image for resp in responses for image in sync_app._gemini_content_images(resp)]
+
+
+async def imagen_generate_images(prompt, n, references=()):
+    edit_client = sync_app.PROVIDER_CLIENTS.gemini_edit() if references else None
+    if references and edit_client is None:
+        return await _gemini_generate_with_references(prompt, n, references)
+    if edit_client is not None:
+        with timed("generate"):
+            resp = await sync_app.GEMINI_LIMITER.call_async(
+                edit_client.aio.models.edit_image,
+                model=sync_app.GEMINI_EDIT_MODEL,
+                prompt=prompt,
+                reference_images=sync_app._gemini_style_references(references),
+                config=sync_app.genai_types.EditImageConfig(number_of_images=n or 1),
+            )
+    else:
+        with timed("generate"):
+            resp = await sync_app.GEMINI_LIMITER.call_async(
+                sync_app.PROVIDER_CLIENTS.gemini().aio.models.generate_images,
+                model=sync_app.GEMINI_IMAGE_MODEL,
+                prompt=prompt,
+                config=sync_app.genai_types.GenerateImagesConfig(number_of_images=n or 1),
+            )
+    return sync_app._gemini_images(resp)
+
+
+async def ideogram_image_urls(prompt, num_images, reference_files=()):
+    files_list = [(name, (None, value)) for name, value in sync_app._ideogram_form_fields(prompt, num_images)]
+    for filename, content, mimetype in reference_files[:3]:
+        files_list.append(("style_reference_images", (filename, content, mimetype)))
+
+    async def post():
+        r = await resources.http.post(
+            sync_app.IDEOGRAM_API_URL,
+            headers={"Api-Key": sync_app.IDEOGRAM_API_KEY},
+            files=files_list,
+            timeout=300,
+        )
+        r.raise_for_status()
+        return r
+
+    with timed("generate"):
+        r = await sync_app.IDEOGRAM_LIMITER.call_async(post)
+    return [item.get("url") for item in r.json().get("data", []) if item.get("url")]
+
+
+async def ideogram_generate_images(prompt, n, references=()):
+    urls = await ideogram_image_urls(prompt, n or 1, sync_app._ideogram_reference_files(references))
+    with timed("download"):
+        results = await asyncio.gather(*(_fetch_image_bytes(url) for url in urls))
+    return [ImagePayload(image_data) for _, image_data, _ in results]
+
+
+PROVIDER_IMAGE_GENERATORS = {
+    "openai": openai_generate_images,
+    "gemini": imagen_generate_images,
+    "ideogram": ideogram_generate_images,
+}
+
+
+async def generate_images_routed(route, primary, prompt, n, references=()):
+    if not sync_app.ROUTING_ENABLED:
+        return await PROVIDER_IMAGE_GENERATORS[primary](prompt, n, references)
+    attempts = [
+        (name, lambda generate=PROVIDER_IMAGE_GENERATORS[name]: generate(prompt, n, references))
+        for name in sync_app.PROVIDER_ROUTER.candidates(primary)
+    ]
+    return (await sync_app.PROVIDER_ROUTER.run_async(route, attempts))[1]
+
+
+async def ideogram_urls_routed(prompt, num_images, references=()):
+    ideogram = lambda: ideogram_image_urls(prompt, num_images, sync_app._ideogram_reference_files(references))
+    if not sync_app.ROUTING_ENABLED:
+        return await ideogram()
+
+    def stored(generate):
+        async def run():
+            public_urls, errors = await store_generated_images(await generate())
+            if not public_urls:
+                raise Exception(errors[0]["error"] if errors else "No image generated")
+            return public_urls
+        return run
+
+    attempts = [("ideogram", ideogram)] + [
+        (name, stored(lambda generate=PROVIDER_IMAGE_GENERATORS[name]: generate(prompt, int(num_images), references)))
+        for name in sync_app.PROVIDER_ROUTER.candidates("ideogram")[1:]
+    ]
+    return (await sync_app.PROVIDER_ROUTER.run_async("ideogram_generate", attempts))[1]
+
+
+# === Stream kết quả tạo ảnh (cùng format event với app.py) ===
+async def _stream_generation(fmt, generate, image_url=None):
+    """download (nếu có image_url) -> generate(reference) -> upload song song, yield event theo format"""
+    started = time.perf_counter()
+    pending = {}
+    try:
+        # Mỗi stage nhận kết quả stage trước: download -> ImagePayload -> generate -> list ImagePayload
+        stages = [("download", lambda _: download_image(image_url))] if image_url else []
+        stages.append(("generate", generate))
+        value = None
+        for stage, make_coro in stages:
+            stage_started = time.perf_counter()
+            yield encode_stream_event(fmt, "progress", {"stage": stage, "status": "started"})
+            task = asyncio.ensure_future(make_coro(value))
+            try:
+                while not (await asyncio.wait({task}, timeout=sync_app.STREAM_HEARTBEAT_SECONDS))[0]:
+                    yield encode_stream_heartbeat(fmt)
+            finally:
+                task.cancel()  # client ngắt kết nối -> hủy stage đang chạy
+            value = task.result()
+            yield encode_stream_event(fmt, "progress", {
+                "stage": stage, "status": "done", "elapsed": round(time.perf_counter() - stage_started, 3),
+            })
+        images = value
+
+        upload_started = time.perf_counter()
+        yield encode_stream_event(fmt, "progress", {"stage": "upload", "status": "started", "count": len(images)})
+        pending = {asyncio.ensure_future(_store_with_limit(image)): index for index, image in enumerate(images)}
+        results = {}
+        while pending:
+            done, _ = await asyncio.wait(pending, timeout=sync_app.STREAM_HEARTBEAT_SECONDS,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                yield encode_stream_heartbeat(fmt)
+            for task in done:
+                index = pending.pop(task)
+                elapsed = round(time.perf_counter() - started, 3)
+                try:
+                    results[index] = task.result()
+                except Exception as e:
+                    print(f"Image {index} failed: {e}")
+                    results[index] = e
+                    yield encode_stream_event(fmt, "image_error", {"index": index, "error": str(e), "elapsed": elapsed})
+                else:
+                    yield encode_stream_event(fmt, "image", {"index": index, "url": results[index], "elapsed": elapsed})
+        yield encode_stream_event(fmt, "progress", {
+            "stage": "upload", "status": "done", "elapsed": round(time.perf_counter() - upload_started, 3),
+        })
+
+        public_urls = [results[i] for i in sorted(results) if not isinstance(results[i], Exception)]
+        errors = [{"index": i, "error": str(results[i])} for i in sorted(results) if isinstance(results[i], Exception)]
+        body, status = sync_app._upload_result(public_urls, errors)
+    except ProviderOverloaded as e:
+        body, status = sync_app._overloaded_result(e)
+    except Exception as e:
+        body, status = {"success": False, "error": str(e)}, 500
+    finally:
+        for task in pending:
+            task.cancel()
+    if "error" in body:
+        yield encode_stream_event(fmt, "error", {**body, "status": status})
+    yield encode_stream_event(fmt, "done", {**body, "status": status, "elapsed": round(time.perf_counter() - started, 3)})
+
+
+def _stream_response(fmt, events):
+    mimetype = "text/event-stream" if fmt == "sse" else "application/x-ndjson"
+    response = Response(events, mimetype=mimetype, headers=sync_app.STREAM_HEADERS)
+    response.timeout = None  # stream dài hơn RESPONSE_TIMEOUT mặc định của Quart
+    return response
+
+
+# === Routes ===
+@app.route('/gen_prompt', methods=['POST'])
+async def generate_prompt_api():
+    data = await request.get_json()
+    image_url = data.get('image_url')
+    style = data.get('style_type')
+
+    if not image_url or not sync_app.validate_image_url(image_url):
+        return jsonify({"error": "Missing or invalid image_url"}), 400
+
+    vision_mode = data.get('vision_mode') or sync_app.VISION_PREP_MODE
+    if vision_mode not in sync_app.VISION_MODES:
+        return jsonify({"error": f"vision_mode must be one of {', '.join(sync_app.VISION_MODES)}"}), 400
+
+    bypass_cache = bool(data.get('bypass_cache'))
+    refresh_cache = bool(data.get('refresh_cache'))
+    cache = sync_app.PROMPT_RESULT_CACHE if not bypass_cache else None
+
+    try:
+        image = await download_image(image_url)
+        style_key = "2D" if style == "2D" else "3D"
+        content_key = PromptResultCache.make_key(image, style_key, vision_mode)
+
+        if cache and not refresh_cache:
+            cached_prompt = await run_io(cache.get, content_key)
+            if cached_prompt is not None:
+                print(f"Prompt cache hit: {content_key}")
+                return jsonify({"prompt": cached_prompt, "cached": True}), 200
+
+        async def analyze():
+            image_description = await describe_image_with_gpt4o(image, style_key, vision_mode)
+            dalle_prompt = await generate_dalle_prompt(image_description)
+            if cache:
+                await run_io(cache.put, content_key, dalle_prompt)
+            return dalle_prompt
+
+        dalle_prompt = await PROMPT_FLIGHT.do(content_key, analyze)
+        return jsonify({"prompt": dalle_prompt, "cached": False}), 200
+    except ProviderOverloaded as e:
+        body, status = sync_app._overloaded_result(e)
+        return jsonify(body), status
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+@app.route('/generate_image', methods=['POST'])
+async def generate_image_api():
+    data = await request.get_json()
+    prompt = data.get('prompt')
+    image_url = data.get('image_url')
+    n = data.get('image_count')
+
+    try:
+        fmt = stream_format(data, request.args, request.accept_mimetypes)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    error = sync_app._generate_image_request_error(data)
+    if error:
+        return jsonify(error), 400
+
+    async def generate(reference):
+        return await generate_image_with_reference(prompt, reference, n)
+
+    if fmt:
+        return _stream_response(fmt, _stream_generation(fmt, generate, image_url))
+
+    async def pipeline():
+        try:
+            reference = await download_image(image_url) if image_url else None
+            images = await generate(reference)
+            public_urls, errors = await store_generated_images(images)
+            return sync_app._upload_result(public_urls, errors)
+        except ProviderOverloaded as e:
+            return sync_app._overloaded_result(e)
+        except Exception as e:
+            return {"success": False, "error": str(e)}, 500
+
+    if sync_app.SINGLEFLIGHT_GENERATION:
+        key = sync_app._flight_key("generate_image", prompt, image_url, n)
+        body, status = await GENERATION_FLIGHT.do(key, pipeline)
+    else:
+        body, status = await pipeline()
+    return jsonify(body), status
+
+
+@app.route('/generate_image_from_prompt', methods=['POST'])
+async def generate_image_from_prompt():
+    try:
+        data = await request.get_json()
+        prompt = data.get("prompt")
+        n = data.get('image_count')
+        if not prompt:
+            return jsonify({"error": "Missing prompt"}), 400
+        fmt = stream_format(data, request.args, request.accept_mimetypes)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    if fmt:
+        return _stream_response(fmt, _stream_generation(
+            fmt, lambda _: generate_images_routed("generate_image_from_prompt", "openai", prompt, n)))
+
+    async def pipeline():
+        try:
+            images = await generate_images_routed("generate_image_from_prompt", "openai", prompt, n)
+            public_urls, errors = await store_generated_images(images)
+            return sync_app._upload_result(public_urls, errors)
+        except ProviderOverloaded as e:
+            return sync_app._overloaded_result(e)
+        except Exception as e:
+            return {"error": str(e)}, 500
+
+    if sync_app.SINGLEFLIGHT_GENERATION:
+        key = sync_app._flight_key("generate_image_from_prompt", prompt, n)
+        body, status = await GENERATION_FLIGHT.do(key, pipeline)
+    else:
+        body, status = await pipeline()
+    return jsonify(body), status
+
+
+async def _read_cropped_image():
+    """Body image/*, multipart hoặc JSON base64 -> bytes ảnh (xem app._read_cropped_image)"""
+    max_bytes = sync_app.UPLOAD_CROPPED_MAX_BYTES
+    kind = sync_app.uploaded_image_kind(request.mimetype)
+    if kind == "json":
+        data = await request.get_json(silent=True) or {}
+        return sync_app.decode_image_base64(data.get("image_base64", ""))
+
+    if kind == "raw":
+        try:
+            reader = ImageBodyReader(request.headers, max_bytes=max_bytes)
+            async for chunk in request.body:
+                reader.feed(chunk)
+            return reader.finish()
+        except (ImageTooLargeError, RequestEntityTooLarge):
+            raise
+        except Exception as e:
+            raise UploadRejected(str(e))
+
+    files = await request.files
+    upload = files.get("image") or next(iter(files.values()), None)
+    if upload is None:
+        raise UploadRejected("Missing image file part")
+    return await run_io(sync_app._read_image_stream, upload.headers, upload.stream.read, max_bytes)
+
+
+@app.route("/upload_cropped_image", methods=["POST"])
+async def upload_cropped_image():
+    try:
+        image_data = await _read_cropped_image()
+        record_bytes("upload_body", len(image_data))
+        async with resources.upload_semaphore:
+            public_url = await store_generated_image(ImagePayload(image_data))
+        return jsonify({"url": public_url})
+    except UploadRejected as e:
+        return jsonify({"error": str(e)}), e.status
+    except (ImageTooLargeError, RequestEntityTooLarge):
+        return jsonify({"error": f"Image too large (limit {sync_app.UPLOAD_CROPPED_MAX_BYTES} bytes)"}), 413
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/ideogram/generate", methods=["POST"])
+async def ideogram_generate():
+    try:
+        image_reference_urls = []
+        uploaded_files = []
+
+        if request.is_json:
+            data = await request.get_json(force=True)
+            prompt = data.get("prompt")
+            num_images = data.get("num_images")
+            image_reference_urls = data.get("image_references", []) or []
+        else:
+            form = await request.form
+            files = await request.files
+            prompt = form.get("prompt")
+            num_images = form.get("image_count")
+            uploaded_files = [(f.filename, f.read(), f.mimetype) for f in files.getlist("image_reference_images")[:3]]
+
+        if not prompt or not num_images:
+            return jsonify({"error": "prompt and num_images are required"}), 400
+
+        if uploaded_files:
+            image_urls = await ideogram_image_urls(prompt, num_images, uploaded_files)
+        else:
+            references = await fetch_reference_images(image_reference_urls) if image_reference_urls else []
+            image_urls = await ideogram_urls_routed(prompt, num_images, references)
+        return jsonify({"images": image_urls})
+
+    except ReferenceFetchError as e:
+        return jsonify({"error": "Cannot fetch image references", "detail": e.errors}), 400
+    except ProviderOverloaded as e:
+        body, status = sync_app._overloaded_result(e)
+        return jsonify(body), status
+    except httpx.HTTPStatusError as e:
+        try:
+            detail = e.response.json()
+        except Exception:
+            detail = e.response.text
+        return jsonify({"error": "Ideogram API error", "detail": detail}), e.response.status_code
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/gemini/generate", methods=["POST"])
+async def gemini_generate():
+    try:
+        if not request.is_json:
+            return jsonify({"error": "Content-Type must be application/json"}), 400
+
+        data = await request.get_json(force=True)
+        prompt = data.get("prompt")
+        num_images = int(data.get("num_images", 1))
+
+        image_reference_urls = data.get("image_references") or []
+        if not image_reference_urls and data.get("image_url"):
+            image_reference_urls = [data["image_url"]]
+
+        if not prompt or num_images < 1:
+            return jsonify({"error": "prompt and num_images are required"}), 400
+        try:
+            response_mode = sync_app.gemini_response_mode(data, request.args, request.accept_mimetypes)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        references = await fetch_reference_images(image_reference_urls) if image_reference_urls else []
+        images = await generate_images_routed("gemini_generate", "gemini", prompt, num_images, references)
+        if response_mode == "multipart":
+            boundary = uuid.uuid4().hex
+            return Response(
+                sync_app.multipart_mixed_parts(images, boundary),
+                content_type=f"multipart/mixed; boundary={boundary}",
+                headers={"X-Image-Count": str(len(images))},
+            )
+        if response_mode == "url":
+            body, status = sync_app._gemini_url_result(*await store_image_bytes(images))
+            return jsonify(body), status
+        # base64 ảnh lớn tốn CPU -> làm ngoài event loop
+        out = await run_cpu(sync_app._gemini_data_urls, images)
+        return jsonify({"images": out})
+
+    except ReferenceFetchError as e:
+        return jsonify({"error": "Cannot fetch image references", "detail": e.errors}), 400
+    except ProviderOverloaded as e:
+        body, status = sync_app._overloaded_result(e)
+        return jsonify(body), status
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/stats", methods=["GET"])
+async def stats():
+    return jsonify({
+        "mode": "async",
+        "reference_image_cache": sync_app.REFERENCE_IMAGE_CACHE.stats() if sync_app.REFERENCE_IMAGE_CACHE else None,
+        "single_flight": {
+            flight.name: flight.stats() for flight in (DOWNLOAD_FLIGHT, PROMPT_FLIGHT, GENERATION_FLIGHT)
+        },
+        "provider_limits": {limiter.name: limiter.stats() for limiter in sync_app.PROVIDER_LIMITERS},
+        "gcs_dedup": sync_app.GCS_DEDUP_UPLOADER.stats() if sync_app.GCS_DEDUP_UPLOADER else None,
+        "routing": {"enabled": sync_app.ROUTING_ENABLED, "breakers": sync_app.PROVIDER_ROUTER.stats()},
+    })
+
+
+@app.route("/routing/decisions", methods=["GET"])
+async def routing_decisions():
+    limit = request.args.get("limit", default=100, type=int)
+    decisions = sync_app.ROUTING_DECISIONS.recent(limit, request.args.get("route"), request.args.get("provider"))
+    return jsonify({"decisions": decisions})
+
+
+METRICS.register_collector(lambda: sync_app._stats_families(
+    "app_async_single_flight",
+    {flight.name: flight.stats() for flight in (DOWNLOAD_FLIGHT, PROMPT_FLIGHT, GENERATION_FLIGHT)},
+    "flight",
+    counters=("executed", "collapsed", "cancelled"),
+))
+
+
+@app.route("/metrics", methods=["GET"])
+async def metrics():
+    return Response(METRICS.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.before_request
+async def _start_request_metrics():
+    g.request_started = time.perf_counter()
+    CURRENT_ENDPOINT.set(request.url_rule.rule if request.url_rule else "unmatched")
+
+
+@app.after_request
+async def _record_request_metrics(response):
+    started = getattr(g, "request_started", None)
+    if started is not None:
+        METRICS.observe("app_http_request_duration_seconds", time.perf_counter() - started,
+                        endpoint=CURRENT_ENDPOINT.get(), method=request.method, status=str(response.status_code))
+    return response
+
+
+@app.after_request
+async def _add_retry_after_header(response):
+    if response.status_code == 503 and response.is_json and "Retry-After" not in response.headers:
+        body = await response.get_json()
+        if isinstance(body, dict) and body.get("retry_after"):
+            response.headers["Retry-After"] = str(math.ceil(body["retry_after"]))
+    return response
+
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,86 @@
+"""So sánh pipeline lưu ảnh generate: đường cũ (PIL -> file PNG -> đọc lại để upload)
+với đường in-memory mới (encode_generated_image -> upload từ buffer).
+
+Upload GCS được thay bằng thao tác đọc bytes để chỉ đo phần encode/IO local.
+
+Chạy từ thư mục gốc repo:
+    python bench/bench_encode.py --iterations 20
+"""
+import argparse
+import base64
+import io
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # noqa: E402
+
+import app  # noqa: E402
+
+
+def make_sample(mode, size=1024):
+    """Ảnh giả lập output của provider: gradient + noise, PNG, base64"""
+    noise = Image.effect_noise((size, size), 40).convert("L")
+    gradient = Image.linear_gradient("L").resize((size, size))
+    channels = [gradient, noise, gradient.transpose(Image.Transpose.ROTATE_90)]
+    if mode == "RGBA":
+        channels.append(Image.new("L", (size, size), 200))
+    image = Image.merge(mode, channels)
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+
+def legacy_disk_path(b64_data, folder):
+    """Bản sao đường xử lý cũ: luôn decode + làm phẳng + optimize PNG ra đĩa rồi đọc lại"""
+    filepath = os.path.join(folder, app._generated_filename())
+    image = Image.open(io.BytesIO(base64.b64decode(b64_data)))
+    if image.mode in ("RGBA", "P"):
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        if image.mode == "RGBA":
+            background.paste(image, mask=image.split()[-1])
+        else:
+            background.paste(image)
+        image = background
+    image.save(filepath, format="PNG", quality=95, optimize=True)
+    with open(filepath, "rb") as f:
+        data = f.read()
+    os.remove(filepath)
+    return data
+
+
+def memory_path(b64_data, folder):
+    return app.encode_generated_image(b64_data)
+
+
+def run(fn, b64_data, iterations, folder):
+    timings = []
+    size = 0
+    for _ in range(iterations):
+        start = time.perf_counter()
+        size = len(fn(b64_data, folder))
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings), max(timings), size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--size", type=int, default=1024)
+    args = parser.parse_args()
+
+    print(f"{'input':<8} {'path':<8} {'median ms':>10} {'max ms':>10} {'bytes':>10}")
+    with tempfile.TemporaryDirectory() as folder:
+        for mode in ("RGB", "RGBA"):
+            sample = make_sample(mode, args.size)
+            for name, fn in (("legacy", legacy_disk_path), ("memory", memory_path)):
+                median, worst, size = run(fn, sample, args.iterations, folder)
+                print(f"{mode:<8} {name:<8} {median:>10.1f} {worst:>10.1f} {size:>10}")
+
+
+if __name__ == "__main__":
+    main()
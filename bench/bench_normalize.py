@@ -0,0 +1,97 @@
+"""Micro-benchmark chuẩn hóa ảnh tham chiếu (_normalize_reference_image)
+so với cách cũ (decode toàn bộ -> RGB -> LANCZOS -> JPEG optimize).
+
+Chạy từ thư mục gốc repo:
+    python bench/bench_normalize.py --iterations 5
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # noqa: E402
+
+import app  # noqa: E402
+
+# (tên, kích thước, format, mode) - các loại input hay gặp
+SAMPLES = [
+    ("small jpeg", (800, 800), "JPEG", "RGB"),
+    ("design png", (1600, 1600), "PNG", "RGBA"),
+    ("phone jpeg", (4032, 3024), "JPEG", "RGB"),
+    ("48mp jpeg", (8064, 6048), "JPEG", "RGB"),
+]
+
+
+def make_sample(size, fmt, mode):
+    width, height = size
+    noise = Image.effect_noise(size, 30).convert("L")
+    gradient = Image.linear_gradient("L").resize(size)
+    channels = [gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)]
+    if mode == "RGBA":
+        channels.append(Image.linear_gradient("L").resize(size))
+    image = Image.merge(mode, channels)
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt, quality=92)
+    return buffer.getvalue()
+
+
+def legacy_normalize(image_data):
+    """Bản sao logic cũ trong download_image"""
+    image = Image.open(io.BytesIO(image_data))
+    if image.mode != "RGB":
+        if image.mode == "RGBA":
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.split()[-1])
+            image = background
+        else:
+            image = image.convert("RGB")
+    max_size = 2048
+    if image.size[0] > max_size or image.size[1] > max_size:
+        image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=85, optimize=True)
+    return buffer.getvalue()
+
+
+def measure(fn, data, iterations):
+    timings = []
+    size = 0
+    for _ in range(iterations):
+        start = time.perf_counter()
+        size = len(fn(data))
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings), size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=5)
+    args = parser.parse_args()
+
+    # Log của app.py không cần thiết khi đo
+    sys.stdout, real_stdout = open(os.devnull, "w"), sys.stdout
+    try:
+        rows = []
+        for name, size, fmt, mode in SAMPLES:
+            data = make_sample(size, fmt, mode)
+            legacy_ms, legacy_bytes = measure(legacy_normalize, data, args.iterations)
+            new_ms, new_bytes = measure(app._normalize_reference_image, data, args.iterations)
+            rows.append((name, len(data), legacy_ms, legacy_bytes, new_ms, new_bytes))
+    finally:
+        sys.stdout.close()
+        sys.stdout = real_stdout
+
+    print(f"{'input':<12} {'in bytes':>10} {'legacy ms':>10} {'legacy out':>11} {'new ms':>8} {'new out':>9} {'speedup':>8}")
+    for name, in_bytes, legacy_ms, legacy_bytes, new_ms, new_bytes in rows:
+        print(
+            f"{name:<12} {in_bytes:>10} {legacy_ms:>10.1f} {legacy_bytes:>11} "
+            f"{new_ms:>8.1f} {new_bytes:>9} {legacy_ms / new_ms:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
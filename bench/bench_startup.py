@@ -0,0 +1,136 @@
+"""Đo thời gian khởi động và bộ nhớ của app.
+
+- import: thời gian `import app` và RSS sau import trong process mới (trung vị qua nhiều lần)
+- gunicorn: khởi động gunicorn với gunicorn.conf.py, đo thời gian tới khi /health trả lời,
+  RSS và bộ nhớ riêng (USS, không chia sẻ copy-on-write với master) của từng worker
+
+Chạy từ thư mục gốc repo:
+    python bench/bench_startup.py --runs 5
+    python bench/bench_startup.py --gunicorn --workers 2
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import requests
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SNIPPET = """
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter() - started
+warm = None
+if {warm_up}:
+    started = time.perf_counter()
+    app.warm_up()
+    warm = time.perf_counter() - started
+rss = 0
+with open("/proc/self/status") as f:
+    for line in f:
+        if line.startswith("VmRSS:"):
+            rss = int(line.split()[1])
+print(json.dumps({{"import": imported, "warm_up": warm, "rss_kb": rss}}))
+"""
+
+
+def _memory_kb(pid):
+    """(RSS, USS) của 1 process: USS = Private_Clean + Private_Dirty"""
+    rss = uss = 0
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                name, _, rest = line.partition(":")
+                if name == "Rss":
+                    rss = int(rest.split()[0])
+                elif name in ("Private_Clean", "Private_Dirty"):
+                    uss += int(rest.split()[0])
+    except OSError:
+        pass
+    return rss, uss
+
+
+def _children(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def bench_import(runs, warm_up):
+    results = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_SNIPPET.format(warm_up=warm_up)],
+            cwd=REPO_ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip().splitlines()[-1]
+        results.append(json.loads(output))
+    summary = {
+        "import_seconds": round(statistics.median(r["import"] for r in results), 3),
+        "rss_mb": round(statistics.median(r["rss_kb"] for r in results) / 1024, 1),
+    }
+    if warm_up:
+        summary["warm_up_seconds"] = round(statistics.median(r["warm_up"] for r in results), 3)
+    return summary
+
+
+def bench_gunicorn(workers, timeout):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    env = {**os.environ, "PORT": str(port), "WEB_CONCURRENCY": str(workers)}
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--bind", f"127.0.0.1:{port}", "app:app"],
+        cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        ready = None
+        while time.perf_counter() - started < timeout:
+            try:
+                requests.get(f"http://127.0.0.1:{port}/health", timeout=1)
+                ready = time.perf_counter() - started
+                break
+            except requests.RequestException:
+                time.sleep(0.05)
+        # Đợi đủ worker được fork
+        deadline = time.perf_counter() + timeout
+        while len(_children(process.pid)) < workers and time.perf_counter() < deadline:
+            time.sleep(0.1)
+        time.sleep(0.5)
+        master_rss, master_uss = _memory_kb(process.pid)
+        worker_memory = [_memory_kb(pid) for pid in _children(process.pid)]
+        return {
+            "ready_seconds": round(ready, 3) if ready is not None else None,
+            "master_rss_mb": round(master_rss / 1024, 1),
+            "master_uss_mb": round(master_uss / 1024, 1),
+            "workers": [{"rss_mb": round(rss / 1024, 1), "uss_mb": round(uss / 1024, 1)} for rss, uss in worker_memory],
+        }
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--gunicorn", action="store_true", help="Đo thêm gunicorn (preload + warm-up theo gunicorn.conf.py)")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    print("import app:", bench_import(args.runs, warm_up=False))
+    print("import app + warm_up:", bench_import(args.runs, warm_up=True))
+    if args.gunicorn:
+        print("gunicorn:", bench_gunicorn(args.workers, args.timeout))
+
+
+if __name__ == "__main__":
+    main()
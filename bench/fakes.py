@@ -0,0 +1,334 @@
+"""Fake server cho OpenAI, Ideogram, Gemini (Imagen), GCS và 1 image host để benchmark app.py
+mà không tốn tiền gọi provider thật.
+
+Mỗi service chạy trên 1 port riêng (HTTP/1.1 keep-alive) với độ trễ và tỉ lệ lỗi cấu hình được.
+Chạy độc lập (in ra biến môi trường cần đặt cho app):
+    python bench/fakes.py --latency openai=1.5,ideogram=2 --error-rate openai=0.05 --error-status 429
+
+Hoặc để bench/load.py tự khởi động.
+"""
+import argparse
+import base64
+import io
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+from PIL import Image
+
+SERVICES = ("openai", "ideogram", "gemini", "gcs", "images")
+
+# Độ trễ mặc định (giây) gần với thời gian thật của từng provider
+DEFAULT_LATENCY = {"openai": 1.0, "ideogram": 1.5, "gemini": 1.5, "gcs": 0.05, "images": 0.05}
+
+
+class FakeConfig:
+    """Độ trễ (trung bình + jitter) và lỗi giả lập cho 1 service"""
+
+    def __init__(self, latency=0.0, jitter=0.2, error_rate=0.0, error_status=500, retry_after=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+
+    def delay(self):
+        if self.latency > 0:
+            time.sleep(max(0.0, random.gauss(self.latency, self.latency * self.jitter)))
+
+    def should_fail(self):
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+
+def _make_image(width, height, fmt, mode="RGB"):
+    """Ảnh noise (khó nén, gần với ảnh thật) encode sẵn 1 lần"""
+    noise = Image.effect_noise((width, height), 60).convert("L")
+    gradient = Image.linear_gradient("L").resize((width, height))
+    channels = [gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)]
+    if mode == "RGBA":
+        channels.append(Image.new("L", (width, height), 220))
+    buffer = io.BytesIO()
+    Image.merge(mode, channels).save(buffer, format=fmt, quality=90)
+    return buffer.getvalue()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    service = None
+    config = None
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send(self, status, body=b"", content_type="application/json", headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method):
+        body = self._body()
+        self.config.delay()
+        with self.state["lock"]:
+            self.state["requests"] += 1
+        if self.config.should_fail():
+            with self.state["lock"]:
+                self.state["errors"] += 1
+            headers = {}
+            if self.config.error_status in (429, 503):
+                headers["Retry-After"] = str(self.config.retry_after)
+            return self._send(self.config.error_status, {"error": {"message": "injected error"}}, headers=headers)
+        return getattr(self, f"_{self.service}")(method, urlparse(self.path), body)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PATCH(self):
+        self._handle("PATCH")
+
+    # ---- OpenAI: chat completions + images edit/generate ----
+    def _openai(self, method, url, body):
+        if url.path.endswith("/chat/completions"):
+            return self._send(200, {
+                "id": "chatcmpl-bench",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": "gpt-4o",
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "A detailed bench description of the image."},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": 900, "completion_tokens": 120, "total_tokens": 1020},
+            })
+        if url.path.endswith("/images/edits") or url.path.endswith("/images/generations"):
+            if url.path.endswith("/generations"):
+                n = json.loads(body or b"{}").get("n") or 1
+            else:
+                match = re.search(rb'name="n"\r\n\r\n(\d+)', body)
+                n = int(match.group(1)) if match else 1
+            b64 = self.state["generated_b64"]
+            return self._send(200, {"created": int(time.time()), "data": [{"b64_json": b64} for _ in range(n)]})
+        return self._send(404, {"error": {"message": f"unknown path {url.path}"}})
+
+    # ---- Ideogram v3 generate (multipart) ----
+    def _ideogram(self, method, url, body):
+        match = re.search(rb'name="num_images"\r\n\r\n(\d+)', body)
+        n = int(match.group(1)) if match else 1
+        image_url = f"{self.state['images_url']}/img/ideogram-{random.getrandbits(32)}.png"
+        return self._send(200, {"created": time.time(), "data": [{"url": image_url, "prompt": "bench"} for _ in range(n)]})
+
+    # ---- Gemini / Imagen: models/*:predict (Imagen) + models/*:generateContent (model ảnh Gemini) ----
+    def _gemini(self, method, url, body):
+        if url.path.endswith(":generateContent"):
+            part = {"inlineData": {"mimeType": "image/png", "data": self.state["generated_b64"]}}
+            return self._send(200, {"candidates": [{"content": {"role": "model", "parts": [part]}, "finishReason": "STOP"}]})
+        if not url.path.endswith(":predict"):
+            return self._send(404, {"error": {"message": f"unknown path {url.path}"}})
+        payload = json.loads(body or b"{}")
+        n = (payload.get("parameters") or {}).get("sampleCount") or 1
+        b64 = self.state["generated_b64"]
+        return self._send(200, {"predictions": [{"bytesBase64Encoded": b64, "mimeType": "image/png"} for _ in range(n)]})
+
+    # ---- GCS JSON API: upload multipart (ifGenerationMatch=0), PATCH acl (make_public), GET metadata ----
+    def _gcs(self, method, url, body):
+        match = re.match(r"^(?:/upload)?/storage/v1/b/([^/]+)/o(?:/(.+))?$", url.path)
+        if not match:
+            return self._send(404, {"error": {"message": f"unknown path {url.path}"}})
+        bucket, name = match.group(1), unquote(match.group(2) or "")
+        objects = self.state["objects"]
+        if name.endswith("/acl"):
+            # make_public() đọc ACL hiện tại trước khi PATCH
+            return self._send(200, {"kind": "storage#objectAccessControls", "items": []})
+
+        if method == "POST":
+            query = parse_qs(url.query)
+            name = (query.get("name") or [""])[0]
+            if not name:
+                # uploadType=multipart: tên object nằm trong part metadata JSON đầu tiên
+                meta = re.search(rb"\r\n\r\n(\{.*?\})\r\n", body, re.S)
+                name = json.loads(meta.group(1)).get("name", "") if meta else ""
+            # ifGenerationMatch=0: chỉ ghi khi object chưa tồn tại (upload theo nội dung)
+            only_if_missing = (query.get("ifGenerationMatch") or [""])[0] == "0"
+            with self.state["lock"]:
+                exists = (bucket, name) in objects
+                if not (only_if_missing and exists):
+                    generation = self.state["generation"] = self.state["generation"] + 1
+                    objects[(bucket, name)] = {"size": len(body), "generation": generation}
+                    self.state["uploaded_bytes"] += len(body)
+            if only_if_missing and exists:
+                return self._send(412, {"error": {"code": 412, "message": "Precondition failed"}})
+        elif (bucket, name) not in objects:
+            return self._send(404, {"error": {"code": 404, "message": "No such object"}})
+
+        resource = {
+            "kind": "storage#object",
+            "bucket": bucket,
+            "name": name,
+            "id": f"{bucket}/{name}",
+            "generation": str(objects[(bucket, name)]["generation"]),
+            "size": str(objects[(bucket, name)]["size"]),
+            "contentType": "image/png",
+        }
+        if method == "PATCH":
+            resource["acl"] = json.loads(body or b"{}").get("acl", [])
+        return self._send(200, resource)
+
+    # ---- Image host: /img/<key>.(jpg|png) ----
+    def _images(self, method, url, body):
+        key = url.path.rsplit("/", 1)[-1]
+        if key.endswith(".png"):
+            return self._send(200, self.state["host_png"], content_type="image/png")
+        # Comment segment chứa key ngay sau SOI -> mỗi URL là 1 ảnh khác hash (không dính cache theo nội dung)
+        comment = key.encode("utf-8")[:200]
+        jpeg = self.state["host_jpeg"]
+        data = jpeg[:2] + b"\xff\xfe" + (len(comment) + 2).to_bytes(2, "big") + comment + jpeg[2:]
+        return self._send(200, data, content_type="image/jpeg", headers={"ETag": f'"{key}"'})
+
+
+class FakeProviders:
+    """Khởi động toàn bộ fake server trong thread nền của process hiện tại"""
+
+    def __init__(self, configs=None, host="127.0.0.1", host_image_size=(2400, 1600), generated_size=1024,
+                 generated_mode="RGB"):
+        self.host = host
+        self.configs = {name: (configs or {}).get(name) or FakeConfig(DEFAULT_LATENCY[name]) for name in SERVICES}
+        self.state = {
+            "lock": threading.Lock(),
+            "requests": 0,
+            "errors": 0,
+            "objects": {},
+            "generation": 0,
+            "uploaded_bytes": 0,
+            "generated_b64": base64.b64encode(
+                _make_image(generated_size, generated_size, "PNG", generated_mode)
+            ).decode("ascii"),
+            "host_jpeg": _make_image(*host_image_size, "JPEG"),
+            "host_png": _make_image(512, 512, "PNG"),
+        }
+        self.servers = {}
+        self.urls = {}
+
+    def start(self):
+        for name in SERVICES:
+            handler = type(f"{name.title()}Handler", (_Handler,), {
+                "service": name, "config": self.configs[name], "state": {**self.state, "lock": threading.Lock()},
+            })
+            server = ThreadingHTTPServer((self.host, 0), handler)
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name=f"fake-{name}", daemon=True).start()
+            self.servers[name] = server
+            self.urls[name] = f"http://{self.host}:{server.server_address[1]}"
+        for server in self.servers.values():
+            server.RequestHandlerClass.state["images_url"] = self.urls["images"]
+        return self
+
+    def stop(self):
+        for server in self.servers.values():
+            server.shutdown()
+            server.server_close()
+
+    def image_url(self, key, ext="jpg"):
+        return f"{self.urls['images']}/img/{key}.{ext}"
+
+    def counters(self):
+        return {
+            name: {
+                "requests": server.RequestHandlerClass.state["requests"],
+                "errors": server.RequestHandlerClass.state["errors"],
+            }
+            for name, server in self.servers.items()
+        }
+
+    def app_env(self):
+        """Biến môi trường trỏ app.py vào các fake server"""
+        return {
+            "OPENAI_API_KEY": "bench",
+            "OPENAI_BASE_URL": f"{self.urls['openai']}/v1",
+            "IDEOGRAM_API_KEY": "bench",
+            "IDEOGRAM_API_URL": f"{self.urls['ideogram']}/v1/ideogram-v3/generate",
+            "GEMINI_API_KEY": "bench",
+            "GEMINI_BASE_URL": self.urls["gemini"],
+            # Imagen predict (generate_images / edit_image) đi qua đường Vertex ở mọi bản google-genai
+            "GOOGLE_GENAI_USE_VERTEXAI": "true",
+            "GCS_API_ENDPOINT": self.urls["gcs"],
+            "GCS_BUCKET_NAME": "bench-bucket",
+        }
+
+
+def parse_service_values(value, cast=float):
+    """'openai=1.5,gcs=0.1' -> {"openai": 1.5, "gcs": 0.1}"""
+    result = {}
+    for part in (value or "").split(","):
+        if "=" not in part:
+            continue
+        name, raw = part.split("=", 1)
+        name = name.strip()
+        if name not in SERVICES:
+            raise ValueError(f"Unknown service {name!r} (expected one of {', '.join(SERVICES)})")
+        result[name] = cast(raw)
+    return result
+
+
+def add_fake_arguments(parser):
+    parser.add_argument("--latency", default="", help="Độ trễ trung bình theo service, vd openai=1.5,gcs=0.05")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Độ lệch chuẩn tương đối của độ trễ")
+    parser.add_argument("--error-rate", default="", help="Tỉ lệ lỗi theo service, vd openai=0.05")
+    parser.add_argument("--error-status", type=int, default=500, help="HTTP status của lỗi giả lập (429/503 kèm Retry-After)")
+    parser.add_argument("--retry-after", type=int, default=1, help="Giá trị Retry-After (giây) cho lỗi 429/503")
+    parser.add_argument("--generated-mode", choices=("RGB", "RGBA"), default="RGB",
+                        help="Mode PNG provider trả về (RGBA buộc app làm phẳng + encode lại)")
+
+
+def configs_from_args(args):
+    latency = {**DEFAULT_LATENCY, **parse_service_values(args.latency)}
+    error_rate = parse_service_values(args.error_rate)
+    return {
+        name: FakeConfig(
+            latency=latency[name],
+            jitter=args.jitter,
+            error_rate=error_rate.get(name, 0.0),
+            error_status=args.error_status,
+            retry_after=args.retry_after,
+        )
+        for name in SERVICES
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_fake_arguments(parser)
+    args = parser.parse_args()
+
+    fakes = FakeProviders(configs_from_args(args), generated_mode=args.generated_mode).start()
+    for name, url in fakes.urls.items():
+        print(f"# {name}: {url}")
+    for key, value in fakes.app_env().items():
+        print(f"export {key}={value}")
+    print(f"# sample image: {fakes.image_url('sample')}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fakes.stop()
+
+
+if __name__ == "__main__":
+    main()
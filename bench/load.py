@@ -0,0 +1,404 @@
+"""Load test app.py (hoặc app_async.py) với provider giả lập từ bench/fakes.py.
+
+Khởi động fake server, chạy app trong process con trỏ tới các fake đó, bắn request song song
+vào từng route và in p50/p95/p99, throughput, tỉ lệ lỗi và RSS của process app.
+
+Chạy từ thư mục gốc repo:
+    python bench/load.py --requests 100 --concurrency 16
+    python bench/load.py --routes gen_prompt,generate_image --latency openai=2 --error-rate openai=0.1 --error-status 429
+    python bench/load.py --routes generate_image --image-count 4 --stream ndjson --json stream.json --compare buffered.json
+    python bench/load.py --app-cmd "hypercorn app_async:app --bind {host}:{port}" --json after.json --compare before.json
+
+--target http://host:port để bắn vào app đang chạy sẵn (app phải tự trỏ tới fake: xem python bench/fakes.py).
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import shlex
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeProviders, add_fake_arguments, configs_from_args  # noqa: E402
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_APP_CMD = f"{sys.executable} -c \"import app; app.app.run(host='{{host}}', port={{port}}, threaded=True)\""
+
+
+def _cropped_png():
+    buffer = io.BytesIO()
+    Image.effect_noise((512, 512), 60).convert("RGB").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class RequestBody:
+    """Body không phải JSON (vd ảnh thô / multipart): kwargs truyền thẳng cho requests.post"""
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+
+class Scenarios:
+    """Payload cho từng route; key đổi theo i để không dính cache / single-flight (trừ khi --repeat)"""
+
+    def __init__(self, fakes, repeat, batch_size, image_count=1, stream=None, gemini_response_mode=None,
+                 upload_format="json"):
+        self.fakes = fakes
+        self.repeat = repeat
+        self.batch_size = batch_size
+        self.image_count = image_count
+        self.stream = stream
+        self.gemini_response_mode = gemini_response_mode
+        self.cropped = _cropped_png()
+        self.cropped_b64 = "data:image/png;base64," + base64.b64encode(self.cropped).decode("ascii")
+        self.upload_format = upload_format
+        self.run_id = f"{int(time.time())}-{os.getpid()}"
+
+    def _key(self, i):
+        return "same" if self.repeat else f"{self.run_id}-{i}"
+
+    def _image(self, i):
+        return self.fakes.image_url(self._key(i))
+
+    def build(self, route, i):
+        key = self._key(i)
+        if route == "gen_prompt":
+            return "/gen_prompt", {"image_url": self._image(i), "style_type": "2D"}
+        if route == "gen_prompt_batch":
+            items = [{"image_url": self.fakes.image_url(f"{key}-{j}")} for j in range(self.batch_size)]
+            return "/gen_prompt/batch", {"items": items, "style_type": "3D"}
+        if route == "generate_image":
+            return "/generate_image", self._generation({"prompt": f"bench {key}", "image_url": self._image(i)})
+        if route == "generate_image_from_prompt":
+            return "/generate_image_from_prompt", self._generation({"prompt": f"bench {key}"})
+        if route == "upload_cropped_image":
+            if self.upload_format == "raw":
+                return "/upload_cropped_image", RequestBody(data=self.cropped, headers={"Content-Type": "image/png"})
+            if self.upload_format == "multipart":
+                return "/upload_cropped_image", RequestBody(files={"image": ("crop.png", self.cropped, "image/png")})
+            return "/upload_cropped_image", {"image_base64": self.cropped_b64}
+        if route == "ideogram":
+            return "/ideogram/generate", {"prompt": f"bench {key}", "num_images": 1, "image_references": [self._image(i)]}
+        if route == "gemini":
+            payload = {"prompt": f"bench {key}", "num_images": self.image_count, "image_references": [self._image(i)]}
+            if self.gemini_response_mode:
+                payload["response_mode"] = self.gemini_response_mode
+            return "/gemini/generate", payload
+        raise ValueError(f"Unknown route {route}")
+
+    def _generation(self, payload):
+        payload["image_count"] = self.image_count
+        if self.stream:
+            payload["stream"] = self.stream
+        return payload
+
+
+STREAM_CONTENT_TYPES = ("application/x-ndjson", "text/event-stream")
+
+
+def _is_image_event(line):
+    # NDJSON: {"event": "image", ...}; SSE: dòng "event: image"
+    return line == b"event: image" or line.startswith(b'{"event": "image"')
+
+
+ROUTES = (
+    "gen_prompt",
+    "gen_prompt_batch",
+    "generate_image",
+    "generate_image_from_prompt",
+    "upload_cropped_image",
+    "ideogram",
+    "gemini",
+)
+
+
+class RssSampler:
+    """Đọc VmRSS / VmHWM từ /proc (Linux), cộng trên cả cây process: dưới gunicorn/hypercorn pid được spawn
+    chỉ là master, bộ nhớ thật nằm ở các worker con"""
+
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak_kb = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _tree(self):
+        pids, stack = [], [self.pid]
+        while stack:
+            pid = stack.pop()
+            pids.append(pid)
+            try:
+                tasks = os.listdir(f"/proc/{pid}/task")
+            except OSError:
+                continue
+            for tid in tasks:
+                try:
+                    with open(f"/proc/{pid}/task/{tid}/children") as f:
+                        stack.extend(int(child) for child in f.read().split())
+                except (OSError, ValueError):
+                    pass
+        return pids
+
+    def read(self):
+        """Tổng VmRSS / VmHWM (kB) của pid và mọi process con, kèm số process đã đọc"""
+        values = {"VmRSS": 0, "VmHWM": 0, "processes": 0}
+        for pid in self._tree():
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith(("VmRSS:", "VmHWM:")):
+                            name, value = line.split(":", 1)
+                            values[name] += int(value.split()[0])
+                values["processes"] += 1
+            except (OSError, ValueError):
+                pass
+        return values
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self.peak_kb = max(self.peak_kb, self.read().get("VmRSS", 0))
+
+    def start(self):
+        self.peak_kb = self.read().get("VmRSS", 0)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.peak_kb
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_route(base_url, scenarios, route, total, concurrency, timeout):
+    """Bắn `total` request vào 1 route với `concurrency` luồng, trả về thống kê"""
+    local = threading.local()
+    counter = iter(range(total))
+    lock = threading.Lock()
+    latencies = []
+    first_images = []  # thời gian tới event image đầu tiên (request stream)
+    statuses = {}
+
+    def session():
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        return local.session
+
+    def worker():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            path, payload = scenarios.build(route, i)
+            started = time.perf_counter()
+            first_image = None
+            try:
+                kwargs = payload.kwargs if isinstance(payload, RequestBody) else {"json": payload}
+                response = session().post(base_url + path, timeout=timeout, stream=True, **kwargs)
+                if response.headers.get("Content-Type", "").startswith(STREAM_CONTENT_TYPES):
+                    # Batch và chế độ stream trả NDJSON / SSE: đọc theo dòng để bắt event image đầu tiên
+                    for line in response.iter_lines():
+                        if first_image is None and _is_image_event(line):
+                            first_image = time.perf_counter() - started
+                else:
+                    response.content  # đọc hết body
+                status = str(response.status_code)
+            except requests.RequestException as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                if first_image is not None:
+                    first_images.append(first_image)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    wall = time.perf_counter() - started
+
+    ok = statuses.get("200", 0)
+    result = {
+        "requests": len(latencies),
+        "ok": ok,
+        "errors": len(latencies) - ok,
+        "statuses": statuses,
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else None,
+        "goodput_rps": round(ok / wall, 2) if wall else None,
+        "mean": round(statistics.fmean(latencies), 4) if latencies else None,
+        "p50": round(percentile(latencies, 50), 4) if latencies else None,
+        "p95": round(percentile(latencies, 95), 4) if latencies else None,
+        "p99": round(percentile(latencies, 99), 4) if latencies else None,
+    }
+    if first_images:
+        result["first_image_p50"] = round(percentile(first_images, 50), 4)
+        result["first_image_p95"] = round(percentile(first_images, 95), 4)
+    return result
+
+
+def _free_port(host):
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def start_app(cmd, env, host, port, startup_timeout):
+    process = subprocess.Popen(shlex.split(cmd.format(host=host, port=port)), cwd=REPO_ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    started = time.perf_counter()
+    deadline = started + startup_timeout
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"App exited during startup with code {process.returncode}")
+        try:
+            requests.get(f"http://{host}:{port}/health", timeout=1)
+            return process, time.perf_counter() - started
+        except requests.RequestException:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"App did not become ready within {startup_timeout}s")
+
+
+def print_report(results, baseline=None):
+    header = f"{'route':<28}{'req':>6}{'err':>6}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'rss MB':>9}"
+    print(header)
+    print("-" * len(header))
+    for route, r in results["routes"].items():
+        rss = f"{r['rss_peak_kb'] / 1024:.0f}" if r.get("rss_peak_kb") else "-"
+        print(f"{route:<28}{r['requests']:>6}{r['errors']:>6}{r['throughput_rps']:>9}"
+              f"{r['p50']:>9}{r['p95']:>9}{r['p99']:>9}{rss:>9}")
+        if r.get("first_image_p50") is not None:
+            print(f"{'':<28}first image: p50 {r['first_image_p50']}, p95 {r['first_image_p95']}")
+        if r["errors"]:
+            print(f"{'':<28}statuses: {r['statuses']}")
+        before = (baseline or {}).get("routes", {}).get(route)
+        if before:
+            deltas = []
+            for key in ("throughput_rps", "p50", "p95", "p99", "first_image_p50"):
+                if before.get(key) and r.get(key) is not None:
+                    deltas.append(f"{key} {100 * (r[key] - before[key]) / before[key]:+.1f}%")
+            print(f"{'':<28}vs baseline: {', '.join(deltas)}")
+    if results.get("rss_kb"):
+        print(f"app RSS: start {results['rss_kb']['start'] / 1024:.0f} MB, "
+              f"end {results['rss_kb']['end'] / 1024:.0f} MB, peak {results['rss_kb']['peak'] / 1024:.0f} MB "
+              f"({results['rss_kb']['processes']} processes)")
+    if results.get("startup_seconds") is not None:
+        print(f"app startup: {results['startup_seconds']:.2f}s")
+    print(f"fake provider calls: {results['fakes']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--routes", default=",".join(ROUTES), help=f"Danh sách route ({', '.join(ROUTES)})")
+    parser.add_argument("--requests", type=int, default=50, help="Số request mỗi route")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--batch-size", type=int, default=10, help="Số item mỗi request gen_prompt_batch")
+    parser.add_argument("--image-count", type=int, default=1, help="Số ảnh mỗi request cho generate_image, generate_image_from_prompt và gemini")
+    parser.add_argument("--stream", choices=("sse", "ndjson"), help="Bật chế độ stream cho các route tạo ảnh (đo thêm thời gian tới ảnh đầu tiên)")
+    parser.add_argument("--gemini-response-mode", choices=("url", "multipart", "data_url"), help="response_mode cho route gemini")
+    parser.add_argument("--upload-format", choices=("json", "raw", "multipart"), default="json",
+                        help="Cách gửi ảnh cho upload_cropped_image: JSON base64, body image/png hoặc multipart")
+    parser.add_argument("--repeat", action="store_true", help="Dùng cùng 1 ảnh/prompt cho mọi request (đo cache + single-flight)")
+    parser.add_argument("--target", help="URL app đang chạy sẵn, bỏ qua việc tự khởi động app")
+    parser.add_argument("--pid", type=int, help="PID app (khi dùng --target) để đo RSS, cộng cả các process con (worker)")
+    parser.add_argument("--app-cmd", default=DEFAULT_APP_CMD, help="Lệnh chạy app, có {host} và {port}")
+    parser.add_argument("--app-env", action="append", default=[], help="Biến môi trường thêm cho app, vd OPENAI_RATE_LIMIT=1000")
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    parser.add_argument("--json", help="Ghi kết quả ra file JSON")
+    parser.add_argument("--compare", help="File JSON kết quả trước đó để so sánh")
+    add_fake_arguments(parser)
+    args = parser.parse_args()
+
+    routes = [r.strip() for r in args.routes.split(",") if r.strip()]
+    unknown = set(routes) - set(ROUTES)
+    if unknown:
+        parser.error(f"Unknown routes: {', '.join(sorted(unknown))}")
+
+    fakes = FakeProviders(configs_from_args(args), generated_mode=args.generated_mode).start()
+    scenarios = Scenarios(fakes, args.repeat, args.batch_size, args.image_count, args.stream, args.gemini_response_mode,
+                          args.upload_format)
+    process = None
+    results = {"config": vars(args), "routes": {}}
+
+    try:
+        if args.target:
+            base_url = args.target.rstrip("/")
+            pid = args.pid
+        else:
+            host, port = "127.0.0.1", _free_port("127.0.0.1")
+            workdir = tempfile.mkdtemp(prefix="bench-app-")
+            env = {
+                **os.environ,
+                **fakes.app_env(),
+                # Cache / job store riêng cho mỗi lần chạy để kết quả lặp lại được
+                "REF_CACHE_DIR": os.path.join(workdir, "reference_images"),
+                "PROMPT_CACHE_PATH": os.path.join(workdir, "prompt_results.sqlite3"),
+                "JOB_STORE_PATH": os.path.join(workdir, "jobs.sqlite3"),
+            }
+            env.update(item.split("=", 1) for item in args.app_env)
+            process, results["startup_seconds"] = start_app(args.app_cmd, env, host, port, args.startup_timeout)
+            base_url = f"http://{host}:{port}"
+            pid = process.pid
+
+        sampler = RssSampler(pid) if pid else None
+        rss_start = sampler.read() if sampler else None
+        overall_peak = 0
+        for route in routes:
+            if sampler:
+                sampler.start()
+            print(f"Running {route}: {args.requests} requests, concurrency {args.concurrency}...", flush=True)
+            results["routes"][route] = run_route(base_url, scenarios, route, args.requests, args.concurrency, args.timeout)
+            if sampler:
+                peak = sampler.stop()
+                results["routes"][route]["rss_peak_kb"] = peak
+                overall_peak = max(overall_peak, peak)
+        if sampler and rss_start and rss_start["VmRSS"]:
+            results["rss_kb"] = {"start": rss_start["VmRSS"], "end": sampler.read()["VmRSS"], "peak": overall_peak,
+                                 "processes": rss_start["processes"]}
+        results["fakes"] = fakes.counters()
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        fakes.stop()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Cấu hình gunicorn cho production: gunicorn -c gunicorn.conf.py app:app
+
+Worker gthread: mỗi request phần lớn thời gian chỉ đợi provider (tới 300s), thread rẻ hơn process
+và dùng chung HTTP pool, cache, limiter trong worker.
+"""
+import gc
+import os
+import tempfile
+
+# Nhiều worker: job phải nằm ở store dùng chung, nếu không GET /jobs/<id> về worker khác sẽ 404.
+# Đặt trước khi preload app (app đọc JOB_STORE lúc import).
+os.environ.setdefault("JOB_STORE", "sqlite")
+# /metrics cộng dồn counter của mọi worker qua file trong thư mục này (mới cho mỗi lần master khởi động)
+os.environ.setdefault("METRICS_MULTIPROC_DIR", os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), f"app-metrics-{os.getpid()}"))
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "32"))
+
+# Load app 1 lần ở master rồi fork: worker khởi động nhanh và dùng chung bộ nhớ của module đã import
+preload_app = True
+WARMUP = os.getenv("GUNICORN_WARMUP", "1") == "1"
+
+# Lời gọi provider dài nhất là 300s (Ideogram / images.edit) -> timeout phải lớn hơn
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "360"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "330"))  # request đang chạy được làm xong khi deploy
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "75"))  # lớn hơn idle timeout của load balancer
+
+# Thay worker định kỳ để chặn bộ nhớ tăng dần (PIL / glibc fragmentation)
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "2000"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", "200"))
+
+# Heartbeat của worker ghi vào tmpfs thay vì đĩa
+if os.path.isdir("/dev/shm"):
+    worker_tmp_dir = "/dev/shm"
+
+accesslog = os.getenv("GUNICORN_ACCESS_LOG", "-")
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+
+def when_ready(server):
+    # Chạy ở master sau khi preload app, trước khi fork worker
+    if WARMUP:
+        import app
+
+        timings = app.warm_up()
+        server.log.info("Warm-up imports: %s", timings)
+    # Đưa object hiện có ra khỏi GC để worker không làm bẩn (copy) các trang dùng chung khi GC quét
+    gc.freeze()
+
+
+def worker_exit(server, worker):
+    # Worker bị thay (max_requests) hoặc deploy: job chạy nền không phải request nên gunicorn không đợi.
+    # Đợi job xong trong graceful_timeout (trừ hao), job còn lại báo failed để client gửi lại.
+    import app
+
+    unfinished = app.JOB_RUNNER.drain(max(0, graceful_timeout - 10))
+    if unfinished:
+        server.log.warning("Worker %s exited with %d unfinished jobs", worker.pid, unfinished)
+    app.METRICS.flush()
+
+
+def child_exit(server, worker):
+    # Ở master: gộp metrics của worker đã thoát vào archive để counter trên /metrics không bị giảm
+    import app
+
+    app.METRICS.mark_dead(worker.pid)